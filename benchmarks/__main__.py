@@ -0,0 +1,68 @@
+"""Run the benchmark suite (suite.py), write the results as JSON and check them against a baseline.
+
+Run from the repository root:
+    python -m benchmarks                          # all benchmarks, compared with benchmarks/baseline.json if present
+    python -m benchmarks actor fanout --quick     # some benchmarks, fewer messages
+    python -m benchmarks --save-baseline          # store the results as the new baseline
+    python -m benchmarks --threshold 20 --thresholds thresholds.json
+
+Results go to benchmarks/results/bench_<time>.json (or --output).  The exit code is 1 if a metric regressed
+by more than its threshold: --threshold for all metrics (default 10 %), overridden per metric by the
+baseline's "thresholds" and then by --thresholds, a JSON file of {metric name or fnmatch pattern: percent}.
+Baselines are only meaningful on the machine that produced them.
+"""
+import argparse
+import os
+import sys
+import time
+from benchmarks import suite
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_BASELINE = os.path.join(BENCH_DIR, "baseline.json")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m benchmarks", description="qmafpy benchmark suite")
+    parser.add_argument("names", nargs="*", metavar="benchmark",
+                        help=f"benchmarks to run (default: all of {', '.join(suite.BENCHMARKS)})")
+    parser.add_argument("--quick", action="store_true", help="fewer messages and sizes, for a fast check")
+    parser.add_argument("--repeat", type=int, default=3, help="runs per benchmark, the best is kept")
+    parser.add_argument("--output", help="results file (default: benchmarks/results/bench_<time>.json)")
+    parser.add_argument("--baseline", default=DEFAULT_BASELINE, help="baseline results file")
+    parser.add_argument("--save-baseline", action="store_true", help="write the results to the baseline file")
+    parser.add_argument("--threshold", type=float, default=suite.DEFAULT_THRESHOLD_PCT,
+                        help="default regression threshold in percent")
+    parser.add_argument("--thresholds", help="JSON file of per metric thresholds")
+    args = parser.parse_args(argv)
+    unknown = [name for name in args.names if name not in suite.BENCHMARKS]
+    if unknown:
+        parser.error(f"unknown benchmark(s): {', '.join(unknown)}")
+
+    results = suite.run(args.names, quick=args.quick, repeat=args.repeat,
+                        progress=lambda name: print(f"Running {name}...", file=sys.stderr, flush=True))
+    output = args.output or os.path.join(BENCH_DIR, "results", f"bench_{time.strftime('%Y%m%d_%H%M%S')}.json")
+    suite.save_json(output, results)
+    print(f"Results written to {output}")
+
+    regressed = False
+    if os.path.exists(args.baseline) and not args.save_baseline:
+        thresholds = suite.load_json(args.thresholds) if args.thresholds else None
+        rows = suite.compare(results, suite.load_json(args.baseline), thresholds, args.threshold)
+        print(f"Compared with {args.baseline}")
+        print(suite.format_comparison(rows))
+        regressed = any(row[-1] == "regression" for row in rows)
+        if regressed:
+            print("REGRESSION: some metrics are worse than the baseline by more than their threshold")
+    else:
+        print(suite.format_results(results))
+    if args.save_baseline:
+        baseline = results
+        if os.path.exists(args.baseline):  # Keep the thresholds tuned in the previous baseline
+            baseline = dict(results, thresholds=suite.load_json(args.baseline).get("thresholds", {}))
+        suite.save_json(args.baseline, baseline)
+        print(f"Baseline written to {args.baseline}")
+    return 1 if regressed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,41 @@
+"""Messages/sec through the actor task loop for single and batched dispatch.
+
+Run from the repository root:
+    python -m benchmarks.bench_batch_dispatch
+"""
+import time
+from qmafpy import Actor
+
+MESSAGES = 200000
+BATCH_SIZES = (1, 16, 64, 256)
+
+
+class _Sink(Actor):
+    def __init__(self, name, batch_size, use_handler):
+        if use_handler:
+            self.batch_handlers = {"receive_data": "receive_data_batch"}
+        super().__init__(name, batch_size=batch_size)
+
+
+def bench(batch_size, use_handler, messages=MESSAGES):
+    """Return messages/sec for a producer filling the queue while the actor drains it"""
+    sink = _Sink(f"bench_batch_{batch_size}_{use_handler}", batch_size, use_handler)
+    item = ("receive_data", ("TOPIC", 1.0), {})
+    put = sink.q.put
+    start = time.perf_counter()
+    for _ in range(messages):
+        put(item)
+    sink.q.join()
+    rate = messages / (time.perf_counter() - start)
+    sink.stop()
+    return rate
+
+
+def main():
+    print(f"{'batch_size':>10} {'receive_data msgs/s':>20} {'batch handler msgs/s':>21}")
+    for batch_size in BATCH_SIZES:
+        print(f"{batch_size:>10} {bench(batch_size, False):>20.0f} {bench(batch_size, True):>21.0f}")
+
+
+if __name__ == "__main__":
+    main()
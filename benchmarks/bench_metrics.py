@@ -0,0 +1,50 @@
+"""Cost of the runtime metrics on the actor task loop.
+
+Time of one put + get + dispatch cycle (single thread, best of ROUNDS) for an actor created without and with
+App.metrics, and the resulting overhead.  Latency and service time are sampled one in
+App.cfg["metrics_sample_every"] tasks.
+
+Run from the repository root:
+    python -m benchmarks.bench_metrics
+"""
+import time
+from qmafpy import App, Actor
+from qmafpy.metrics import MetricsMgr
+
+MESSAGES = 20000
+ROUNDS = 50
+
+
+def bench(actor, messages=MESSAGES):
+    """Return ns per message"""
+    item = ("receive_data", ("TOPIC", 1.0), {})
+    q = actor.q
+    put, get, dispatch, task_done = q.put, q.get, actor._dispatch, q.task_done
+    start = time.perf_counter()
+    for _ in range(messages):
+        put(item)
+        dispatch(get())
+        task_done()
+    return (time.perf_counter() - start) / messages * 1e9
+
+
+def main():
+    metrics = MetricsMgr()
+    plain = Actor("bench_metrics_off", auto_start=False)
+    App.metrics = metrics
+    measured = Actor("bench_metrics_on", auto_start=False)
+    App.metrics = None
+    off, on = [], []
+    for _ in range(ROUNDS):  # Interleaved to share the machine's noise
+        off.append(bench(plain))
+        on.append(bench(measured))
+    print(f"{'metrics off ns/msg':>18} {'metrics on ns/msg':>18} {'overhead':>9}")
+    print(f"{min(off):>18.0f} {min(on):>18.0f} {(min(on) / min(off) - 1) * 100:>8.1f}%")
+    snap = metrics.snapshot()["actors"]["bench_metrics_on"]
+    print(f"queue latency ns: {snap['queue_latency_ns']}")
+    print(f"service time ns: {snap['service_ns']['receive_data']}")
+    metrics.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,64 @@
+"""Network transport over loopback: one-way throughput and query round trip, for TCP and Unix sockets.
+
+A single node listens, and the peer "loop" is its own address, so messages to loop:<actor> go through the
+socket, framing and batching, and back into this process.
+
+Run from the repository root:
+    python -m benchmarks.bench_network
+"""
+import os
+import tempfile
+import time
+from qmafpy import App, Actor
+from qmafpy.histogram import Histogram
+from qmafpy.network import NetworkNode
+
+MESSAGES = 100000
+QUERIES = 2000
+
+
+class _Sink(Actor):
+    def noop(self, *args):
+        pass
+
+    def echo(self, value, return_q=None):
+        return value
+
+
+def bench(address, messages=MESSAGES, queries=QUERIES):
+    """Return (msgs/s, query round trip Histogram in ns, batches sent)"""
+    App.network = network = NetworkNode("bench", listen=address, auth_key="bench", linger_s=0.0005)
+    network.add_peer("loop", network.address)
+    sink = _Sink("bench_net_sink")
+    item = ("noop", (1, "TOPIC", 1.0), {})
+    remote_q = App.get_queue("loop:bench_net_sink")
+    sink.task_query("loop:bench_net_sink", "echo", 5, 0)  # Connect
+    start = time.perf_counter()
+    for _ in range(messages):
+        remote_q.put(item)
+    sink.task_query("loop:bench_net_sink", "echo", 30, 0)  # Behind every message on the same connection
+    rate = messages / (time.perf_counter() - start)
+    round_trip = Histogram()
+    for i in range(queries):
+        start = time.perf_counter_ns()
+        sink.query("loop:bench_net_sink", "echo", 5, i).result()
+        round_trip.record(time.perf_counter_ns() - start)
+    batches = network.get_stats()["loop"][0]["batches"]
+    sink.stop()
+    network.stop()
+    App.network = None
+    return rate, round_trip, batches
+
+
+def main():
+    print(f"{'transport':>9} {'msgs/s':>10} {'batches':>8} {'query p50 us':>13} {'query p99 us':>13}")
+    with tempfile.TemporaryDirectory() as sock_dir:
+        for label, address in (("tcp", "tcp://127.0.0.1:0"),
+                               ("unix", f"unix://{os.path.join(sock_dir, 'bench.sock')}")):
+            rate, round_trip, batches = bench(address)
+            summary = round_trip.summary()
+            print(f"{label:>9} {rate:>10.0f} {batches:>8} {summary['p50'] / 1e3:>13.1f} {summary['p99'] / 1e3:>13.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,101 @@
+"""Throughput of ProcessActor against the thread based Actor.
+
+Measures small message dispatch rate, large payload transfer rate, and the time
+for several actors to finish a CPU bound task in parallel.
+
+Run from the repository root:
+    python -m benchmarks.bench_process_actor
+"""
+import time
+from qmafpy import App, Actor, ProcessActor
+
+MESSAGES = 20000
+PAYLOAD_MB = 8
+PAYLOAD_MSGS = 20
+CPU_ACTORS = 4
+CPU_LOOPS = 3000000
+
+
+class _Counter:
+    def count(self, data=None):
+        self.cnt += 1
+
+    def burn(self, loops):
+        total = 0
+        for i in range(loops):
+            total += i
+        self.cnt += 1
+
+    def get_count(self, return_q=None):
+        return_q.put(self.cnt)
+
+
+class ThreadCounter(_Counter, Actor):
+    def __init__(self, name):
+        self.cnt = 0
+        super().__init__(name)
+
+
+class ProcessCounter(_Counter, ProcessActor):
+    def __init__(self, name):
+        self.cnt = 0
+        super().__init__(name)
+
+
+class _Client(Actor):
+    def __init__(self):
+        super().__init__("bench_client")
+
+    def wait_count(self, names, target, timeout=120):
+        """Poll the counters with task_query until each has handled target messages"""
+        deadline = time.perf_counter() + timeout
+        for name in names:
+            while time.perf_counter() < deadline:
+                reply = App.create_queue("bench_reply")
+                self.enqueue(name, "get_count", return_q=reply)
+                if reply.get(timeout=timeout) >= target:
+                    break
+                time.sleep(0.001)
+
+
+def _run(counter_cls, client, label):
+    counter = counter_cls(f"bench_{label}")
+    name = counter.name
+    client.wait_count([name], 0)  # Child process is up
+    start = time.perf_counter()
+    for _ in range(MESSAGES):
+        client.enqueue(name, "count")
+    client.wait_count([name], MESSAGES)
+    msg_rate = MESSAGES / (time.perf_counter() - start)
+
+    payload = bytearray(PAYLOAD_MB * 1024 * 1024)
+    start = time.perf_counter()
+    for _ in range(PAYLOAD_MSGS):
+        client.enqueue(name, "count", payload)
+    client.wait_count([name], MESSAGES + PAYLOAD_MSGS)
+    mb_rate = PAYLOAD_MB * PAYLOAD_MSGS / (time.perf_counter() - start)
+    counter.exit()
+
+    counters = [counter_cls(f"bench_{label}_cpu{i}") for i in range(CPU_ACTORS)]
+    names = [c.name for c in counters]
+    client.wait_count(names, 0)
+    start = time.perf_counter()
+    for cpu_name in names:
+        client.enqueue(cpu_name, "burn", CPU_LOOPS)
+    client.wait_count(names, 1)
+    cpu_s = time.perf_counter() - start
+    for c in counters:
+        c.exit()
+    return msg_rate, mb_rate, cpu_s
+
+
+def main():
+    client = _Client()
+    print(f"{'actor':>13} {'msgs/s':>10} {'MB/s':>8} {f'{CPU_ACTORS} x cpu task (s)':>18}")
+    for counter_cls, label in ((ThreadCounter, "thread"), (ProcessCounter, "process")):
+        msg_rate, mb_rate, cpu_s = _run(counter_cls, client, label)
+        print(f"{counter_cls.__name__:>13} {msg_rate:>10.0f} {mb_rate:>8.0f} {cpu_s:>18.2f}")
+
+
+if __name__ == "__main__":
+    main()
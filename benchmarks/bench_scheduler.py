@@ -0,0 +1,60 @@
+"""Per-tick cost of SchedMgr at 10 / 1k / 100k scheduled items.
+
+Run from the repository root:
+    python -m benchmarks.bench_scheduler
+"""
+import time
+from qmafpy import App
+from qmafpy.scheduler import SchedMgr
+
+SIZES = (10, 1000, 100000)
+TICKS = 2000
+
+
+def _drain(q):
+    while not q.empty():
+        q.get_nowait()
+
+
+def bench_sizes(sizes=SIZES, ticks=TICKS):
+    """Return {size: (idle_tick_us, due_tick_us, flush_ms)} for each number of scheduled items."""
+    sink_q = App.create_queue("bench_sink")
+    sched = SchedMgr()
+    sched.stop()  # Drive _check directly, without the wake monitor thread
+    results = {}
+    for size in sizes:
+        sched.reset()
+        # Park the items an hour out so only the probe item below is ever due
+        for i in range(size):
+            sched.schedule("bench", f"item_{i}", 3600 + i * 0.001, 0, "bench_sink", "noop")
+        _drain(sched.q_wake)
+        # Idle tick: nothing is due
+        start = time.perf_counter()
+        for _ in range(ticks):
+            sched._check()
+        idle_us = (time.perf_counter() - start) / ticks * 1e6
+        _drain(sched.q_wake)
+        # Due tick: one periodic item fires on every check
+        sched.schedule("bench", "probe", 0, 0, "bench_sink", "noop")
+        start = time.perf_counter()
+        for _ in range(ticks):
+            sched._check()
+        due_us = (time.perf_counter() - start) / ticks * 1e6
+        _drain(sched.q_wake)
+        _drain(sink_q)
+        # Cancellation cost for one source
+        start = time.perf_counter()
+        sched.flush_my_items("bench")
+        flush_ms = (time.perf_counter() - start) * 1e3
+        results[size] = (idle_us, due_us, flush_ms)
+    return results
+
+
+def main():
+    print(f"{'items':>8} {'idle tick (us)':>15} {'due tick (us)':>14} {'flush (ms)':>11}")
+    for size, (idle_us, due_us, flush_ms) in bench_sizes().items():
+        print(f"{size:>8} {idle_us:>15.2f} {due_us:>14.2f} {flush_ms:>11.2f}")
+
+
+if __name__ == "__main__":
+    main()
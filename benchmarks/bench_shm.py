@@ -0,0 +1,73 @@
+"""Large payload delivery to a ProcessActor: pickled through the pipe vs a shared memory handle.
+
+pipe: the payload is sent as a task argument (pickled and copied to the child).
+shm: the payload is written once into the topic's shared memory ring and the child gets a ShmHandle,
+then maps a zero-copy view of it.
+Times are per message, from enqueue until the child's reply is received.
+
+Run from the repository root:
+    python -m benchmarks.bench_shm
+"""
+import time
+from qmafpy import App, Actor, ProcessActor
+from qmafpy.shm_ring import share
+
+PAYLOAD_MB = (1, 10, 100)
+MESSAGES = 10
+
+
+class ShmConsumer(ProcessActor):
+    def consume(self, payload, return_q=None):
+        return_q.put((len(payload), payload[-1]))
+
+    def consume_shared(self, handle, return_q=None):
+        view = handle.view()
+        return_q.put((len(view), view[-1]))
+
+
+class _Client(Actor):
+    def __init__(self):
+        super().__init__("bench_shm_client")
+
+    def call(self, task, arg, timeout=120):
+        reply = App.create_queue("bench_shm_reply")
+        self.enqueue("bench_shm_consumer", task, arg, return_q=reply)
+        return reply.get(timeout=timeout)
+
+
+def bench(client, size_mb, messages=MESSAGES):
+    """Return (pipe, shm write, shm) ms per message"""
+    payload = bytearray(size_mb * 1024 * 1024)
+    payload[-1] = 1
+    start = time.perf_counter()
+    for _ in range(messages):
+        client.call("consume", payload)
+    pipe_ms = (time.perf_counter() - start) / messages * 1000
+    for _ in range(App.cfg["shm_slot_cnt"]):
+        share("bench_shm", payload)  # Create the ring and fault its pages in outside of the timing
+    start = time.perf_counter()
+    for _ in range(messages):
+        share("bench_shm", payload)
+    write_ms = (time.perf_counter() - start) / messages * 1000
+    start = time.perf_counter()
+    for _ in range(messages):
+        client.call("consume_shared", share("bench_shm", payload))
+    shm_ms = (time.perf_counter() - start) / messages * 1000
+    return pipe_ms, write_ms, shm_ms
+
+
+def main():
+    App.cfg.setdefault("shm_slot_cnt", 4)
+    client = _Client()
+    consumer = ShmConsumer("bench_shm_consumer")
+    client.call("consume", b"x")  # Child process is up
+    print(f"{'payload MB':>10} {'pipe ms/msg':>12} {'shm write ms':>13} {'shm ms/msg':>11}")
+    for size_mb in PAYLOAD_MB:
+        pipe_ms, write_ms, shm_ms = bench(client, size_mb)
+        print(f"{size_mb:>10} {pipe_ms:>12.2f} {write_ms:>13.2f} {shm_ms:>11.2f}")
+    consumer.exit()
+    client.stop()
+
+
+if __name__ == "__main__":
+    main()
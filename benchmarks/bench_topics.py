@@ -0,0 +1,85 @@
+"""Subscription matching cost for 10k hierarchical topics against a growing number of wildcard subscriptions.
+
+cold: match with an empty match cache (trie walk), warm: match cache hit,
+linear: reference scan that tests every wildcard subscription.
+
+Run from the repository root:
+    python -m benchmarks.bench_topics
+"""
+import random
+import time
+from qmafpy.subscription import TOPIC_SEP, WILDCARD_ALL, WILDCARD_ONE, SubsriptionMgr
+
+RACKS, DMMS, CHANNELS = 100, 10, 10  # 10k topics
+WILDCARD_SUBS = (0, 100, 1000, 10000)
+
+
+def _topics():
+    return [f"rack{r}/dmm{d}/ch{c}" for r in range(RACKS) for d in range(DMMS) for c in range(CHANNELS)]
+
+
+def _patterns(cnt, seed=1):
+    """cnt distinct wildcard topics.  Most of them match some of the published topics."""
+    rnd = random.Random(seed)
+    patterns = set()
+    while len(patterns) < cnt:
+        r, d, c = rnd.randrange(RACKS * 4), rnd.randrange(DMMS), rnd.randrange(CHANNELS)
+        patterns.add(rnd.choice((f"rack{r}/+/ch{c}", f"rack{r}/dmm{d}/+", f"rack{r}/dmm{d}/#",
+                                 f"+/dmm{d}/ch{c}", f"rack{r}/#", f"lab{r}/dmm{d}/+")))
+    return sorted(patterns)
+
+
+def _linear_match(patterns, topic):
+    levels = topic.split(TOPIC_SEP)
+    matches = []
+    for pattern in patterns:
+        p_levels = pattern.split(TOPIC_SEP)
+        for i, level in enumerate(p_levels):
+            if level == WILDCARD_ALL:
+                matches.append(pattern)
+                break
+            if i >= len(levels) or (level != WILDCARD_ONE and level != levels[i]):
+                break
+        else:
+            if len(p_levels) == len(levels):
+                matches.append(pattern)
+    return matches
+
+
+def bench(subs_mgr, wildcard_cnt, topics):
+    """Return (cold, warm, linear) microseconds per published topic"""
+    subs_mgr.reset()
+    patterns = _patterns(wildcard_cnt)
+    for pattern in patterns:
+        subs_mgr.add_subscription(pattern, "bench_sink", "receive_data")
+    match = subs_mgr._match
+    subs_mgr._match_cache.clear()
+    start = time.perf_counter()
+    for topic in topics:
+        match(topic)
+    cold = (time.perf_counter() - start) / len(topics) * 1e6
+    start = time.perf_counter()
+    for topic in topics:
+        match(topic)
+    warm = (time.perf_counter() - start) / len(topics) * 1e6
+    sample = topics[::100]
+    start = time.perf_counter()
+    for topic in sample:
+        _linear_match(patterns, topic)
+    linear = (time.perf_counter() - start) / len(sample) * 1e6
+    return cold, warm, linear
+
+
+def main():
+    subs_mgr = SubsriptionMgr()
+    topics = _topics()
+    print(f"{len(topics)} topics")
+    print(f"{'wildcard subs':>13} {'cold us/topic':>14} {'warm us/topic':>14} {'linear us/topic':>16}")
+    for wildcard_cnt in WILDCARD_SUBS:
+        cold, warm, linear = bench(subs_mgr, wildcard_cnt, topics)
+        print(f"{wildcard_cnt:>13} {cold:>14.2f} {warm:>14.2f} {linear:>16.2f}")
+    subs_mgr.stop()
+
+
+if __name__ == "__main__":
+    main()
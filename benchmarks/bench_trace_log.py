@@ -0,0 +1,68 @@
+"""Cost of disabled trace (level 5) log lines.
+
+Compares an eager f-string log call with the lazy %-style call used by Actor,
+for a large payload, and measures the per-message cost of the dequeue loop.
+
+Run from the repository root:
+    python -m benchmarks.bench_trace_log
+"""
+import time
+from qmafpy import Actor
+
+CALLS = 20000
+PAYLOAD = list(range(10000))
+
+
+class _Sink(Actor):
+    def __init__(self):
+        self.done = None
+        super().__init__("bench_sink", log_level=0)
+
+    def noop(self, data):
+        pass
+
+    def mark(self):
+        self.done = time.perf_counter()
+
+
+def _per_call_ns(func, calls=CALLS):
+    start = time.perf_counter()
+    for _ in range(calls):
+        func()
+    return (time.perf_counter() - start) / calls * 1e9
+
+
+def bench_log_calls():
+    """Return (eager_ns, lazy_ns, guard_ns) per disabled trace log call."""
+    actor = _Sink()
+    actor.stop()
+    data = PAYLOAD
+    eager_ns = _per_call_ns(lambda: actor.log(f"Receive Data topic={'T'}, data={data}", 5), calls=200)
+    lazy_ns = _per_call_ns(lambda: actor.log("Receive Data topic=%s, data=%s", 5, "T", data))
+    guard_ns = _per_call_ns(lambda: actor.log_enabled(5))
+    return eager_ns, lazy_ns, guard_ns
+
+
+def bench_dequeue(messages=CALLS):
+    """Return ns per message dispatched through the actor's task loop with tracing disabled."""
+    actor = _Sink()
+    start = time.perf_counter()
+    for _ in range(messages):
+        actor.q.put(("noop", (PAYLOAD,), {}))
+    actor.q.put(("mark", (), {}))
+    actor.q.join()
+    elapsed = actor.done - start
+    actor.stop()
+    return elapsed / messages * 1e9
+
+
+def main():
+    eager_ns, lazy_ns, guard_ns = bench_log_calls()
+    print(f"disabled trace line, eager f-string : {eager_ns:12.0f} ns")
+    print(f"disabled trace line, lazy args      : {lazy_ns:12.0f} ns")
+    print(f"log_enabled(5) guard                : {guard_ns:12.0f} ns")
+    print(f"enqueue + dequeue + dispatch        : {bench_dequeue():12.0f} ns/msg")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,59 @@
+"""Regression check: aggregated and rate limited subscriptions.
+
+A subscriber with aggregate="mean" on a topic carrying non-numeric data must not break the delivery to the
+other subscribers, nor raise from publish.  A max_rate_hz subscriber must receive the last sample of a burst
+(trailing edge).
+
+Run from the repository root:
+    python -m benchmarks.regress_aggregate
+"""
+import sys
+import time
+from qmafpy import App, AppMgr, Actor
+
+TOPIC = "regress/agg"
+
+
+class Recorder(Actor):
+    def __init__(self, name):
+        self.values = []
+        super().__init__(name)
+
+    def on_value(self, topic, attributes, data):
+        self.values.append(data)
+
+
+def main():
+    AppMgr.init_services()
+    client = Actor("regress_client")
+    plain = Recorder("regress_plain")
+    mean = Recorder("regress_mean")
+    rate = Recorder("regress_rate")
+    plain.subscribe(TOPIC, "on_value")
+    mean.subscribe(TOPIC, "on_value", every_nth=2, aggregate="mean")
+    rate.subscribe(TOPIC, "on_value", max_rate_hz=5)
+    failures = []
+    published = ["x", "y", {"a": 1}, {"b": 2}, 1.0, 3.0]
+    for data in published:
+        try:
+            client.publish(TOPIC, data)
+        except Exception as e:
+            failures.append(f"publish({data!r}) raised {type(e).__name__}: {e}")
+    time.sleep(0.5)  # Past the rate limit interval, so the trailing edge is delivered
+    if plain.values != published:
+        failures.append(f"plain subscriber received {plain.values}, expected {published}")
+    if mean.values[-1:] != [2.0]:
+        failures.append(f"mean subscriber received {mean.values}, expected the mean 2.0 last")
+    if rate.values != ["x", 3.0]:
+        failures.append(f"rate limited subscriber received {rate.values}, expected ['x', 3.0]")
+    stats = App.subs_mgr.get_subscription_stats(TOPIC)[TOPIC]
+    if not stats["regress_mean"].get("aggregate_errors"):
+        failures.append(f"no aggregate errors counted: {stats}")
+    for failure in failures:
+        print(f"FAIL: {failure}")
+    print("FAIL" if failures else "PASS")
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,76 @@
+"""Regression check: a full mailbox with the block policy must not stall the scheduler or the publishers.
+
+An actor with a small blocking mailbox is kept busy while the scheduler ticks into it and topics are
+published to it.  schedule(), del_item() and publish must still return at once, and the refused ticks and
+deliveries must be counted.
+
+Run from the repository root:
+    python -m benchmarks.regress_full_mailbox
+"""
+import sys
+import threading
+import time
+from qmafpy import App, AppMgr, Actor
+from qmafpy.mailbox import MAILBOX_BLOCK
+
+TOPIC = "regress/full"
+MAX_CALL_S = 1.0
+
+
+class Slow(Actor):
+    def __init__(self, name):
+        self.release = threading.Event()
+        super().__init__(name, mailbox={"maxsize": 2, "policy": MAILBOX_BLOCK})
+
+    def hold(self):
+        self.release.wait(30)
+
+    def tick(self):
+        pass
+
+    def on_value(self, topic, attributes, data):
+        pass
+
+
+def timed_call(func, *args):
+    """Return the time func took, or None if it did not return within MAX_CALL_S"""
+    done = threading.Event()
+    start = time.perf_counter()
+    thread = threading.Thread(target=lambda: (func(*args), done.set()), daemon=True)
+    thread.start()
+    if not done.wait(MAX_CALL_S):
+        return None
+    return time.perf_counter() - start
+
+
+def main():
+    AppMgr.init_services()
+    client = Actor("regress_client")
+    slow = Slow("regress_slow")
+    slow.subscribe(TOPIC, "on_value")
+    client.enqueue(slow.name, "hold")
+    time.sleep(0.1)
+    client.sched("tick", 0.001, 0, slow.name, "tick")
+    time.sleep(0.2)  # The mailbox is full and the scheduler keeps ticking into it
+    failures = []
+    calls = (("schedule", client.sched, "other", 10, 1, slow.name, "tick"),
+             ("del_item", client.sched_del_item, "other"),
+             ("publish", client.publish, TOPIC, 1))
+    for label, func, *args in calls:
+        if timed_call(func, *args) is None:
+            failures.append(f"{label} blocked for more than {MAX_CALL_S} s behind the full mailbox")
+    stats = client.sched_get_stats("tick")
+    if not stats or not stats.get("rejected"):
+        failures.append(f"no rejected ticks counted: {stats}")
+    if not App.subs_mgr.failed_deliveries:
+        failures.append("no failed delivery counted")
+    slow.release.set()
+    client.sched_del_item("tick")
+    for failure in failures:
+        print(f"FAIL: {failure}")
+    print("FAIL" if failures else "PASS")
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
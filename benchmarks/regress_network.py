@@ -0,0 +1,146 @@
+"""Regression check: network transport between two processes.
+
+A server node runs in a child process.  This process queries one of its actors over TCP loopback and checks:
+the reply comes back, a server that can't prove it holds the auth_key is refused, listening on TCP without an
+auth_key is refused, and a node that does not listen gets a clear error on query and subscribe instead of replies
+that never come.  Messages the server can't deliver (full mailbox, unknown actor, service actor) must not lose
+the other messages of their batch.
+
+Run from the repository root:
+    python -m benchmarks.regress_network
+"""
+import os
+import socket
+import subprocess
+import sys
+import threading
+import time
+from qmafpy import App, AppMgr, Actor
+from qmafpy.mailbox import MAILBOX_REJECT
+from qmafpy.network import NetworkNode
+from qmafpy.rpc import QueryError
+
+AUTH_KEY = "regress-key"
+SERVER = "regress_server"
+
+
+class Echo(Actor):
+    def __init__(self, name):
+        self.values = []
+        super().__init__(name)
+
+    def echo(self, value, return_q=None):
+        return value
+
+    def record(self, value):
+        self.values.append(value)
+
+    def get_values(self, return_q=None):
+        return self.values
+
+
+class Full(Actor):
+    def __init__(self, name):
+        self.release = threading.Event()
+        super().__init__(name, mailbox={"maxsize": 1, "policy": MAILBOX_REJECT})
+
+    def hold(self):
+        self.release.wait(30)
+
+
+def serve():
+    """Child process: run the server node until stdin is closed"""
+    AppMgr.init_services()
+    App.network = NetworkNode(SERVER, listen="tcp://127.0.0.1:0", auth_key=AUTH_KEY)
+    Echo("regress_echo")
+    Full("regress_full")
+    print(App.network.address, flush=True)
+    sys.stdin.read()
+    App.network.stop()
+
+
+def fake_server():
+    """Accept every hello and answer with a wrong MAC.  Return its address."""
+    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server.bind(("127.0.0.1", 0))
+    server.listen()
+
+    def run():
+        while True:
+            sock, _ = server.accept()
+            sock.sendall(os.urandom(16))  # Nonce
+            sock.recv(65536)
+            sock.sendall(b"\x01" + bytes(32))  # Accepted, with a zero MAC
+    threading.Thread(target=run, daemon=True).start()
+    return f"tcp://127.0.0.1:{server.getsockname()[1]}"
+
+
+def main():
+    if sys.argv[1:] == ["serve"]:
+        serve()
+        return 0
+    failures = []
+    child = subprocess.Popen([sys.executable, "-m", "benchmarks.regress_network", "serve"],
+                             stdin=subprocess.PIPE, stdout=subprocess.PIPE, universal_newlines=True)
+    try:
+        server_address = child.stdout.readline().strip()
+        AppMgr.init_services()
+        client = Actor("regress_client")
+
+        # A node that does not listen can't get replies
+        App.network = NetworkNode("regress_sender", peers={SERVER: server_address}, auth_key=AUTH_KEY)
+        try:
+            client.query(f"{SERVER}:regress_echo", "echo", 5, 1)
+            failures.append("query from a node that does not listen did not raise")
+        except QueryError:
+            pass
+        try:
+            client.subscribe(f"{SERVER}:topic", "echo")
+            failures.append("remote subscribe from a node that does not listen did not raise")
+        except ValueError:
+            pass
+        App.network.stop()
+
+        for address in ("tcp://0.0.0.0:0", "tcp://127.0.0.1:0"):
+            try:
+                NetworkNode("regress_open", listen=address).stop()
+                failures.append(f"listening on {address} without an auth_key was allowed")
+            except ValueError:
+                pass
+
+        App.network = NetworkNode("regress_client", listen="tcp://127.0.0.1:0",
+                                  peers={SERVER: server_address, "regress_fake": fake_server()}, auth_key=AUTH_KEY)
+        rtn, data = client.task_query(f"{SERVER}:regress_echo", "echo", 10, 42)
+        if (rtn, data) != (0, 42):
+            failures.append(f"query to the child process returned {(rtn, data)}, expected (0, 42)")
+        # One batch: the messages for regress_echo must all arrive
+        client.enqueue(f"{SERVER}:regress_echo", "record", -1)
+        for _ in range(3):
+            client.enqueue(f"{SERVER}:regress_full", "hold")
+        client.enqueue(f"{SERVER}:regress_missing", "record", 0)
+        client.enqueue(f"{SERVER}:sched", "flush_my_items", "regress_echo")
+        for value in range(3):
+            client.enqueue(f"{SERVER}:regress_echo", "record", value)
+        rtn, values = client.task_query(f"{SERVER}:regress_echo", "get_values", 10)
+        if values != [-1, 0, 1, 2]:
+            failures.append(f"regress_echo received {values} behind undeliverable messages, expected [-1, 0, 1, 2]")
+        client.enqueue("regress_fake:regress_echo", "echo", 1)
+        time.sleep(0.5)
+        fake_stats = App.network.get_stats()["regress_fake"][0]
+        if fake_stats["connects"]:
+            failures.append(f"connected to a server that does not hold the auth_key: {fake_stats}")
+        App.network.stop()
+    finally:
+        child.stdin.close()
+        try:
+            child.wait(10)
+        except subprocess.TimeoutExpired:
+            child.kill()
+    for failure in failures:
+        print(f"FAIL: {failure}")
+    print("FAIL" if failures else "PASS")
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,71 @@
+"""Regression check: a ProcessActor subclass that subscribes and schedules in its constructor.
+
+The constructor runs in the parent (to build the handle) and in the child.  The subscription and the
+schedule must be made once, by the child, and the handle must have the attributes of an Actor.
+
+Run from the repository root:
+    python -m benchmarks.regress_process_actor
+"""
+import sys
+import time
+from qmafpy import App, AppMgr, Actor, ProcessActor
+
+TOPIC = "regress/value"
+
+
+class Subscriber(ProcessActor):
+    def __init__(self, name):
+        self.values = []
+        super().__init__(name)
+        self.subscribe(TOPIC, "on_value")
+        self.sched_local("tick", 3600, 1, "get_values")
+
+    def on_value(self, topic, attributes, data):
+        self.values.append(data)
+
+    def get_values(self, return_q=None):
+        return list(self.values)
+
+
+def main():
+    AppMgr.init_services()
+    schedule_calls = []
+    schedule = App.scheduler.schedule
+    App.scheduler.schedule = lambda source_name, *args, **kwargs: (
+        schedule_calls.append(source_name), schedule(source_name, *args, **kwargs))
+    client = Actor("regress_client")
+    sub = Subscriber("regress_sub")
+    failures = []
+    if not hasattr(sub, "received_data"):
+        failures.append("the handle has no received_data")
+    rtn, values = client.task_query(sub.name, "get_values", 30)
+    if rtn != 0:
+        failures.append("the child did not answer")
+    deadline = time.monotonic() + 10
+    while not App.subs_mgr.get_subscription_stats(TOPIC)[TOPIC] and time.monotonic() < deadline:
+        time.sleep(0.01)
+    time.sleep(0.5)  # A duplicate would be forwarded by now
+    subscriptions = App.subs_mgr.get_subscription_stats(TOPIC)[TOPIC]
+    if len(subscriptions) != 1:
+        failures.append(f"{len(subscriptions)} subscriptions made, expected 1: {subscriptions}")
+    if schedule_calls.count(sub.name) != 1:
+        failures.append(f"{schedule_calls.count(sub.name)} schedule calls made, expected 1")
+    client.publish(TOPIC, 1)
+    deadline = time.monotonic() + 10
+    values = []
+    while not values and time.monotonic() < deadline:
+        _, values = client.task_query(sub.name, "get_values", 10)
+        time.sleep(0.01)
+    time.sleep(0.2)
+    _, values = client.task_query(sub.name, "get_values", 10)
+    if values != [1]:
+        failures.append(f"received {values}, expected [1]")
+    sub.stop()
+    for failure in failures:
+        print(f"FAIL: {failure}")
+    print("FAIL" if failures else "PASS")
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,44 @@
+"""Run the regression checks (regress_*.py), each in its own process since they use the global App.
+
+Run from the repository root:
+    python -m benchmarks.regressions                  # all checks
+    python -m benchmarks.regressions process_actor    # some checks
+
+The exit code is 1 if a check failed.
+"""
+import os
+import subprocess
+import sys
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+TIMEOUT_S = 120
+
+
+def find_checks():
+    return sorted(name[len("regress_"):-len(".py")] for name in os.listdir(BENCH_DIR)
+                  if name.startswith("regress_") and name.endswith(".py"))
+
+
+def main(argv=None):
+    names = (argv if argv is not None else sys.argv[1:]) or find_checks()
+    failed = []
+    for name in names:
+        try:
+            result = subprocess.run([sys.executable, "-m", f"benchmarks.regress_{name}"], timeout=TIMEOUT_S,
+                                    cwd=os.path.dirname(BENCH_DIR), stdout=subprocess.PIPE,
+                                    stderr=subprocess.STDOUT, universal_newlines=True)
+            passed = result.returncode == 0
+            output = result.stdout
+        except subprocess.TimeoutExpired as e:
+            passed = False
+            output = f"{e.output or ''}\nTimed out after {TIMEOUT_S} s (hung?)"
+        print(f"{'PASS' if passed else 'FAIL'}  {name}")
+        if not passed:
+            failed.append(name)
+            print("    " + output.strip().replace("\n", "\n    "))
+    print(f"{len(names) - len(failed)} of {len(names)} checks passed")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,329 @@
+"""Benchmark suite of the messaging core, with JSON results and regression checks against a baseline.
+
+Each benchmark returns {metric: (value, unit, better)}, better being "higher" or "lower".  Metrics are named
+<benchmark>.<metric> in the results.  Each benchmark runs repeat times and the best value of each metric is kept,
+to reduce the noise of the machine.
+
+Run from the repository root (see __main__.py for the options):
+    python -m benchmarks
+"""
+import contextlib
+import fnmatch
+import json
+import os
+import platform
+import sys
+import tempfile
+import threading
+import time
+from qmafpy import App, Actor
+from qmafpy.histogram import Histogram
+from qmafpy.log_manager import AppLogger, LOG_FORMAT_JSONL, LOG_FORMAT_TEXT
+from qmafpy.metrics import MetricsMgr
+from qmafpy.recorder import MessageRecorder
+from qmafpy.scheduler import SchedMgr
+from qmafpy.subscription import SubsriptionMgr
+from benchmarks import bench_batch_dispatch as batch_dispatch
+from benchmarks import bench_metrics as metrics_overhead
+from benchmarks import bench_network as network_loopback
+from benchmarks import bench_scheduler as scheduler_ticks
+from benchmarks import bench_topics as topic_matching
+
+HIGHER, LOWER = "higher", "lower"
+DEFAULT_THRESHOLD_PCT = 10.0
+
+
+class _Sink(Actor):
+    """Records the time from enqueue to dispatch of stamped messages"""
+    def __init__(self, name, **kwargs):
+        self.latency = Histogram()  # ns
+        super().__init__(name, **kwargs)
+
+    def stamp(self, put_ns):
+        self.latency.record(time.perf_counter_ns() - put_ns)
+
+    def noop(self, *args):
+        pass
+
+
+def _drain(q):
+    while not q.empty():
+        q.get_nowait()
+
+
+#### Benchmarks
+def bench_actor(quick):
+    """enqueue -> dispatch throughput of a running Actor, and dispatch latency percentiles of paced messages"""
+    messages = 20000 if quick else 200000
+    sink = _Sink("bench_suite_actor")
+    item = ("noop", (), {})
+    put = sink.q.put
+    start = time.perf_counter()
+    for _ in range(messages):
+        put(item)
+    sink.q.join()
+    rate = messages / (time.perf_counter() - start)
+    for _ in range(1000 if quick else 5000):  # One message at a time: latency without queueing
+        put(("stamp", (time.perf_counter_ns(),), {}))
+        sink.q.join()
+    sink.stop()
+    summary = sink.latency.summary()
+    return {"throughput_msgs_s": (rate, "msgs/s", HIGHER),
+            "latency_p50_us": (summary["p50"] / 1e3, "us", LOWER),
+            "latency_p99_us": (summary["p99"] / 1e3, "us", LOWER),
+            "latency_p999_us": (summary["p999"] / 1e3, "us", LOWER)}
+
+
+def bench_fanout(quick):
+    """SubsriptionMgr publish cost with 1, 10 and 100 subscribers of a topic"""
+    publishes = 2000 if quick else 20000
+    subs_mgr = SubsriptionMgr()
+    sinks = [_Sink(f"bench_suite_fan_{i}", auto_start=False) for i in range(100)]
+    results = {}
+    for subs_cnt in (1, 10, 100):
+        subs_mgr.reset()
+        for sink in sinks[:subs_cnt]:
+            subs_mgr.add_subscription("bench/fanout", sink.name, "noop")
+        start = time.perf_counter()
+        for i in range(publishes):
+            subs_mgr._publish("bench/fanout", i)
+        elapsed = time.perf_counter() - start
+        for sink in sinks[:subs_cnt]:
+            _drain(sink.q)
+        results[f"{subs_cnt}_subs.publish_us"] = (elapsed / publishes * 1e6, "us", LOWER)
+        results[f"{subs_cnt}_subs.delivery_ns"] = (elapsed / publishes / subs_cnt * 1e9, "ns", LOWER)
+    subs_mgr.stop()
+    return results
+
+
+def bench_scheduler(quick):
+    """SchedMgr per-tick cost at scale (bench_scheduler) and timer accuracy of a periodic item"""
+    sizes = (10, 1000, 10000) if quick else scheduler_ticks.SIZES
+    results = {}
+    for size, (idle_us, due_us, flush_ms) in scheduler_ticks.bench_sizes(sizes, ticks=500 if quick else 2000).items():
+        results[f"{size}_items.idle_tick_us"] = (idle_us, "us", LOWER)
+        results[f"{size}_items.due_tick_us"] = (due_us, "us", LOWER)
+        results[f"{size}_items.flush_ms"] = (flush_ms, "ms", LOWER)
+    # Timer accuracy: a 5 ms periodic item among 1000 parked items
+    sink = _Sink("bench_suite_timer")
+    sched = SchedMgr()
+    for i in range(1000):
+        sched.schedule("bench_suite", f"parked_{i}", 3600 + i * 0.001, 0, sink.name, "noop")
+    ticks = 100 if quick else 400
+    sched.schedule("bench_suite", "timer", 0.005, ticks, sink.name, "noop")
+    time.sleep(ticks * 0.005 + 0.2)
+    stats = sched.get_stats("bench_suite", "timer")
+    sched.stop()
+    sink.stop()
+    results["timer.lateness_mean_ms"] = (stats["lateness"]["mean_ms"], "ms", LOWER)
+    results["timer.lateness_max_ms"] = (stats["lateness"]["max_ms"], "ms", LOWER)
+    results["timer.jitter_mean_ms"] = (stats["jitter"]["mean_ms"], "ms", LOWER)
+    return results
+
+
+def bench_logger(quick):
+    """AppLogger messages/sec, sync and async.  Async is timed until exit() has written every message.
+    Standard output is discarded while the logger prints."""
+    messages = 5000 if quick else 50000
+    results = {}
+    with tempfile.TemporaryDirectory() as log_dir, open(os.devnull, "w") as devnull:
+        for label, async_mode, log_format in (("sync_text", False, LOG_FORMAT_TEXT),
+                                              ("async_text", True, LOG_FORMAT_TEXT),
+                                              ("async_jsonl", True, LOG_FORMAT_JSONL)):
+            with contextlib.redirect_stdout(devnull):
+                logger = AppLogger(log_dir, f"bench_{label}", async_mode=async_mode, log_format=log_format,
+                                   buffer_size=messages + 1)
+                start = time.perf_counter()
+                for i in range(messages):
+                    logger.log_record("bench", 1, "Logged message")
+                caller = time.perf_counter() - start
+                logger.exit()
+                total = time.perf_counter() - start
+            results[f"{label}.msgs_s"] = (messages / total, "msgs/s", HIGHER)
+            if async_mode:
+                results[f"{label}.caller_ns"] = (caller / messages * 1e9, "ns", LOWER)
+    return results
+
+
+def bench_lifecycle(quick):
+    """Actor startup (construct and start its thread) and shutdown (stop and join) time"""
+    actor_cnt = 50 if quick else 200
+    start = time.perf_counter()
+    actors = [_Sink(f"bench_suite_life_{i}") for i in range(actor_cnt)]
+    startup = time.perf_counter() - start
+    start = time.perf_counter()
+    for actor in actors:
+        actor.stop()
+    shutdown = time.perf_counter() - start
+    with App.lock:
+        for actor in actors:
+            App.queues.pop(actor.name, None)
+    return {"startup_us": (startup / actor_cnt * 1e6, "us", LOWER),
+            "shutdown_us": (shutdown / actor_cnt * 1e6, "us", LOWER)}
+
+
+def bench_dispatch(quick):
+    """Batched dispatch throughput (bench_batch_dispatch)"""
+    messages = 20000 if quick else batch_dispatch.MESSAGES
+    return {f"batch_{batch_size}.msgs_s": (batch_dispatch.bench(batch_size, True, messages), "msgs/s", HIGHER)
+            for batch_size in (1, 64)}
+
+
+def bench_topics(quick):
+    """Wildcard topic matching (bench_topics)"""
+    subs_mgr = SubsriptionMgr()
+    topics = topic_matching._topics()
+    results = {}
+    for wildcard_cnt in (100, 1000) if quick else (100, 1000, 10000):
+        cold, warm, _ = topic_matching.bench(subs_mgr, wildcard_cnt, topics)
+        results[f"{wildcard_cnt}_wildcards.cold_us"] = (cold, "us", LOWER)
+        results[f"{wildcard_cnt}_wildcards.warm_us"] = (warm, "us", LOWER)
+    subs_mgr.stop()
+    return results
+
+
+def bench_metrics(quick):
+    """Dispatch cost without and with runtime metrics (bench_metrics)"""
+    metrics = MetricsMgr()
+    plain = Actor("bench_suite_metrics_off", auto_start=False)
+    App.metrics = metrics
+    try:
+        measured = Actor("bench_suite_metrics_on", auto_start=False)
+    finally:
+        App.metrics = None
+    messages = 5000 if quick else metrics_overhead.MESSAGES
+    off, on = [], []
+    for _ in range(10):  # Interleaved to share the machine's noise
+        off.append(metrics_overhead.bench(plain, messages))
+        on.append(metrics_overhead.bench(measured, messages))
+    off, on = min(off), min(on)
+    metrics.stop()
+    return {"off_ns": (off, "ns", LOWER), "on_ns": (on, "ns", LOWER)}
+
+
+def bench_recorder(quick):
+    """Cost of message recording: put + get with and without the recorder, and writer time per message"""
+    messages = 10000 if quick else 100000
+    q = App.create_queue("bench_suite_recorder")
+    item = ("receive_data", ("TOPIC", {"value": 1.0, "samples": [1.0] * 10}), {})
+
+    def put_get_ns():
+        start = time.perf_counter()
+        for _ in range(messages):
+            q.put(item)
+            q.get()
+        return (time.perf_counter() - start) / messages * 1e9
+
+    off = put_get_ns()
+    with tempfile.TemporaryDirectory() as record_dir:
+        recorder = MessageRecorder(record_dir, flush_interval_s=3600, buffer_size=messages)
+        recorder.start()
+        on = put_get_ns()
+        start = time.perf_counter()
+        recorder.stop()  # Writes the whole buffer
+        write_ns = (time.perf_counter() - start) / messages * 1e9
+    with App.lock:
+        App.queues.pop(q.name, None)
+    return {"off_ns": (off, "ns", LOWER), "on_ns": (on, "ns", LOWER), "write_ns": (write_ns, "ns", LOWER)}
+
+
+def bench_network(quick):
+    """Network transport over TCP loopback (bench_network)"""
+    messages, queries = (10000, 200) if quick else (network_loopback.MESSAGES, network_loopback.QUERIES)
+    rate, round_trip, _ = network_loopback.bench("tcp://127.0.0.1:0", messages, queries)
+    return {"tcp.msgs_s": (rate, "msgs/s", HIGHER),
+            "tcp.query_p50_us": (round_trip.summary()["p50"] / 1e3, "us", LOWER)}
+
+
+BENCHMARKS = {"actor": bench_actor, "fanout": bench_fanout, "scheduler": bench_scheduler, "logger": bench_logger,
+              "lifecycle": bench_lifecycle, "dispatch": bench_dispatch, "topics": bench_topics,
+              "metrics": bench_metrics, "recorder": bench_recorder, "network": bench_network}
+
+
+#### Running and comparing
+def _best(values, better):
+    return max(values) if better == HIGHER else min(values)
+
+
+def run(names=None, quick=False, repeat=3, progress=None):
+    """Run the benchmarks (all by default) and return the results as a JSON-able dict"""
+    names = list(names or BENCHMARKS)
+    metrics = {}
+    for name in names:
+        if progress is not None:
+            progress(name)
+        runs = [BENCHMARKS[name](quick) for _ in range(repeat)]
+        for metric, (_, unit, better) in runs[0].items():
+            value = _best([result[metric][0] for result in runs if metric in result], better)
+            metrics[f"{name}.{metric}"] = {"value": value, "unit": unit, "better": better}
+    return {"time": time.strftime("%Y-%m-%dT%H:%M:%S"), "quick": quick, "repeat": repeat,
+            "python": sys.version.split()[0], "platform": platform.platform(), "cpu_count": os.cpu_count(),
+            "threads": threading.active_count(), "benchmarks": names, "metrics": metrics}
+
+
+def threshold_for(metric, thresholds, default_pct=DEFAULT_THRESHOLD_PCT):
+    """Return the regression threshold (%) of a metric.  thresholds maps metric names or fnmatch patterns
+    (e.g. "actor.latency_*") to a percentage.  An exact name wins over patterns, then the longest pattern."""
+    if metric in thresholds:
+        return thresholds[metric]
+    matches = [pattern for pattern in thresholds if fnmatch.fnmatchcase(metric, pattern)]
+    return thresholds[max(matches, key=len)] if matches else default_pct
+
+
+def compare(results, baseline, thresholds=None, default_pct=DEFAULT_THRESHOLD_PCT):
+    """Compare results with a baseline.  Returns a list of rows
+    (metric, baseline value, value, change %, threshold %, status), status being "ok", "regression",
+    "improvement", "new" or "missing" (from a benchmark that was run).  A change is a regression or an improvement past its threshold.
+    The baseline's own "thresholds" are used, updated by thresholds."""
+    merged = dict(baseline.get("thresholds", {}))
+    merged.update(thresholds or {})
+    rows = []
+    base_metrics = baseline.get("metrics", {})
+    for metric, current in results["metrics"].items():
+        pct = threshold_for(metric, merged, default_pct)
+        base = base_metrics.get(metric)
+        if base is None:
+            rows.append((metric, None, current["value"], None, pct, "new"))
+            continue
+        if base["value"] == 0:
+            change = 0.0 if current["value"] == 0 else float("inf")
+        else:
+            change = (current["value"] / base["value"] - 1) * 100
+        worse = change if current["better"] == LOWER else -change
+        status = "regression" if worse > pct else "improvement" if worse < -pct else "ok"
+        rows.append((metric, base["value"], current["value"], change, pct, status))
+    run_names = set(results.get("benchmarks", ()))
+    for metric, base in base_metrics.items():
+        if metric not in results["metrics"] and metric.split(".", 1)[0] in run_names:
+            rows.append((metric, base["value"], None, None, threshold_for(metric, merged, default_pct), "missing"))
+    return rows
+
+
+def format_results(results):
+    lines = [f"{'metric':<40} {'value':>14} unit"]
+    for metric, current in results["metrics"].items():
+        lines.append(f"{metric:<40} {current['value']:>14.3f} {current['unit']}")
+    return "\n".join(lines)
+
+
+def format_comparison(rows):
+    lines = [f"{'metric':<40} {'baseline':>14} {'value':>14} {'change':>9} {'limit':>7}  status"]
+    for metric, base, value, change, pct, status in rows:
+        base_s = f"{base:>14.3f}" if base is not None else f"{'-':>14}"
+        value_s = f"{value:>14.3f}" if value is not None else f"{'-':>14}"
+        change_s = f"{change:>+8.1f}%" if change is not None else f"{'-':>9}"
+        lines.append(f"{metric:<40} {base_s} {value_s} {change_s} {pct:>6.0f}%  {status}")
+    return "\n".join(lines)
+
+
+def load_json(path):
+    with open(path) as f:
+        return json.load(f)
+
+
+def save_json(path, data):
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    with open(path, "w") as f:
+        json.dump(data, f, indent=2)
@@ -1,5 +1,7 @@
 from .globals import App
 from .app_manager import AppMgr
-from .actor import Actor
+from .actor import Actor, task
+from .process_actor import ProcessActor
+from .async_actor import AsyncActor
 
 
@@ -1,6 +1,75 @@
+import collections
+import concurrent.futures
+import inspect
 import threading
+import time
 import queue
 from .globals import App
+from .mailbox import Mailbox, SampledItem, get_batch, task_done_batch
+from .profiler import ActorProfiler
+from .rpc import QueryError, ReplyChannel
+
+try:
+    import contextvars
+except ImportError:  # Python 3.6
+    contextvars = None
+
+
+def task(method):
+    """Decorator marking a method as a task.  Only needed in classes with explicit_tasks = True."""
+    method._is_task = True
+    return method
+
+
+# Public methods that are not tasks: they can't be enqueued by name
+NOT_TASKS = ("task_order_key",)
+# Tasks the framework sends to every actor.  Subclasses can't define methods with these names.
+RESERVED_TASKS = ("receive_publications",)
+
+
+class _ThreadActor(threading.local):
+    """Stands in for the current_actor ContextVar on Python 3.6.  Per thread, so it is not kept across the awaits of
+    a coroutine task."""
+    value = None
+
+    def get(self):
+        return self.value
+
+    def set(self, value):
+        token, self.value = self.value, value
+        return token
+
+    def reset(self, token):
+        self.value = token
+
+
+# Name of the actor whose task is running, or None.  Only set while App.recorder is set: it is the source of the
+# recorded messages, whichever thread or event loop performs the task.
+current_actor = contextvars.ContextVar("current_actor", default=None) if contextvars is not None else _ThreadActor()
+
+
+def _is_marked(attr):
+    func = attr.__func__ if isinstance(attr, (staticmethod, classmethod)) else attr
+    return getattr(func, "_is_task", False)
+
+
+def _build_task_table(cls):
+    """Return {task name: function or descriptor} of the methods that can be enqueued as tasks on cls"""
+    table = {}
+    # With explicit_tasks, an override of a @task method stays a task.  The rest of the base API does not.
+    inherited = {name for base in cls.__bases__ for name, attr in getattr(base, "_task_table", {}).items()
+                 if _is_marked(attr)}
+    for name in dir(cls):
+        if name.startswith("_") or name in NOT_TASKS:
+            continue
+        attr = inspect.getattr_static(cls, name)
+        func = attr.__func__ if isinstance(attr, (staticmethod, classmethod)) else attr
+        if not callable(func) or isinstance(func, type):
+            continue  # Properties, data and nested classes
+        if cls.explicit_tasks and name not in inherited and not _is_marked(attr):
+            continue
+        table[name] = attr
+    return table
 
 
 class Actor:
@@ -11,61 +80,205 @@ class Actor:
         When run method is called it launches an autonomous thread the dequeues task items.
             Dequeued items will call a method to process them.
         When the 'exit' task is received, the dequeue loop will close.
+        Pooled mode (workers > 1):
+            Several worker threads dequeue from the same queue, so tasks run in parallel.
+            Tasks for which task_order_key returns the same key still run one at a time, in enqueue order.
+        Shared executor mode (executor=<ActorExecutor>):
+            The actor has no thread of its own.  Its tasks run on the executor's shared threads (see executor.py).
+        Bounded mailbox (mailbox={"maxsize": ..., "policy": ..., ...} or App.cfg["mailbox"]):
+            The queue is a Mailbox with a capacity, an overflow policy and backlog watermarks (see mailbox.py).
+            enqueue/send_data return False if the item was dropped or rejected.
+        Priority lanes:
+            exit, set_log_level, set_profiling and the stop sentinel are delivered ahead of queued data.
+            stop() returns once the tasks being run are done, in single thread and pooled mode alike.  The
+            tasks still queued are not run.  reset keeps its place in the queue and acts on what was queued
+            before it.
+            enqueue_priority(q_name, PRIORITY_HIGH, ...) puts a task ahead of normal tasks.
+        Batched dequeue (batch_size > 1, single thread mode):
+            Each wakeup takes up to batch_size queued items at once.
+            A run of consecutive items for a task listed in batch_handlers is passed to its batch handler
+            in one call, as a list of (args, kwargs).
+                e.g. batch_handlers = {"receive_data": "receive_data_batch"}
+        Queries (request/response):
+            query() sends a task with a return_q and returns a QueryFuture at once, so many queries can be
+            pending.  The reply is what the task puts on return_q, or its return value.  See rpc.py.
+        Task dispatch:
+            Each class has a dispatch table of the methods that can be enqueued by name, built once when the
+            class is defined.  By default it holds every public method.  With explicit_tasks = True, only the
+            methods decorated with @task are in it, with the framework tasks of Actor (e.g. exit, reset,
+            receive_data) and their overrides.  The rest of the Actor API (publish, enqueue, stop...) is not.
+            RESERVED_TASKS (receive_publications) are sent by the framework and can't be redefined.
+        Profiling (opt-in, see profiler.py):
+            set_profiling(sample_rate, slow_threshold_s) runs a fraction of the tasks under cProfile and samples
+            the stack of any task running past the threshold.  It is a control task, so it can be toggled at
+            runtime (App.update_profiling) or set at start with App.cfg["profiling"] = {name: {...}}.
+            Results are written to App.cfg["results_dir"]/profiles/<name>/ by dump_profile, when profiling
+            is turned off and on exit.
     """
+    batch_handlers = {}  # key = task name, value = name of the method that takes a list of (args, kwargs)
+    explicit_tasks = False  # True: only @task methods can be enqueued by name
+    _task_table = {}  # key = task name, value = function.  Built per class by __init_subclass__.
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        for name in RESERVED_TASKS:
+            if name in cls.__dict__:
+                raise TypeError(f"{cls.__name__}.{name}: {name} is a reserved task name")
+        cls._task_table = _build_task_table(cls)
+
 
     #### Initialize
-    def __init__(self, name: str, log_level=0, auto_start=True):
+    def __init__(self, name: str, log_level=0, auto_start=True, workers=1, executor=None, batch_size=None,
+                 mailbox=None):
         self.name = name
         self.log_level = log_level
         self.cfg = App.cfg
-        self.q = App.create_queue(self.name)
+        self.executor = executor
+        self.q = self._create_queue(mailbox if mailbox is not None else {})  # See Mailbox and App.mailbox_options
         self._running = False
         self.received_data = {}
         self._stop_flag = False
+        self.workers = workers
+        self.batch_size = batch_size if batch_size is not None else App.cfg.get("actor_batch_size", 1)
         self.task_monitor_thread = None
+        self.task_monitor_threads = []
+        self._running_cnt = 0
+        self._get_lock = threading.Lock()  # Pooled mode: dequeue and claim an order key as one step (never blocks)
+        self._key_lock = threading.Lock()
+        self._key_pending = {}  # Pooled mode: key = order key being run, value = deque of tasks waiting on it
         self.lock = threading.RLock()
-        self.callable_task_list = [
-            attr for attr in dir(self)
-            if callable(getattr(self, attr)) and not attr.startswith("_")
-            ]
+        self.replies = ReplyChannel(self.name)  # Pending queries made by this actor
+        self._metrics = App.metrics.register(self) if App.metrics is not None else None
+        self._busy = App.watchdog.register(self) if App.watchdog is not None else None  # Running tasks
+        self._done_cnt = 0  # Watched actors: tasks completed (heartbeat)
+        self._profiler = None
+        profiling = App.cfg.get("profiling", {}).get(self.name)
+        if profiling:
+            self.set_profiling(**profiling)
         if auto_start:
             self.run()
 
+    def _create_queue(self, mailbox_options):
+        """Create this actor's queue and add it to App.queues.  Subclasses with another kind of queue override it."""
+        if self.executor is not None:
+            q = self.executor.create_queue(self, **App.mailbox_options(self.name, **mailbox_options))
+            App.add_queue(self.name, q)
+            return q
+        return App.create_queue(self.name, **mailbox_options)
+
     #### Default methods of queued state machines
+    @task
     def set_log_level(self, level: int):
         """Update the verbose level of logging event messages for this module."""
         self.log_level = level
 
-    def log(self, msg, level=0):
-        """This method writes messages to the command window and also to a log file"""
+    @task
+    def set_profiling(self, sample_rate=0.0, slow_threshold_s=None):
+        """Profile a fraction (0.0 to 1.0) of this actor's tasks and capture the tasks slower than slow_threshold_s.
+        With the defaults, profiling is turned off and the results so far are written."""
+        if not sample_rate and slow_threshold_s is None:
+            if self._profiler is not None:
+                self.dump_profile()
+                self._profiler = None
+        elif self._profiler is None:
+            self._profiler = ActorProfiler(self.name, sample_rate, slow_threshold_s)
+        else:
+            self._profiler.configure(sample_rate, slow_threshold_s)
+
+    @task
+    def dump_profile(self):
+        """Write the profiling results of this actor to App.cfg["results_dir"]"""
+        if self._profiler is not None:
+            profile_dir = self._profiler.write()
+            if profile_dir is not None:
+                self.log(f"Profile written to {profile_dir}", 1)
+
+    def log_enabled(self, level):
+        """Return True if messages at this level are logged.  Use it to guard costly log-only work."""
+        return level <= self.log_level
+
+    def log(self, msg, level=0, *args):
+        """This method writes messages to the command window and also to a log file
+        Any args are merged into msg with %-formatting, only if the level is enabled.
+        Trace messages therefore cost nothing to format (e.g. repr of large data) while tracing is off."""
         if level <= self.log_level:
+            if args:
+                msg = msg % args
             # Log to File
             if hasattr(App, 'logger') and App.logger is not None:
-                App.logger.log(f"{self.name} {msg}")
+                if hasattr(App.logger, 'log_record'):
+                    App.logger.log_record(self.name, level, msg)
+                else:
+                    App.logger.log(f"{self.name} {msg}")
             else:
                 # Write to cmd window
                 print(self.name + " " + msg)
 
     ### Subscriptions
-    def subscribe(self, topic: str, callback_method, attributes=None, subs_id=None):
-        """This method will subscribe to data"""
+    def subscribe(self, topic: str, callback_method, attributes=None, subs_id=None, conflate=False,
+                  max_rate_hz=None, every_nth=None, aggregate="last"):
+        """This method will subscribe to data.  The topic may use + and # wildcards (e.g. rack1/+/voltage).
+        conflate=True: at most one delivery of the topic waits in this actor's mailbox.  A newer publish replaces
+        its data, so a lagging actor only processes the latest value.
+        max_rate_hz / every_nth: receive at most max_rate_hz deliveries per second / one of every n publishes.
+        aggregate: "last", "minmax" or "mean" of the samples since the previous delivery.
+        A <node>:<topic> subscribes to the topic on another node (see network.py)."""
 
-        if hasattr(App, 'subs_mgr'):
-            self.log(f"Subscribe topic={topic} dest_q={self.name} task_method={callback_method}", 5)
-            App.subs_mgr.add_subscription(topic, self.name, callback_method, attributes=attributes, subs_id=subs_id)
+        network = App.network
+        if network is not None and network.is_remote(topic):  # <node>:<topic>
+            self.log("Subscribe remote topic=%s dest_q=%s task_method=%s", 5, topic, self.name, callback_method)
+            if callable(callback_method):
+                callback_method = callback_method.__name__  # Sent by name
+            network.subscribe_remote(topic, self.name, callback_method, attributes=attributes, subs_id=subs_id,
+                                     conflate=conflate, max_rate_hz=max_rate_hz, every_nth=every_nth,
+                                     aggregate=aggregate)
+        elif hasattr(App, 'subs_mgr'):
+            self.log("Subscribe topic=%s dest_q=%s task_method=%s", 5, topic, self.name, callback_method)
+            App.subs_mgr.add_subscription(topic, self.name, callback_method, attributes=attributes, subs_id=subs_id,
+                                          conflate=conflate, max_rate_hz=max_rate_hz, every_nth=every_nth,
+                                          aggregate=aggregate)
 
     def publish(self, topic: str, data):
-        """This method will publish data"""
-        if hasattr(App, 'subs_mgr'):
-            self.log("published topic " + topic, 5)
+        """This method will publish data.  A <node>:<topic> is published on that node (see network.py)."""
+        network = App.network
+        if network is not None and network.is_remote(topic):
+            self.log("published remote topic %s", 5, topic)
+            network.publish_remote(topic, data)
+        elif hasattr(App, 'subs_mgr'):
+            self.log("published topic %s", 5, topic)
             App.subs_mgr._publish(topic, data)
 
+    def publish_shared(self, topic: str, data):
+        """This method will publish a large bytes-like payload (e.g. a waveform array) through shared memory.
+        Subscribers receive a small ShmHandle instead of the data, also in other processes.  See shm_ring.
+        Raises NotImplementedError where shared memory is not supported (Python < 3.8)."""
+        from .shm_ring import share
+        self.publish(topic, share(topic, data))
+
+    def publish_many(self, data_by_topic: dict):
+        """This method will publish several topics at once ({topic: data}).
+        Each subscriber gets one message with all its deliveries (see receive_publications)."""
+        if hasattr(App, 'subs_mgr'):
+            self.log("published topics %s", 5, list(data_by_topic))
+            App.subs_mgr._publish_many(data_by_topic)
+
     def run(self):
-        """This method launches the dequeue loop in an autonomous thread"""
+        """This method launches the dequeue loop in an autonomous thread (one per worker in pooled mode)"""
         self.log("Task Monitor Run Initiated", 5)
-        if not self._running:
-            self.task_monitor_thread = threading.Thread(target=self._task_queue_thread, args=(), daemon=True)
-            self.task_monitor_thread.start()
+        if self.executor is not None:
+            self._stop_flag = False
+            self._running = True
+            self.executor.notify(self)  # Run any tasks queued before the start
+        elif not self._running:
+            self._running = True
+            self._stop_flag = False
+            self._running_cnt = self.workers
+            target = self._task_queue_thread if self.workers == 1 else self._pool_worker_thread
+            self.task_monitor_threads = [threading.Thread(target=target, args=(), name=self.name, daemon=True)
+                                         for _ in range(self.workers)]
+            self.task_monitor_thread = self.task_monitor_threads[0]
+            for thread in self.task_monitor_threads:
+                thread.start()
         else:
             self.log("Can't run Task Monitor thread.  It is already running.", 5)
 
@@ -74,29 +287,185 @@ class Actor:
         self.log("Task Monitor Running", 5)
         self._running = True
         self._stop_flag = False
-        while not self._stop_flag:
-            task_data = self.q.get()
-            if task_data is None:
-                self._stop_flag = True
-            else:
-                is_error = False
-                task, args, kwargs = task_data
-                self.log(f"Dequeue task={task}, args={args}, kwargs={kwargs}", 5)
-                task_method = task
-                if type(task) == str:
-                    if task in self.callable_task_list:
-                        task_method = getattr(self, task)
-                    else:
-                        is_error = True
-                        self.log(f"ERROR: Dequeued invalid task: {task}")
-                if not is_error:
-                    try:
-                        task_method(*args, **kwargs)
-                    except Exception as e:
-                        self.log(f"ERROR: Exception performing task {task_data}: {e}")
-            self.q.task_done()
+        if self.batch_size > 1:
+            while not self._stop_flag:
+                batch = get_batch(self.q, self.batch_size)
+                self._dispatch_batch(batch)
+                task_done_batch(self.q, len(batch))
+        else:
+            while not self._stop_flag:
+                task_data = self.q.get()
+                if task_data is None:
+                    self._stop_flag = True
+                else:
+                    self._dispatch(task_data)
+                self.q.task_done()
         self._running = False
 
+    def _pool_worker_thread(self):
+        """Pooled mode worker.  Loops processing enqueued tasks until it dequeues a None.
+        stop() puts one None per worker in the control lane, so each worker stops after its current task."""
+        self.log("Task Monitor Worker Running", 5)
+        q = self.q
+        while True:
+            with q.not_empty:  # Idle workers wait on the queue, not on _get_lock
+                q.not_empty.wait_for(q._qsize)
+            key = None
+            with self._get_lock:
+                try:
+                    task_data = q.get_nowait()
+                except queue.Empty:
+                    continue  # Taken by another worker
+                if task_data is None:
+                    q.task_done()
+                    break
+                try:
+                    key = self.task_order_key(*task_data)
+                except Exception as e:
+                    self.log(f"ERROR: Exception getting order key of task {task_data}: {e}")
+                if key is not None:
+                    with self._key_lock:
+                        if key in self._key_pending:
+                            # Another worker is running this key.  It will run this task when done.
+                            self._key_pending[key].append(task_data)
+                            continue
+                        self._key_pending[key] = collections.deque()
+            while task_data is not None:
+                self._dispatch(task_data)
+                q.task_done()
+                task_data = None
+                if key is not None:
+                    with self._key_lock:
+                        pending = self._key_pending[key]
+                        if pending and not self._stop_flag:
+                            task_data = pending.popleft()
+                        else:
+                            del self._key_pending[key]
+                            for _ in pending:  # Not run: the actor was stopped
+                                q.task_done()
+        with self._key_lock:
+            self._running_cnt -= 1
+            if self._running_cnt <= 0:
+                self._running = False
+
+    def _dispatch(self, task_data):
+        """Perform one dequeued task"""
+        task, args, kwargs = task_data
+        self.log("Dequeue task=%s, args=%s, kwargs=%s", 5, task, args, kwargs)
+        try:
+            task_method = self._resolve_task(task)
+        except Exception as e:
+            self.log(f"ERROR: Exception resolving task {task_data}: {e}")
+            self._deliver_reply(kwargs, None, e)
+            return
+        if task_method is not None:
+            state = self._begin_task(task_data) if self._hooked(task_data) else None
+            try:
+                result = task_method(*args, **kwargs)
+            except Exception as e:
+                self.log(f"ERROR: Exception performing task {task_data}: {e}")
+                self._deliver_reply(kwargs, None, e)
+            else:
+                if result is not None:
+                    self._deliver_reply(kwargs, result)
+            if state is not None:
+                self._end_task(task_data, state)
+
+    def _hooked(self, task_data):
+        """Return True if the task needs the bookkeeping of _begin_task and _end_task"""
+        return (self._profiler is not None or self._busy is not None or type(task_data) is SampledItem
+                or App.recorder is not None)
+
+    def _begin_task(self, task_data):
+        """Start the bookkeeping of a task about to run: service time of a sampled task (metrics), profiling,
+        watchdog and current_actor (recorder).  Returns the state to pass to _end_task.  Shared by the dispatch of
+        every kind of actor."""
+        task = task_data[0]
+        start = time.perf_counter() if self._metrics is not None and type(task_data) is SampledItem else None
+        profiler = self._profiler
+        running = profiler.begin(task) if profiler is not None else None
+        busy = self._busy
+        ident = outer = None
+        if busy is not None:
+            ident = threading.get_ident()
+            outer = busy.get(ident)  # Set while performing the deliveries of receive_publications
+            busy[ident] = (task, time.monotonic())
+        token = current_actor.set(self.name) if App.recorder is not None else None
+        return start, profiler, running, busy, ident, outer, token
+
+    def _end_task(self, task_data, state):
+        start, profiler, running, busy, ident, outer, token = state
+        if token is not None:
+            current_actor.reset(token)
+        if busy is not None:
+            self._done_cnt += 1
+            if outer is None:
+                del busy[ident]
+            else:
+                busy[ident] = outer
+        if profiler is not None:
+            profiler.end(running, task_data)
+        if start is not None:
+            self._metrics.record_task(task_data[0], int((time.perf_counter() - start) * 1e9))
+
+    def _deliver_reply(self, kwargs, result, exc=None):
+        """Resolve the query a task was sent with (see query) with the task's return value or exception.
+        A task may also reply explicitly with return_q.put(value).  The first reply wins."""
+        return_q = kwargs.get("return_q")
+        set_exception = getattr(return_q, "set_exception", None)  # Plain queues are only replied to explicitly
+        if set_exception is not None:
+            if exc is not None:
+                set_exception(exc)
+            else:
+                return_q.put(result)
+
+    def _dispatch_batch(self, batch):
+        """Perform a list of dequeued tasks in order.  Consecutive tasks with a batch handler are grouped."""
+        i = 0
+        while i < len(batch):
+            task_data = batch[i]
+            if task_data is None:  # Always last (see get_batch)
+                self._stop_flag = True
+                return
+            task = task_data[0]
+            handler_name = self.batch_handlers.get(task) if type(task) == str else None
+            if handler_name is None:
+                self._dispatch(task_data)
+                i += 1
+                continue
+            calls = []
+            while i < len(batch) and batch[i] is not None and batch[i][0] == task:
+                calls.append((batch[i][1], batch[i][2]))
+                i += 1
+            self.log("Dequeue batch task=%s, cnt=%s", 5, task, len(calls))
+            try:
+                getattr(self, handler_name)(calls)
+            except Exception as e:
+                self.log(f"ERROR: Exception performing batch task {task} ({len(calls)} calls): {e}")
+
+    def _resolve_task(self, task):
+        """Return the method for a dequeued task (a task name or a callable), or None if it is invalid"""
+        if type(task) == str:
+            func = self._task_table.get(task)
+            if func is not None:
+                get = getattr(type(func), "__get__", None)  # e.g. functools.partial has none
+                return func if get is None else get(func, self, type(self))
+            self.log(f"ERROR: Dequeued invalid task: {task}")
+            return None
+        return task
+
+    @property
+    def callable_task_list(self):
+        """Names of the tasks that can be enqueued on this actor (read only, see _task_table)"""
+        return list(self._task_table)
+
+    def task_order_key(self, task, args, kwargs):
+        """Pooled mode: return the ordering key of an enqueued task, or None if it can run in any order.
+        Tasks with the same key are never run at the same time and run in enqueue order.
+        Override this method, e.g. return args[0] to serialize the reads of each instrument channel."""
+        return None
+
+    @task
     def flush_received_data(self, topic=None):
         if topic is None: # FLush all data
             self.received_data = {}
@@ -104,80 +473,186 @@ class Actor:
             if topic in self.received_data:
                 del self.received_data[topic]
 
+    @task
     def receive_data(self, topic, data):
-        self.log(f"Receive Data topic={topic}, data={data}", 5)
+        self.log("Receive Data topic=%s, data=%s", 5, topic, data)
         self.received_data[topic] = data
 
+    def receive_data_batch(self, calls):
+        """Batch handler for receive_data.  Opt in with batch_handlers = {"receive_data": "receive_data_batch"}"""
+        self.log("Receive Data batch cnt=%s", 5, len(calls))
+        for args, kwargs in calls:
+            topic, data = args
+            self.received_data[topic] = data
+
+    @task
+    def receive_publications(self, deliveries):
+        """Perform the deliveries of a publish_many.  Each is (task_method, topic, attributes, data)."""
+        for task_method, topic, attributes, data in deliveries:
+            self._dispatch((task_method, (topic, attributes, data), {}))
+
     def enqueue_local(self,task_method, *args, **kwargs):
         self.q.put((task_method, args, kwargs))
 
     def send_data(self, q_name, topic, data):
-        self.log(f"Send Data dest={q_name}, topic={topic}, data={data}" , 5)
+        """Send data to another actor.  Returns False if it could not be queued."""
+        self.log("Send Data dest=%s, topic=%s, data=%s", 5, q_name, topic, data)
         dest_q = App.get_queue(q_name)
         if dest_q is not None:
-            dest_q.put(("data_input", (topic,data), {}))
+            return self._put(dest_q, q_name, ("data_input", (topic,data), {}))
         else:
             self.log(f"ERROR: dest_q does not exist.  Send Data dest={q_name}", 0)
+        return False
 
     def enqueue(self,q_name, task_method, *args, **kwargs):
-        self.log(f"Enqueue dest={q_name} task={task_method} args={args}", 5)
+        """Enqueue a task to another actor.  Returns False if it could not be queued."""
+        self.log("Enqueue dest=%s task=%s args=%s", 5, q_name, task_method, args)
         dest_q = App.get_queue(q_name)
         if dest_q is not None:
-            dest_q.put((task_method, args, kwargs))
+            return self._put(dest_q, q_name, (task_method, args, kwargs))
         else:
             self.log(f"ERROR: dest_q does not exist.  Enqueue dest={q_name} task={task_method} args={args}", 0)
+        return False
 
-    def task_query(self, q_name, task_method, timeout, *args, **kwargs):
-        data = None
-        rtn_code = 0
-        self.log(f"Query dest={q_name} task={task_method} args={args}", 5)
+    def enqueue_priority(self, q_name, priority, task_method, *args, **kwargs):
+        """Enqueue a task in a priority lane of another actor's mailbox (mailbox.PRIORITY_HIGH/PRIORITY_NORMAL).
+        Returns False if it could not be queued."""
+        self.log("Enqueue dest=%s priority=%s task=%s args=%s", 5, q_name, priority, task_method, args)
         dest_q = App.get_queue(q_name)
         if dest_q is not None:
-            rtn_q = queue.Queue()
-            kwargs.update({"return_q":rtn_q})
-            dest_q.put((task_method, args, kwargs))
-            try:
-                rtn_q.get(timeout=timeout)
-            except queue.Empty:
-                self.log(f"ERROR: Query timeout. Dest={q_name} task={task_method} args={args}", 0)
-                rtn_code = -1
+            return self._put(dest_q, q_name, (task_method, args, kwargs), priority)
+        else:
+            self.log(f"ERROR: dest_q does not exist.  Enqueue dest={q_name} task={task_method} args={args}", 0)
+        return False
+
+    def enqueue_conflated(self, q_name, key, task_method, *args, **kwargs):
+        """Enqueue a task, or replace the args of the task with the same key still waiting in the mailbox.
+        Returns False if it could not be queued."""
+        self.log("Enqueue conflated dest=%s key=%s task=%s args=%s", 5, q_name, key, task_method, args)
+        dest_q = App.get_queue(q_name)
+        if dest_q is not None:
+            return self._put(dest_q, q_name, (task_method, args, kwargs), key=key)
         else:
-            rtn_code = -1
+            self.log(f"ERROR: dest_q does not exist.  Enqueue dest={q_name} task={task_method} args={args}", 0)
+        return False
+
+    def _put(self, dest_q, q_name, item, priority=None, key=None, block=True):
+        """Put an item on a destination queue.  A full bounded mailbox may drop or reject it.
+        block=False: a full mailbox with the block policy rejects the item at once instead of waiting.
+        Only a Mailbox supports priority and conflation key.  Other queues get a plain put."""
+        try:
+            if isinstance(dest_q, Mailbox):
+                if key is not None:
+                    return dest_q.put_conflated(key, item, block, priority=priority) is not False
+                return dest_q.put(item, block, priority=priority) is not False
+            return dest_q.put(item, block) is not False
+        except queue.Full as e:
+            # Non-blocking senders (scheduler, publishers) count the refusals, so they are only traced
+            self.log(f"ERROR: Enqueue rejected. dest={q_name} task={item[0]}: {e}", 0 if block else 2)
+            return False
+
+    def query(self, q_name, task_method, timeout, *args, **kwargs):
+        """Send a task to another actor and return a QueryFuture for its reply, without waiting.
+        The task receives a return_q kwarg.  It replies with return_q.put(value) or by returning a value.
+        An exception raised by the task is set on the future.
+        timeout (s, or None): the query is cancelled when it expires, and a late reply is discarded.
+        Many queries can be pending at once.  Wait on them with future.result(), rpc.gather or rpc.wait_any."""
+        self.log("Query dest=%s task=%s args=%s", 5, q_name, task_method, args)
+        future, reply = self.replies.open(timeout, q_name)
+        kwargs["return_q"] = reply
+        dest_q = App.get_queue(q_name)
+        if dest_q is None:
             self.log(f"ERROR: dest_q does not exist.  Query dest={q_name} task={task_method} args={args}", 0)
-        return rtn_code, data
+            reply.set_exception(QueryError(f"dest_q {q_name} does not exist"))
+        elif not self._put(dest_q, q_name, (task_method, args, kwargs)):
+            reply.set_exception(QueryError(f"Query to {q_name} was not queued"))
+        return future
+
+    def query_then(self, q_name, task_method, timeout, callback_task, *args, **kwargs):
+        """Non-blocking query.  When the reply arrives, or the query fails or times out, callback_task is
+        enqueued on this actor with the QueryFuture as its argument."""
+        future = self.query(q_name, task_method, timeout, *args, **kwargs)
+        sched_id = None
+        if timeout is not None and not future.done() and App.scheduler is not None:
+            sched_id = f"query_{future.corr_id}"
+            self.sched_local(sched_id, timeout, 1, "cancel_query", future.corr_id)
+
+        def on_done(f):
+            if sched_id is not None:
+                App.scheduler.del_item(self.name, sched_id)  # Scheduled before, so a quick reply removes it too
+            self.enqueue_local(callback_task, f)
+        future.add_done_callback(on_done)
+        return future
+
+    @task
+    def cancel_query(self, corr_id):
+        """Cancel a pending query of this actor.  A late reply is discarded."""
+        self.replies.cancel(corr_id)
+
+    def task_query(self, q_name, task_method, timeout, *args, **kwargs):
+        """Blocking query.  Returns (rtn_code, data): (0, reply), or (-1, None) on timeout or failure."""
+        future = self.query(q_name, task_method, timeout, *args, **kwargs)
+        try:
+            return 0, future.result()
+        except (concurrent.futures.TimeoutError, concurrent.futures.CancelledError):
+            self.log(f"ERROR: Query timeout. Dest={q_name} task={task_method} args={args}", 0)
+        except Exception as e:
+            self.log(f"ERROR: Query failed. Dest={q_name} task={task_method} args={args}: {e}", 0)
+        return -1, None
 
     def sched_local(self,sched_id, interval_s, count, task_method, *args, **kwargs):
+        """Schedule a task of this actor.  sched_policy is a reserved keyword (see SchedMgr.schedule)."""
         App.scheduler.schedule(self.name, sched_id, interval_s, count, self.name, task_method, *args, **kwargs)
 
     def sched(self,sched_id, interval_s, count, dest_q_name, task_method, *args, **kwargs):
-        self.log(f"Schedule Event sched_id={sched_id}, interval={interval_s}, cnt={count}, dest_q={dest_q_name}, task_method={task_method}", 5)
+        """Schedule a task of dest_q_name.  sched_policy is a reserved keyword (see SchedMgr.schedule)."""
+        self.log("Schedule Event sched_id=%s, interval=%s, cnt=%s, dest_q=%s, task_method=%s", 5,
+                 sched_id, interval_s, count, dest_q_name, task_method)
         App.scheduler.schedule(self.name, sched_id, interval_s, count, dest_q_name, task_method, *args, **kwargs)
 
     def sched_del_item(self,sched_id):
-        self.log(f"Schedule Cancel Event sched_id={sched_id}", 5)
+        self.log("Schedule Cancel Event sched_id=%s", 5, sched_id)
         App.scheduler.del_item(self.name, sched_id)
 
+    def sched_get_stats(self, sched_id):
+        """Return the lateness/jitter statistics of an item this actor scheduled (see SchedStats.snapshot)."""
+        return App.scheduler.get_stats(self.name, sched_id)
+
     def stop(self):
         self._stop_flag = True
-        if self._running:
+        if self.executor is not None:
+            self._running = False  # The executor stops running this actor after the current task
+        elif self._running:
             try:
-                self.q.put(None)
-                self.task_monitor_thread.join()
+                for _ in self.task_monitor_threads:
+                    self.q.put(None)
+                for thread in self.task_monitor_threads:
+                    if thread is not threading.current_thread():  # exit() runs on one of them
+                        thread.join()
             except:
                 pass
 
+    @task
     def reset(self, *args, **kwargs):
         """This method resets is actor
         Override this method with logic to handle other items that need to be reset."""
         # Flush any scheduled tasks
         App.scheduler.flush_my_items(self.name)
-        # Empty queue
-        while not self.q.empty():
-            self.q.get()
+        # Empty queue.  get_nowait: in pooled mode another worker may take the last item first.
+        while True:
+            try:
+                self.q.get_nowait()
+            except queue.Empty:
+                break
+            self.q.task_done()
 
+    @task
     def exit(self, *args, **kwargs):
         """Exit this actor - close the running dequeue thread"""
         self.log("Exiting", 1)
+        self.dump_profile()
         self.stop()
         self.log("Exited", 1)
 
+
+Actor._task_table = _build_task_table(Actor)
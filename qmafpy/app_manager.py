@@ -1,8 +1,14 @@
+import os
 from .globals import App
 from .log_manager import AppLogger
 from .config_manager import CfgMgr
 from .subscription import SubsriptionMgr
 from .scheduler import SchedMgr
+from .executor import ActorExecutor
+from .metrics import MetricsMgr
+from .watchdog import Watchdog
+from .recorder import MessageRecorder
+from .network import NetworkNode
 
 class AppMgr:
     #### Configuration Methods ####
@@ -15,12 +21,54 @@ class AppMgr:
     #### Logging Methods ####
     @staticmethod
     def init_logger():  # Can skip this method and use different log manager
-        App.logger = AppLogger(App.cfg["logs_dir"], App.cfg["app_name"])
+        App.logger = AppLogger(App.cfg["logs_dir"], App.cfg["app_name"],
+                               async_mode=App.cfg.get("log_async", False),
+                               flush_interval_s=App.cfg.get("log_flush_interval_s", 0.5),
+                               batch_size=App.cfg.get("log_batch_size", 500),
+                               buffer_size=App.cfg.get("log_buffer_size", 10000),
+                               overflow=App.cfg.get("log_overflow", "block"),
+                               log_format=App.cfg.get("log_format", "text"),
+                               index_every=App.cfg.get("log_index_every", 1000))
         App.logger.log("App Launch")
 
     ### Sched and Subscription
     @staticmethod
     def init_services():  # Can skip this method and use different log manager
+        if App.cfg.get("watchdog_enabled", True):
+            App.watchdog = Watchdog()  # First, so that the services and the actors created next are watched
         App.subs_mgr = SubsriptionMgr()
         App.scheduler = SchedMgr()
+        if App.metrics is not None:
+            App.metrics.start_publishing()  # Deferred by init_metrics until the scheduler exists
 
+    ### Shared executor for actors created with executor=App.executor
+    @staticmethod
+    def init_executor():
+        App.executor = ActorExecutor(workers=App.cfg.get("executor_workers", 4),
+                                     quantum=App.cfg.get("executor_quantum", 50))
+
+    ### Runtime metrics.  Start before init_services and the actors to measure them.
+    @staticmethod
+    def init_metrics():
+        App.metrics = MetricsMgr(publish_interval_s=App.cfg.get("metrics_publish_interval_s"))
+
+    ### Message recording (see recorder.py).  Records the queues created before and after it.
+    @staticmethod
+    def init_recorder():
+        App.recorder = MessageRecorder(App.cfg.get("record_dir", os.path.join(App.cfg["results_dir"], "recordings")),
+                                       file_mb=App.cfg.get("record_file_mb", 64),
+                                       max_files=App.cfg.get("record_max_files", 10),
+                                       flush_interval_s=App.cfg.get("record_flush_interval_s", 0.5),
+                                       buffer_size=App.cfg.get("record_buffer_size", 100000))
+        App.recorder.start()
+
+    ### Network transport, so actors can reach the actors of other nodes as <node>:<actor> (see network.py)
+    @staticmethod
+    def init_network():
+        App.network = NetworkNode(App.cfg["node_name"], listen=App.cfg.get("node_listen"),
+                                  peers=App.cfg.get("node_peers", {}), auth_key=App.cfg.get("net_auth_key"),
+                                  pool_size=App.cfg.get("net_pool_size", 1),
+                                  max_batch=App.cfg.get("net_max_batch", 1000),
+                                  linger_s=App.cfg.get("net_linger_s", 0.0005),
+                                  max_pending=App.cfg.get("net_max_pending", 100000),
+                                  reconnect_max_s=App.cfg.get("net_reconnect_max_s", 5.0))
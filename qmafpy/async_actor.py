@@ -0,0 +1,226 @@
+import asyncio
+import threading
+import time
+from .actor import Actor
+from .globals import App
+from .histogram import Histogram
+from .mailbox import SampledItem, _StampedSlot
+
+
+def get_app_loop():
+    """Return the shared asyncio event loop of the app, starting its thread on first use"""
+    with App.lock:
+        if App.async_loop is None:
+            loop = asyncio.new_event_loop()
+            thread = threading.Thread(target=loop.run_forever, args=(), name="async_loop", daemon=True)
+            thread.start()
+            App.async_loop = loop
+        return App.async_loop
+
+
+class _AsyncBridgeQueue:
+    """The App queue of an AsyncActor.  put() is thread safe: the item is handed to the event loop, which
+    moves it into the actor's asyncio.Queue.  Items keep their order.
+    track_latency(sample_every) samples the enqueue to dequeue latency like Mailbox.track_latency.  The counts are
+    not locked, so concurrent senders may rarely lose one."""
+    def __init__(self, actor):
+        self.actor = actor
+        self.queue_latency = None  # Histogram (ns) when latency is tracked
+        self.max_depth = 0
+        self.put_cnt = 0  # Items put while latency is tracked
+        self._sample_every = 0
+
+    def track_latency(self, sample_every=16):
+        self.queue_latency = Histogram()
+        self._sample_every = sample_every
+
+    def put(self, item, block=True, timeout=None):
+        if self._sample_every:
+            self.put_cnt += 1
+            if not self.put_cnt % self._sample_every and type(item) is tuple:
+                item = _StampedSlot(item, time.perf_counter())
+                depth = self.qsize() + 1
+                if depth > self.max_depth:
+                    self.max_depth = depth
+        self.actor.loop.call_soon_threadsafe(self.actor._put_local, item)
+
+    def unstamp(self, slot):
+        """Record the latency of a sampled item when it is dequeued, and return it as a SampledItem"""
+        self.queue_latency.record(int((time.perf_counter() - slot.put_time) * 1e9))
+        return SampledItem(slot.item)
+
+    def put_nowait(self, item):
+        self.put(item)
+
+    def qsize(self):
+        aq = self.actor._aq
+        return 0 if aq is None else aq.qsize()
+
+    def empty(self):
+        return self.qsize() == 0
+
+
+class AsyncActor(Actor):
+    """An actor whose mailbox is served by an asyncio event loop instead of a thread.
+        Tasks may be regular methods or coroutine methods (async def).  Regular methods run on the loop as
+        they are dequeued.  Coroutine methods are started as asyncio tasks, so many can be in flight at once,
+        up to max_inflight (None = unlimited).  Their order of completion is not their order of enqueue.
+        Other actors reach it with enqueue/send_data/App.get_queue as usual, from any thread.
+        By default all AsyncActors share the app's loop thread (see get_app_loop), so one thread can serve
+        many actors and connections.  Blocking calls in a task stall every actor on the loop.
+        Metrics, profiling and the watchdog cover the synchronous part of each task, as it is what holds the
+        loop.  The awaits of a coroutine task are not attributed to it.
+    """
+    def __init__(self, name: str, log_level=0, auto_start=True, loop=None, max_inflight=None):
+        self.loop = loop if loop is not None else get_app_loop()
+        self.max_inflight = max_inflight
+        self._aq = None  # asyncio.Queue.  Created on the loop.
+        self._inflight = set()
+        self._slots = None  # Semaphore limiting in flight coroutine tasks
+        self._mailbox_future = None
+        super().__init__(name, log_level=log_level, auto_start=False)
+        if auto_start:
+            self.run()
+
+    def _create_queue(self, mailbox_options):
+        q = _AsyncBridgeQueue(self)
+        App.add_queue(self.name, q)
+        return q
+
+    def _queue(self):
+        """Return the asyncio.Queue.  Only call on the loop."""
+        if self._aq is None:
+            self._aq = asyncio.Queue()
+        return self._aq
+
+    def _put_local(self, item):
+        self._queue().put_nowait(item)
+
+    def run(self):
+        """This method starts serving the mailbox on the event loop"""
+        self.log("Task Monitor Run Initiated", 5)
+        if not self._running:
+            self._running = True
+            self._stop_flag = False
+            self._mailbox_future = asyncio.run_coroutine_threadsafe(self._mailbox_loop(), self.loop)
+        else:
+            self.log("Can't run mailbox.  It is already running.", 5)
+
+    async def _mailbox_loop(self):
+        self.log("Task Monitor Running", 5)
+        aq = self._queue()
+        if self.max_inflight is not None:
+            self._slots = asyncio.Semaphore(self.max_inflight)
+        while not self._stop_flag:
+            task_data = await aq.get()
+            if task_data is None:
+                break
+            if type(task_data) is _StampedSlot:
+                task_data = self.q.unstamp(task_data)
+            if task_data[0] == "receive_publications":
+                # Each delivery of a publish_many is its own task, so coroutine callbacks are run as usual
+                for task_method, topic, attributes, data in task_data[1][0]:
+                    if self._slots is not None:
+                        await self._slots.acquire()
+                    self._dispatch((task_method, (topic, attributes, data), {}))
+                continue
+            if self._slots is not None:
+                await self._slots.acquire()
+            self._dispatch(task_data)
+        for task in list(self._inflight):
+            task.cancel()
+        self._running = False
+
+    def _dispatch(self, task_data):
+        """Perform one dequeued task.  A coroutine returned by the task is run as an asyncio task."""
+        task, args, kwargs = task_data
+        self.log("Dequeue task=%s, args=%s, kwargs=%s", 5, task, args, kwargs)
+        result = task_method = state = None
+        try:
+            task_method = self._resolve_task(task)
+        except Exception as e:
+            self.log(f"ERROR: Exception resolving task {task_data}: {e}")
+            self._deliver_reply(kwargs, None, e)
+        if task_method is not None:
+            state = self._begin_task(task_data) if self._hooked(task_data) else None
+            try:
+                result = task_method(*args, **kwargs)
+            except Exception as e:
+                self.log(f"ERROR: Exception performing task {task_data}: {e}")
+                self._deliver_reply(kwargs, None, e)
+        if asyncio.iscoroutine(result):
+            # Created before _end_task, so the asyncio task copies the current_actor context
+            task = self.loop.create_task(self._run_coroutine(result, task_data))
+            self._inflight.add(task)
+            task.add_done_callback(self._inflight.discard)
+        else:
+            if result is not None:
+                self._deliver_reply(kwargs, result)
+            if self._slots is not None:
+                self._slots.release()
+        if state is not None:
+            self._end_task(task_data, state)
+
+    async def _run_coroutine(self, coro, task_data):
+        try:
+            result = await coro
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            self.log(f"ERROR: Exception performing task {task_data}: {e}")
+            self._deliver_reply(task_data[2], None, e)
+        else:
+            if result is not None:
+                self._deliver_reply(task_data[2], result)
+        finally:
+            if self._slots is not None:
+                self._slots.release()
+
+    ### Awaitable versions of the messaging methods.  Only await them on the actor's loop.
+    async def query_async(self, q_name, task_method, timeout, *args, **kwargs):
+        """Awaitable query.  Returns the reply, or raises like QueryFuture.result (the query is cancelled on timeout)."""
+        future = self.query(q_name, task_method, timeout, *args, **kwargs)
+        return await asyncio.wait_for(asyncio.wrap_future(future, loop=self.loop), timeout)
+
+    async def task_query_async(self, q_name, task_method, timeout, *args, **kwargs):
+        """Awaitable task_query.  Returns (rtn_code, data), where data is the reply of the task."""
+        try:
+            return 0, await self.query_async(q_name, task_method, timeout, *args, **kwargs)
+        except asyncio.TimeoutError:
+            self.log(f"ERROR: Query timeout. Dest={q_name} task={task_method} args={args}", 0)
+        except Exception as e:
+            self.log(f"ERROR: Query failed. Dest={q_name} task={task_method} args={args}: {e}", 0)
+        return -1, None
+
+    async def publish_async(self, topic: str, data):
+        """Awaitable publish.  Publishing only enqueues, so it completes without suspending."""
+        self.publish(topic, data)
+
+    def reset(self, *args, **kwargs):
+        """This method resets is actor.  Runs on the loop, so the mailbox is drained directly."""
+        App.scheduler.flush_my_items(self.name)
+        aq = self._queue()
+        while not aq.empty():
+            aq.get_nowait()
+
+    def stop(self):
+        self._stop_flag = True
+        if self._running:
+            self.q.put(None)
+            future = self._mailbox_future
+            on_loop = self.loop.is_running() and _running_loop() is self.loop
+            if future is not None and not on_loop:
+                try:
+                    future.result(timeout=5)
+                except Exception:
+                    pass
+
+
+def _running_loop():
+    """Return the event loop running in this thread, or None"""
+    if not hasattr(asyncio, "get_running_loop"):  # Python 3.6
+        return asyncio._get_running_loop()
+    try:
+        return asyncio.get_running_loop()
+    except RuntimeError:
+        return None
@@ -0,0 +1,109 @@
+import collections
+import queue
+import threading
+from .mailbox import Mailbox
+
+
+class _ExecutorQueue(Mailbox):
+    """Mailbox of an actor that runs on an ActorExecutor.  Each put makes the actor ready to run."""
+    def __init__(self, executor, actor, **options):
+        super().__init__(actor.name, **options)
+        self.executor = executor
+        self.actor = actor
+
+    def put(self, item, block=True, timeout=None, priority=None):
+        queued = super().put(item, block, timeout, priority)
+        self.executor.notify(self.actor)
+        return queued
+
+    def put_conflated(self, key, item, block=True, timeout=None, priority=None):
+        queued = super().put_conflated(key, item, block, timeout, priority)
+        self.executor.notify(self.actor)
+        return queued
+
+
+class ActorExecutor:
+    """Runs many actors on a fixed number of shared threads (M:N).
+    An actor created with executor=<ActorExecutor> has no thread of its own.  Its queue is only a mailbox.
+    When a task is put in it, the actor is added to the executor's ready list.  A worker thread takes the
+    actor from the ready list and performs up to quantum of its queued tasks, then moves it to the back
+    of the ready list if more tasks are waiting.  An actor is in the ready list at most once, so its tasks
+    still run one at a time and in order.  The quantum stops one busy actor from starving the others.
+    """
+    def __init__(self, workers=4, quantum=50, name="executor"):
+        self.name = name
+        self.workers = workers
+        self.quantum = quantum
+        self._ready = collections.deque()
+        self._ready_cv = threading.Condition(threading.Lock())
+        self._sched_lock = threading.Lock()
+        self._scheduled = set()  # Actors in the ready list or being run
+        self._stop_flag = False
+        self.threads = [threading.Thread(target=self._worker, args=(), name=f"{name}-{i}", daemon=True)
+                        for i in range(workers)]
+        for thread in self.threads:
+            thread.start()
+
+    def create_queue(self, actor, **options):
+        """Return the mailbox for an actor that runs on this executor"""
+        return _ExecutorQueue(self, actor, **options)
+
+    def notify(self, actor):
+        """Add the actor to the ready list, unless it is already there or running"""
+        if not actor._running:
+            return
+        with self._sched_lock:
+            if actor in self._scheduled:
+                return
+            self._scheduled.add(actor)
+        self._push(actor)
+
+    def _push(self, actor):
+        with self._ready_cv:
+            self._ready.append(actor)
+            self._ready_cv.notify()
+
+    def _worker(self):
+        while True:
+            with self._ready_cv:
+                while not self._ready and not self._stop_flag:
+                    self._ready_cv.wait()
+                if self._stop_flag:
+                    break
+                actor = self._ready.popleft()
+            self._run_turn(actor)
+
+    def _run_turn(self, actor):
+        """Perform up to quantum queued tasks of an actor"""
+        q = actor.q
+        for _ in range(self.quantum):
+            if actor._stop_flag:
+                break
+            try:
+                task_data = q.get_nowait()
+            except queue.Empty:
+                break
+            if task_data is None:
+                actor._stop_flag = True
+                actor._running = False
+            else:
+                actor._dispatch(task_data)
+            q.task_done()
+        # A put that happens before this check is seen by qsize.  One after it sees the actor unscheduled.
+        with self._sched_lock:
+            if actor._running and not actor._stop_flag and q.qsize() > 0:
+                requeue = True
+            else:
+                requeue = False
+                self._scheduled.discard(actor)
+        if requeue:
+            self._push(actor)
+
+    def stop(self):
+        """Stop the worker threads.  Actors still in the ready list are not run."""
+        with self._ready_cv:
+            self._stop_flag = True
+            self._ready_cv.notify_all()
+        for thread in self.threads:
+            if thread is not threading.current_thread():
+                thread.join()
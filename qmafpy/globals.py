@@ -1,6 +1,6 @@
-import queue
 import threading
 import time
+from .mailbox import Mailbox
 
 
 class BorgMeta(type):
@@ -42,6 +42,12 @@ class App(object, metaclass=BorgMeta):
     logger = None
     subs_mgr = None
     scheduler = None
+    executor = None
+    async_loop = None
+    metrics = None
+    watchdog = None
+    recorder = None
+    network = None
     lock = threading.RLock()
 
     @staticmethod
@@ -59,17 +65,32 @@ class App(object, metaclass=BorgMeta):
     def add_queue(name, q_ref):
         with App.lock:
             App.queues[name] = q_ref
+        if App.recorder is not None:
+            App.recorder.attach(name, q_ref)
 
     @staticmethod
-    def create_queue(name):
-        q_ref = queue.Queue()
-        with App.lock:
-            App.queues[name] = q_ref
+    def mailbox_options(name, **options):
+        """Mailbox options for a queue: App.cfg["mailbox"]["default"], updated by App.cfg["mailbox"][name],
+        updated by options.  Keys are the Mailbox arguments (maxsize, policy, put_timeout, high_watermark,
+        low_watermark)."""
+        mailbox_cfg = App.cfg.get("mailbox", {})
+        merged = dict(mailbox_cfg.get("default", {}))
+        merged.update(mailbox_cfg.get(name, {}))
+        merged.update(options)
+        return merged
+
+    @staticmethod
+    def create_queue(name, **options):
+        q_ref = Mailbox(name, **App.mailbox_options(name, **options))
+        App.add_queue(name, q_ref)
         return q_ref
 
     @staticmethod
     def get_queue(name):
-        return App.queues.get(name, None)
+        q_ref = App.queues.get(name, None)
+        if q_ref is None and App.network is not None:
+            q_ref = App.network.remote_queue(name)  # <node>:<actor>
+        return q_ref
 
     @staticmethod
     def update_log_levels(log_levels:dict):
@@ -78,11 +99,21 @@ class App(object, metaclass=BorgMeta):
             if dest_q is not None:
                 dest_q.put(("set_log_level", (level,),{}))
 
+    @staticmethod
+    def update_profiling(profiling:dict):
+        """Toggle profiling at runtime.  key = actor name, value = set_profiling kwargs ({} turns it off)"""
+        for name, kwargs in profiling.items():
+            dest_q = App.queues.get(name, None)
+            if dest_q is not None:
+                dest_q.put(("set_profiling", (), kwargs))
+
     @staticmethod
     def exit():
         for dest_q in App.queues.values():
             dest_q.put(("exit", (), {}))
         time.sleep(0.1)
+        if App.executor is not None:
+            App.executor.stop()  # After the exit tasks of its actors had time to run
 
 
 
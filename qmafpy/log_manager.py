@@ -1,50 +1,252 @@
+import atexit
+import json
 import os
+import queue
+import threading
+import time
 from datetime import datetime
 
+# Overflow policies for the asynchronous log buffer
+LOG_OVERFLOW_BLOCK = "block"  # Caller waits for room in the buffer
+LOG_OVERFLOW_DROP = "drop"  # Message is dropped and counted in AppLogger.dropped_cnt
+
+# Log file formats
+LOG_FORMAT_TEXT = "text"  # Log_<app>_<date>.txt, one free-form line per message
+LOG_FORMAT_JSONL = "jsonl"  # Log_<app>_<date>.jsonl plus a sparse index in Log_<app>_<date>.idx
+
+
 class AppLogger():
 	"""This module handles logging of app status messages.
+	In async mode, log() only stamps the message and pushes it into a bounded buffer.  A writer thread
+	formats, prints and writes the buffered messages in batches.  The file is flushed every flush_interval_s
+	or after batch_size messages, whichever comes first.
+	In jsonl format, each message is stored as one JSON object per line:
+		{"t": epoch time, "a": actor name, "l": level, "m": message}
+	Every index_every records, a line describing that block of the file is appended to the index file:
+		{"t0": first time, "t1": last time, "o": start offset, "n": end offset, "c": record count, "a": [actors]}
+	LogReader (log_reader.py) uses the index to read only the blocks matching a time range and actors.
 	"""
-	def __init__(self, log_dir, app_name):
+	def __init__(self, log_dir, app_name, async_mode=False, flush_interval_s=0.5, batch_size=500,
+				 buffer_size=10000, overflow=LOG_OVERFLOW_BLOCK, log_format=LOG_FORMAT_TEXT, index_every=1000):
 		self.log_dir = log_dir
 		self.app_name = app_name
 		self.log_file_date = None
 		self.log_file = None
+		self.log_format = log_format
+		self.index_every = index_every
+		self._index_file = None
+		self._offset = 0  # Byte offset of the end of the jsonl file
+		self._block = None  # Block of jsonl records not yet in the index
+		self._lock = threading.RLock()
+		self.async_mode = async_mode
+		self.flush_interval_s = flush_interval_s
+		self.batch_size = batch_size
+		self.overflow = overflow
+		self.dropped_cnt = 0  # Messages dropped because the buffer was full
+		self._dropped_lock = threading.Lock()
+		self._buffer = None
+		self._writer_thread = None
+		if self.async_mode:
+			self._buffer = queue.Queue(maxsize=buffer_size)
+			self._writer_thread = threading.Thread(target=self._writer, args=(), daemon=True)
+			self._writer_thread.start()
+			atexit.register(self.exit)  # Drain the buffer even if exit() is never called.  Unregistered by exit().
 
 	def log(self, msg):
 		"""Add time stamp then write to log file.
 		"""
-		log_msg = str(datetime.now())[:-3] + ": " + msg
-		self._logMessage(log_msg)
+		self.log_record(None, None, msg)
+
+	def log_record(self, name, level, msg):
+		"""Log a message with the name and level of its source (e.g. an actor) kept as separate fields."""
+		record = (time.time(), name, level, msg)
+		buffer = self._buffer
+		if buffer is not None:
+			self._push(buffer, record)
+		else:
+			with self._lock:
+				self._write_batch([record])
 
-	def open_new_file(self):
-		if self.log_file is not None:
+	def _push(self, buffer, record):
+		"""Add a record to the async buffer, applying the overflow policy when it is full."""
+		if self.overflow == LOG_OVERFLOW_BLOCK:
+			while True:
+				try:
+					buffer.put(record, timeout=1.0)
+					return
+				except queue.Full:
+					writer_thread = self._writer_thread
+					if writer_thread is None or not writer_thread.is_alive():
+						# No writer to make room.  Write synchronously rather than wait forever.
+						with self._lock:
+							self._write_batch([record])
+						return
+		else:
 			try:
-				self.log_file.close()
-			except:
-				pass
-		self.log_file_date = datetime.now().strftime("%Y%m%d")
-		file_name = "Log_" + self.app_name + "_" + self.log_file_date + ".txt"
+				buffer.put_nowait(record)
+			except queue.Full:
+				with self._dropped_lock:
+					self.dropped_cnt += 1
+
+	def _writer(self):
+		"""Writer thread.  Collect records into a batch, then format and write the batch."""
+		exiting = False
+		while not exiting:
+			batch = []
+			deadline = time.monotonic() + self.flush_interval_s
+			while len(batch) < self.batch_size:
+				try:
+					record = self._buffer.get(timeout=max(0, deadline - time.monotonic()))
+				except queue.Empty:
+					break
+				if record is None:
+					exiting = True
+					break
+				batch.append(record)
+			if batch:
+				try:
+					with self._lock:
+						self._write_batch(batch)
+				except Exception as e:
+					# Keep the writer alive (e.g. disk full), so the buffer keeps draining
+					print(f"ERROR: Log writer failed to write {len(batch)} messages: {e}")
+
+	def _write_batch(self, batch):
+		if self.dropped_cnt:
+			with self._dropped_lock:
+				dropped_cnt, self.dropped_cnt = self.dropped_cnt, 0
+			batch.append((time.time(), None, 0, f"WARNING: Log buffer full. {dropped_cnt} messages dropped"))
+		text_lines = []
+		records = []
+		for record in batch:
+			stamp = datetime.fromtimestamp(record[0])
+			file_date = stamp.strftime("%Y%m%d")
+			if self.log_file is None or self.log_file_date != file_date:
+				# Day rollover.  Write what belongs to the previous day before switching files.
+				self._write_lines(text_lines, records)
+				text_lines = []
+				records = []
+				self.open_new_file(file_date)
+			name, msg = record[1], record[3]
+			text_lines.append(str(stamp)[:-3] + ": " + (msg if name is None else name + " " + msg))
+			records.append(record)
+		self._write_lines(text_lines, records)
+
+	def _write_lines(self, text_lines, records):
+		if text_lines:
+			text = "\n".join(text_lines)
+			# 1) Print to StdOut
+			print(text)
+			# 2) Write to log file
+			if self.log_format == LOG_FORMAT_JSONL:
+				self._write_jsonl(records)
+			else:
+				self.log_file.write(text + "\n")
+			self.log_file.flush()
+
+	def _write_jsonl(self, records):
+		block = self._block
+		for timestamp, name, level, msg in records:
+			line = json.dumps({"t": timestamp, "a": name, "l": level, "m": msg}, separators=(",", ":")) + "\n"
+			data = line.encode("utf-8")
+			self.log_file.write(data)
+			self._offset += len(data)
+			block["t0"] = timestamp if block["t0"] is None else min(block["t0"], timestamp)
+			block["t1"] = timestamp if block["t1"] is None else max(block["t1"], timestamp)
+			block["a"].add(name)
+			block["c"] += 1
+			if block["c"] >= self.index_every:
+				self._write_index_entry()
+				block = self._block
+
+	def _write_index_entry(self):
+		"""Close the current block: append its index line and start a new block at the current offset."""
+		block = self._block
+		if block is not None and block["c"] > 0:
+			entry = dict(block, n=self._offset, a=sorted(block["a"], key=str))
+			self._index_file.write(json.dumps(entry, separators=(",", ":")) + "\n")
+			self._index_file.flush()
+		self._block = {"t0": None, "t1": None, "o": self._offset, "c": 0, "a": set()}
+
+	def open_new_file(self, file_date=None):
+		self.close()
+		self.log_file_date = file_date if file_date is not None else datetime.now().strftime("%Y%m%d")
+		file_name = "Log_" + self.app_name + "_" + self.log_file_date
 		file_path = os.path.join(self.log_dir, file_name)
-		self.log_file = open(file_path, 'a')
+		if self.log_format == LOG_FORMAT_JSONL:
+			self._open_jsonl(file_path + ".jsonl", file_path + ".idx")
+		else:
+			self.log_file = open(file_path + ".txt", 'a')
 
-	def _logMessage(self, msg: str):
-		"""Write to log file.
-		"""
-		if self.log_file is None or self.log_file_date != datetime.now().strftime("%Y%m%d"):
-			self.open_new_file()
-		# 1) Print to StdOut
-		print(msg)
-		# 2) Write to log file
-		self.log_file.write(msg + "\n")
-		self.log_file.flush()
+	def _open_jsonl(self, file_path, index_path):
+		"""Open the day's jsonl file for append.
+		Records a previous run left out of the index (e.g. after a crash) are added to the first new block."""
+		indexed_end = 0
+		if os.path.exists(index_path):
+			with open(index_path, 'rb') as f:
+				for line in f:
+					try:
+						indexed_end = json.loads(line)["n"]
+					except (ValueError, KeyError):
+						pass  # Ignore a torn last line
+		self._offset = indexed_end
+		self._block = {"t0": None, "t1": None, "o": indexed_end, "c": 0, "a": set()}
+		if os.path.exists(file_path):
+			with open(file_path, 'rb') as f:
+				f.seek(indexed_end)
+				for line in f:
+					if line.endswith(b"\n"):
+						self._offset += len(line)
+						try:
+							record = json.loads(line)
+						except ValueError:
+							continue
+						block = self._block
+						block["t0"] = record["t"] if block["t0"] is None else min(block["t0"], record["t"])
+						block["t1"] = record["t"] if block["t1"] is None else max(block["t1"], record["t"])
+						block["a"].add(record["a"])
+						block["c"] += 1
+			if os.path.getsize(file_path) > self._offset:
+				os.truncate(file_path, self._offset)  # Drop a torn last record so appended records stay line aligned
+		self.log_file = open(file_path, 'ab')
+		self._index_file = open(index_path, 'a')
 
 	def close(self):
-		if self.log_file != None:
-			try:
-				self.log_file.close()
-				self.log_file = None
-			except:
-				pass
+		with self._lock:
+			if self._index_file is not None:
+				try:
+					self._write_index_entry()  # Index the partial last block
+					self._index_file.close()
+				except:
+					pass
+				self._index_file = None
+				self._block = None
+			if self.log_file != None:
+				try:
+					self.log_file.close()
+					self.log_file = None
+				except:
+					pass
 
 	def exit(self):
+		"""Drain any buffered messages, then close the log file."""
+		if self._writer_thread is not None:
+			writer_thread, self._writer_thread = self._writer_thread, None
+			while writer_thread.is_alive():
+				try:
+					self._buffer.put(None, timeout=1.0)  # Queued behind the pending records, so they are written
+					break
+				except queue.Full:
+					pass
+			writer_thread.join()
+			buffer, self._buffer = self._buffer, None
+			leftover = []  # Left by a writer that died
+			while not buffer.empty():
+				record = buffer.get_nowait()
+				if record is not None:
+					leftover.append(record)
+			if leftover:
+				with self._lock:
+					self._write_batch(leftover)
+			atexit.unregister(self.exit)  # Release this logger
 		self.close()
@@ -0,0 +1,123 @@
+import argparse
+import json
+import os
+from datetime import datetime
+
+# Accepted time strings: the stamp of the text log lines (e.g. 2024-01-31 13:00:00.123), with a "T" or without the
+# fraction.  datetime.fromisoformat needs Python 3.7.
+_TIME_FORMATS = ("%Y-%m-%d %H:%M:%S.%f", "%Y-%m-%d %H:%M:%S", "%Y-%m-%dT%H:%M:%S.%f", "%Y-%m-%dT%H:%M:%S",
+                 "%Y-%m-%d %H:%M", "%Y-%m-%dT%H:%M", "%Y-%m-%d")
+
+
+def _parse_time(text):
+    """Return the datetime of a time string in one of _TIME_FORMATS"""
+    for time_format in _TIME_FORMATS:
+        try:
+            return datetime.strptime(text.strip(), time_format)
+        except ValueError:
+            pass
+    raise ValueError(f"Invalid time: {text!r}.  Expected e.g. 2024-01-31 13:00:00.123 or 2024-01-31T13:00:00")
+
+
+class LogReader:
+    """Reads the jsonl log files written by AppLogger (log_format="jsonl").
+    The sparse index next to the log file (same name, .idx extension) lists blocks of records with their
+    time range, byte offsets and actor names.  A query only reads the blocks that overlap its time range
+    and contain one of its actors, plus the records written after the last indexed block.
+    """
+    def __init__(self, file_path):
+        self.file_path = file_path
+        self.index_path = os.path.splitext(file_path)[0] + ".idx"
+        self.index = self._load_index()
+
+    def _load_index(self):
+        index = []
+        if os.path.exists(self.index_path):
+            with open(self.index_path, 'rb') as f:
+                for line in f:
+                    try:
+                        index.append(json.loads(line))
+                    except ValueError:
+                        pass  # Ignore a torn last line
+        return index
+
+    @staticmethod
+    def _to_epoch(value):
+        if value is None or isinstance(value, (int, float)):
+            return value
+        if isinstance(value, str):
+            value = _parse_time(value)
+        return value.timestamp()
+
+    def query(self, start=None, end=None, actors=None):
+        """Yield the records (dicts with keys t, a, l, m) logged between start and end by the given actors.
+        start/end may be epoch seconds, datetimes or local time strings (see _TIME_FORMATS).  None means
+        unbounded.
+        """
+        start = self._to_epoch(start)
+        end = self._to_epoch(end)
+        if actors is not None:
+            actors = set(actors)
+        with open(self.file_path, 'rb') as f:
+            indexed_end = 0
+            for entry in self.index:
+                indexed_end = entry["n"]
+                if start is not None and entry["t1"] < start:
+                    continue
+                if end is not None and entry["t0"] > end:
+                    continue
+                if actors is not None and actors.isdisjoint(entry["a"]):
+                    continue
+                yield from self._scan(f, entry["o"], entry["n"], start, end, actors)
+            # Records written after the last indexed block
+            yield from self._scan(f, indexed_end, None, start, end, actors)
+
+    @staticmethod
+    def _scan(f, offset, end_offset, start, end, actors):
+        needles = None
+        if actors is not None:
+            # Cheap byte match before parsing.  AppLogger writes compact JSON, so the field reads "a":<name>
+            needles = [b'"a":' + json.dumps(actor).encode("utf-8") for actor in actors]
+        f.seek(offset)
+        while end_offset is None or offset < end_offset:
+            line = f.readline()
+            if not line.endswith(b"\n"):
+                break  # End of file or a record still being written
+            offset += len(line)
+            if needles is not None and not any(needle in line for needle in needles):
+                continue
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue
+            if start is not None and record["t"] < start:
+                continue
+            if end is not None and record["t"] > end:
+                continue
+            if actors is not None and record["a"] not in actors:
+                continue
+            yield record
+
+    @staticmethod
+    def format_record(record):
+        """Format a record the same way as a line of a text log file."""
+        stamp = str(datetime.fromtimestamp(record["t"]))[:-3]
+        if record["a"] is None:
+            return f"{stamp}: {record['m']}"
+        return f"{stamp}: {record['a']} {record['m']}"
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Query a qmafpy jsonl log file by time range and actor.")
+    parser.add_argument("file_path", help="Log_<app>_<date>.jsonl file")
+    parser.add_argument("--start", help="Local time, e.g. \"2024-01-31 13:00:00\" or 2024-01-31T13:00:00")
+    parser.add_argument("--end", help="Local time, e.g. \"2024-01-31 13:05:00\" or 2024-01-31T13:05:00")
+    parser.add_argument("--actor", action="append", help="Actor name.  Can be repeated.")
+    args = parser.parse_args(argv)
+    reader = LogReader(args.file_path)
+    for record in reader.query(args.start, args.end, args.actor):
+        print(LogReader.format_record(record))
+
+
+if __name__ == "__main__":
+    main()
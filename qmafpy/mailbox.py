@@ -0,0 +1,336 @@
+import collections
+import queue
+import time
+from .histogram import Histogram
+
+# Overflow policies of a bounded Mailbox
+MAILBOX_BLOCK = "block"  # Sender waits up to put_timeout for room, then gets MailboxFull
+MAILBOX_DROP_NEWEST = "drop_newest"  # The new item is dropped
+MAILBOX_DROP_OLDEST = "drop_oldest"  # The oldest queued item is dropped to make room
+MAILBOX_REJECT = "reject"  # Sender gets MailboxFull immediately
+MAILBOX_POLICIES = (MAILBOX_BLOCK, MAILBOX_DROP_NEWEST, MAILBOX_DROP_OLDEST, MAILBOX_REJECT)
+
+# Priority lanes.  Items are dequeued from the lowest lane number first, and in FIFO order within a lane.
+PRIORITY_CONTROL = 0
+PRIORITY_HIGH = 1
+PRIORITY_NORMAL = 2
+_LANE_CNT = 3
+
+# Tasks that always go to the control lane and are accepted even by a full mailbox, so an actor can be
+# stopped and reconfigured without waiting behind its backlog.  The stop sentinel (None) goes there too.
+CONTROL_TASKS = ("exit", "set_log_level", "set_profiling")
+# Tasks accepted even by a full mailbox, but kept in order in the normal lane: reset acts on what was queued
+# before it.
+IN_ORDER_TASKS = ("reset",)
+
+
+class MailboxFull(queue.Full):
+    """Raised to the sender when a bounded mailbox rejects an item"""
+
+
+class _ConflatedSlot:
+    """A queued item that a newer put_conflated with the same key replaces in place"""
+    __slots__ = ("key", "item")
+
+    def __init__(self, key, item):
+        self.key = key
+        self.item = item
+
+
+class _StampedSlot:
+    """A queued item sampled for latency tracking, with the time it was put"""
+    __slots__ = ("item", "put_time")
+
+    def __init__(self, item, put_time):
+        self.item = item
+        self.put_time = put_time  # time.perf_counter()
+
+
+class SampledItem(tuple):
+    """A dequeued task tuple that was sampled for latency tracking.  The mark travels with the item, so the actor
+    that performs it (any worker, any batch) times its task (see Actor._dispatch)."""
+    __slots__ = ()
+
+
+_SLOT_TYPES = (_ConflatedSlot, _StampedSlot)
+
+
+def is_control(item):
+    return item is None or (type(item) is tuple and item and item[0] in CONTROL_TASKS)
+
+
+def is_always_accepted(item):
+    """Return True for the items a full mailbox accepts and never drops: control items, reset and None"""
+    return item is None or (type(item) is tuple and item and (item[0] in CONTROL_TASKS or item[0] in IN_ORDER_TASKS))
+
+
+class Mailbox(queue.Queue):
+    """The queue of an actor.  It is a queue.Queue with optional capacity and backlog monitoring.
+        Items are kept in priority lanes (control, high, normal).  put() takes an optional priority.
+            Control items (CONTROL_TASKS) always go to the control lane.  Others default to normal.
+            get() returns the oldest item of the highest priority lane that is not empty.
+        maxsize: capacity (0 = unbounded).  When full, policy selects what happens (MAILBOX_POLICIES).
+            Control items, reset and the stop sentinel (None) are always accepted and never dropped.
+            drop_oldest drops from the lowest priority lane first, and rejects if nothing can be dropped.
+        high_watermark / low_watermark: the mailbox is backlogged from when its size reaches high_watermark
+            until it drains to low_watermark (default high_watermark // 2).  Listeners added with
+            add_watermark_listener are called with (mailbox, backlogged) on each change.
+        put_conflated(key, item): at most one item per key is queued.  A newer item replaces the payload of the
+            queued one, which keeps its place in the queue.
+        Counters: dropped_cnt, rejected_cnt, conflated_cnt (items replaced in place) and high_watermark_cnt
+            (number of times it became backlogged).
+        set_put_listener(callback): callback(name, item) is called for each item the mailbox accepts, including
+            a conflated replacement (used by the MessageRecorder).
+        track_latency(sample_every): measure the enqueue to dequeue latency of one of every sample_every items
+            into queue_latency (a Histogram in ns), and the depth seen by those items into max_depth.
+            A sampled task is dequeued as a SampledItem, so its actor can time it.
+            put_cnt counts the items put while tracked.
+    """
+    def __init__(self, name="", maxsize=0, policy=MAILBOX_BLOCK, put_timeout=None, high_watermark=None,
+                 low_watermark=None):
+        if policy not in MAILBOX_POLICIES:
+            raise ValueError(f"Invalid mailbox policy: {policy}")
+        super().__init__(maxsize)
+        self.name = name
+        self.policy = policy
+        self.put_timeout = put_timeout
+        self.high_watermark = high_watermark
+        if high_watermark is not None and low_watermark is None:
+            low_watermark = high_watermark // 2
+        self.low_watermark = low_watermark
+        self.backlogged = False
+        self.dropped_cnt = 0
+        self.rejected_cnt = 0
+        self.conflated_cnt = 0
+        self.high_watermark_cnt = 0
+        self._conflated = {}  # key = conflation key, value = its queued _ConflatedSlot
+        self._watermark_listeners = []
+        self._put_listener = None
+        self._low_crossed = False  # Set under the mutex by _get, reported after it is released
+        self.queue_latency = None  # Histogram (ns) when latency is tracked
+        self.max_depth = 0
+        self._sample_every = 0
+        self._sample_countdown = 0  # Puts left until the next sampled one
+        self._sample_rounds = 0
+
+    def track_latency(self, sample_every=16):
+        """Start measuring queueing latency (see class doc).  A sampled item is queued in a _StampedSlot
+        holding its put time.  _put_tracked replaces _put, so an untracked mailbox pays nothing on put."""
+        with self.mutex:
+            self.queue_latency = Histogram()
+            self._sample_every = self._sample_countdown = sample_every
+            self._sample_rounds = 0
+            self._put = self._put_tracked
+
+    @property
+    def put_cnt(self):
+        """Items put while latency is tracked"""
+        return self._sample_rounds * self._sample_every + self._sample_every - self._sample_countdown
+
+    def add_watermark_listener(self, callback):
+        """callback(mailbox, backlogged) is called when the mailbox becomes backlogged or drains.
+        It runs on the sender's or the receiver's thread, so it must not block."""
+        self._watermark_listeners.append(callback)
+
+    def set_put_listener(self, callback):
+        """callback(name, item) is called for each accepted item, or None to remove it.  It is called with the
+        mailbox locked, so it must be quick and must not block or use the mailbox."""
+        with self.mutex:
+            self._put_listener = callback
+
+    def _notify_watermark(self, backlogged):
+        for callback in self._watermark_listeners:
+            try:
+                callback(self, backlogged)
+            except Exception as e:
+                print(f"ERROR: Mailbox {self.name} watermark listener: {e}")
+
+    # Queue storage: one deque per priority lane
+    def _init(self, maxsize):
+        self._lanes = [collections.deque() for _ in range(_LANE_CNT)]
+        self._size = 0
+
+    def _qsize(self):
+        return self._size
+
+    def _put(self, item, priority=PRIORITY_NORMAL):
+        self._lanes[priority].append(item)
+        self._size += 1
+
+    def _put_tracked(self, item, priority=PRIORITY_NORMAL):
+        self._sample_countdown -= 1
+        if not self._sample_countdown:  # Only a countdown on the other puts
+            self._sample_countdown = self._sample_every
+            self._sample_rounds += 1
+            if type(item) is not _ConflatedSlot:
+                item = _StampedSlot(item, time.perf_counter())
+                if self._size >= self.max_depth:
+                    self.max_depth = self._size + 1
+        self._lanes[priority].append(item)
+        self._size += 1
+
+    def _drop_oldest(self):
+        """Drop the oldest item that may be dropped, lowest priority lane first.  Returns False if there is none."""
+        for lane in reversed(self._lanes[PRIORITY_CONTROL + 1:]):
+            for i, item in enumerate(lane):
+                if is_always_accepted(item.item if type(item) is _StampedSlot else item):
+                    continue  # Rare: only reset is kept outside the control lane
+                del lane[i]
+                self._size -= 1
+                if type(item) is _ConflatedSlot:
+                    del self._conflated[item.key]
+                return True
+        return False
+
+    def put(self, item, block=True, timeout=None, priority=None):
+        """Put an item, applying the overflow policy if the mailbox is full.
+        priority: PRIORITY_HIGH or PRIORITY_NORMAL (default).  Control items always use PRIORITY_CONTROL.
+        None (the stop sentinel) uses the control lane.  reset uses the normal lane, so it acts on the tasks
+        queued before it.
+        Returns True if the item was queued, False if it was dropped.  Raises MailboxFull if rejected."""
+        return self._enqueue(item, block, timeout, priority, None)
+
+    def put_conflated(self, key, item, block=True, timeout=None, priority=None):
+        """Put an item, or replace the payload of the queued item with the same key.
+        Returns True if the item was queued or replaced, False if it was dropped.  Raises MailboxFull if rejected."""
+        return self._enqueue(item, block, timeout, priority, key)
+
+    def _replace_conflated(self, key, item):
+        """Replace the payload of the queued item with this key.  Returns False if there is none.  Call locked."""
+        slot = self._conflated.get(key)
+        if slot is None:
+            return False
+        slot.item = item
+        self.conflated_cnt += 1
+        if self._put_listener is not None:
+            self._put_listener(self.name, item)
+        return True
+
+    def _enqueue(self, item, block, timeout, priority, key):
+        accepted = is_always_accepted(item)
+        if is_control(item):
+            priority = PRIORITY_CONTROL
+        elif priority is None:
+            priority = PRIORITY_NORMAL
+        elif not PRIORITY_CONTROL <= priority <= PRIORITY_NORMAL:
+            raise ValueError(f"Invalid priority: {priority}")
+        with self.not_full:
+            if key is not None and self._replace_conflated(key, item):
+                return True
+            if self.maxsize > 0 and self._qsize() >= self.maxsize and not accepted:
+                if self.policy == MAILBOX_DROP_NEWEST:
+                    self.dropped_cnt += 1
+                    return False
+                if self.policy == MAILBOX_DROP_OLDEST and self._drop_oldest():
+                    self.unfinished_tasks -= 1  # The dropped item will never be marked done
+                    self.dropped_cnt += 1
+                elif self.policy == MAILBOX_DROP_OLDEST:
+                    self.rejected_cnt += 1
+                    raise MailboxFull(f"Mailbox {self.name} is full of items that can't be dropped")
+                else:
+                    if self.policy == MAILBOX_BLOCK and block:
+                        wait_s = timeout if timeout is not None else self.put_timeout
+                        self.not_full.wait_for(lambda: self._qsize() < self.maxsize, wait_s)
+                        if key is not None and self._replace_conflated(key, item):
+                            return True  # Queued by another sender while waiting
+                    if self._qsize() >= self.maxsize:
+                        self.rejected_cnt += 1
+                        raise MailboxFull(f"Mailbox {self.name} is full ({self.maxsize} items)")
+            if self._put_listener is not None:
+                self._put_listener(self.name, item)
+            if key is not None:
+                slot = _ConflatedSlot(key, item)
+                self._conflated[key] = slot
+                item = slot
+            self._put(item, priority)
+            self.unfinished_tasks += 1
+            self.not_empty.notify()
+            crossed_high = (self.high_watermark is not None and not self.backlogged
+                            and self._qsize() >= self.high_watermark)
+            if crossed_high:
+                self.backlogged = True
+                self.high_watermark_cnt += 1
+        if crossed_high:
+            self._notify_watermark(True)
+        return True
+
+    def _get(self):
+        for lane in self._lanes:
+            if lane:
+                item = lane.popleft()
+                break
+        self._size -= 1
+        if type(item) in _SLOT_TYPES:
+            if type(item) is _ConflatedSlot:
+                del self._conflated[item.key]
+                item = item.item
+            else:
+                self.queue_latency.record(int((time.perf_counter() - item.put_time) * 1e9))
+                item = SampledItem(item.item) if type(item.item) is tuple else item.item
+        if self.backlogged and self._qsize() <= self.low_watermark:
+            self.backlogged = False
+            self._low_crossed = True
+        return item
+
+    def _report_low(self):
+        if self._low_crossed:
+            with self.mutex:
+                crossed_low, self._low_crossed = self._low_crossed, False
+            if crossed_low:
+                self._notify_watermark(False)
+
+    def get(self, block=True, timeout=None):
+        item = super().get(block, timeout)
+        self._report_low()
+        return item
+
+    def get_batch(self, max_items, block=True, timeout=None):
+        """Remove and return a list of up to max_items items with one lock acquire (see get_batch)"""
+        items = _get_batch(self, max_items, block, timeout)
+        self._report_low()
+        return items
+
+    def stats(self):
+        return {"size": self.qsize(), "maxsize": self.maxsize, "backlogged": self.backlogged,
+                "dropped": self.dropped_cnt, "rejected": self.rejected_cnt, "conflated": self.conflated_cnt,
+                "high_watermark_cnt": self.high_watermark_cnt, "max_depth": self.max_depth}
+
+
+def get_batch(q, max_items, block=True, timeout=None):
+    """Remove and return a list of up to max_items items from a queue.Queue with one lock acquire.
+    Waits like q.get() for the first item, then takes whatever else is already queued, up to a None.
+    Call task_done_batch(q, len(items)) when they are processed."""
+    if isinstance(q, Mailbox):
+        return q.get_batch(max_items, block, timeout)
+    return _get_batch(q, max_items, block, timeout)
+
+
+def _get_batch(q, max_items, block, timeout):
+    with q.not_empty:
+        if not block:
+            if not q._qsize():
+                return []
+        else:
+            if not q.not_empty.wait_for(q._qsize, timeout):
+                return []
+        items = []
+        while len(items) < max_items and q._qsize():
+            item = q._get()
+            items.append(item)
+            if item is None:
+                break  # Stop sentinel.  The items behind it stay queued, as with get().
+        q.not_full.notify(len(items))
+        return items
+
+
+def task_done_batch(q, cnt):
+    """Mark cnt items of a queue.Queue as processed (cnt calls of q.task_done())."""
+    if cnt <= 0:
+        return
+    with q.all_tasks_done:
+        unfinished = q.unfinished_tasks - cnt
+        if unfinished <= 0:
+            if unfinished < 0:
+                raise ValueError('task_done() called too many times')
+            q.all_tasks_done.notify_all()
+        q.unfinished_tasks = unfinished
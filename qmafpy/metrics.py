@@ -0,0 +1,102 @@
+import threading
+import time
+from .actor import Actor
+from .globals import App
+from .histogram import Histogram
+
+
+class ActorMetrics:
+    """Metrics of one actor.  The actor updates them on its own thread(s).
+    The mailbox samples one of every sample_every items (see Mailbox.track_latency).  The task of a sampled item
+    is timed into the service time histogram of its task."""
+    def __init__(self, actor, sample_every):
+        self.name = actor.name
+        self.actor = actor
+        self.service_time = {}  # key = task name, value = Histogram (ns)
+        if hasattr(actor.q, "track_latency"):
+            actor.q.track_latency(sample_every)
+
+    def record_task(self, task, duration_ns):
+        name = task if type(task) == str else getattr(task, "__name__", str(task))
+        hist = self.service_time.get(name)
+        if hist is None:
+            hist = self.service_time[name] = Histogram()
+        hist.record(duration_ns)
+
+    def snapshot(self):
+        q = self.actor.q
+        snap = {"service_ns": {name: hist.summary() for name, hist in list(self.service_time.items())}}
+        if hasattr(q, "qsize"):
+            snap["depth"] = q.qsize()
+        if getattr(q, "queue_latency", None) is not None:
+            snap["enqueued"] = q.put_cnt
+            snap["max_depth"] = q.max_depth
+            snap["queue_latency_ns"] = q.queue_latency.summary()
+        return snap
+
+
+class MetricsMgr(Actor):
+    """This class collects runtime metrics.  It is started by AppMgr.init_metrics() as App.metrics.
+        Actors created after it register themselves (see Actor.__init__): mailbox depth, enqueue to dequeue
+        latency and per task service time.  Latency and service time are sampled (App.cfg["metrics_sample_every"],
+        default 64) to keep the cost per task low.
+        Publishes are counted per topic with a histogram of their fan-out (deliveries per publish).
+        snapshot() returns everything as a dict.  With publish_interval_s, it is also published periodically
+        on App.cfg["metrics_topic"] (default "metrics").
+    """
+    def __init__(self, publish_interval_s=None, log_level=0):
+        self.name = "metrics"
+        self.sample_every = App.cfg.get("metrics_sample_every", 64)
+        self.topic = App.cfg.get("metrics_topic", "metrics")
+        self.actors = {}  # key = actor name, value = ActorMetrics
+        self.topics = {}  # key = topic, value = [publish count, delivery count]
+        self.fanout = Histogram()
+        self.sched_check_time = Histogram()  # Time (ns) of each scheduler check
+        self._registry_lock = threading.Lock()
+        self.publish_interval_s = publish_interval_s
+        self._publishing = False
+        super().__init__(self.name, log_level=log_level)
+        self.start_publishing()
+
+    def start_publishing(self):
+        """Schedule the periodic publish_metrics, once App.scheduler exists.  Metrics are usually started before
+        the services, so AppMgr.init_services calls it again after creating the scheduler."""
+        if self.publish_interval_s and not self._publishing and App.scheduler is not None:
+            self._publishing = True
+            self.sched_local("publish_metrics", self.publish_interval_s, 0, "publish_metrics")
+
+    def register(self, actor):
+        """Start collecting the metrics of an actor and return its ActorMetrics"""
+        actor_metrics = ActorMetrics(actor, self.sample_every)
+        with self._registry_lock:
+            self.actors[actor.name] = actor_metrics
+        return actor_metrics
+
+    def record_publish(self, topic, deliveries):
+        counts = self.topics.get(topic)
+        if counts is None:
+            counts = self.topics[topic] = [0, 0]
+        counts[0] += 1
+        counts[1] += deliveries
+        self.fanout.record(deliveries)
+
+    def snapshot(self):
+        with self._registry_lock:
+            actors = list(self.actors.values())
+        snap = {"time": time.time(),
+                "actors": {actor_metrics.name: actor_metrics.snapshot() for actor_metrics in actors},
+                "topics": {topic: {"publishes": counts[0], "deliveries": counts[1]}
+                           for topic, counts in list(self.topics.items())},
+                "fanout": self.fanout.summary()}
+        scheduler = App.scheduler
+        if scheduler is not None and hasattr(scheduler, "sched_items"):
+            with scheduler.lock:
+                stats = [s for source in scheduler.sched_stats.values() for s in source.values()]
+                snap["scheduler"] = {"items": len(scheduler.sched_items), "heap": len(scheduler._heap),
+                                     "sent": sum(s.sent for s in stats), "missed": sum(s.missed for s in stats),
+                                     "check_ns": self.sched_check_time.summary()}
+        return snap
+
+    def publish_metrics(self):
+        """Publish a snapshot on the metrics topic"""
+        self.publish(self.topic, self.snapshot())
@@ -0,0 +1,641 @@
+import collections
+import hashlib
+import hmac
+import itertools
+import json
+import os
+import pickle
+import queue
+import select
+import socket
+import stat
+import struct
+import threading
+import time
+import weakref
+from .actor import Actor
+from .globals import App
+from .rpc import QueryError
+
+NODE_SEP = ":"  # Qualified names are <node>:<actor> and <node>:<topic>
+_PROTOCOL = min(5, pickle.HIGHEST_PROTOCOL)  # 4 before Python 3.8: no out-of-band buffers
+_FRAME = struct.Struct("<II")  # Pickle length, out-of-band buffer count.  Then the pickle, then each buffer.
+_BUFFER = struct.Struct("<Q")  # Length of an out-of-band buffer
+_LEN = struct.Struct("<I")
+_NONCE_SIZE = 16
+_MAC_SIZE = hashlib.sha256().digest_size
+_MAX_HELLO = 65536
+_ACCEPTED = b"\x01"  # Sent by the server once the hello is authenticated, with its own MAC
+_CLIENT, _SERVER = b"client", b"server"  # Prefixed to the nonce, so a MAC can't be replayed in the other role
+_SEND_JOIN_MAX = 65536  # Parts smaller than this are joined into one send
+# Services a peer may call.  Everything else is refused.
+_REMOTE_CALLS = {("subs_mgr", "add_subscription"), ("subs_mgr", "unsubscribe"), ("subs_mgr", "_publish"),
+                 ("subs_mgr", "_publish_many")}
+# Service actors a peer may not put tasks on.  Their tasks (schedule, add_peer...) would get around _REMOTE_CALLS.
+_SERVICE_QUEUES = ("sched", "subscription", "network", "metrics", "watchdog")
+
+
+#### Transports.  An address is <scheme>://<location>, e.g. tcp://127.0.0.1:7400 or unix:///tmp/node_a.sock
+class TcpTransport:
+    @staticmethod
+    def listen(location):
+        host, port = location.rsplit(":", 1)
+        if hasattr(socket, "create_server"):
+            return socket.create_server((host, int(port)))
+        server = socket.socket(socket.getaddrinfo(host, int(port), type=socket.SOCK_STREAM)[0][0])  # Python < 3.8
+        if os.name == "posix":
+            server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        server.bind((host, int(port)))
+        server.listen()
+        return server
+
+    @staticmethod
+    def connect(location, timeout):
+        host, port = location.rsplit(":", 1)
+        sock = socket.create_connection((host, int(port)), timeout=timeout)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)  # Batching is done by the sender
+        return sock
+
+    @staticmethod
+    def address(server):
+        host, port = server.getsockname()[:2]
+        return f"tcp://{host}:{port}"
+
+    @staticmethod
+    def is_private(server):
+        """True if only this user can connect.  Any local process can connect to a TCP port, even on loopback."""
+        return False
+
+    @staticmethod
+    def close(server, location):
+        server.close()
+
+
+class UnixTransport:
+    @staticmethod
+    def listen(location):
+        if os.path.exists(location):
+            os.unlink(location)  # Left over by a previous run
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        server.bind(location)
+        os.chmod(location, 0o600)  # Owner only
+        server.listen()
+        return server
+
+    @staticmethod
+    def connect(location, timeout):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(timeout)
+        try:
+            sock.connect(location)
+        except OSError:
+            sock.close()
+            raise
+        return sock
+
+    @staticmethod
+    def address(server):
+        return f"unix://{server.getsockname()}"
+
+    @staticmethod
+    def is_private(server):
+        return not stat.S_IMODE(os.stat(server.getsockname()).st_mode) & 0o077
+
+    @staticmethod
+    def close(server, location):
+        server.close()
+        try:
+            os.unlink(location)
+        except OSError:
+            pass
+
+
+TRANSPORTS = {"tcp": TcpTransport, "unix": UnixTransport}  # Add a scheme here to plug in another transport
+
+
+def _transport(address):
+    scheme, sep, location = address.partition("://")
+    if not sep or scheme not in TRANSPORTS:
+        raise ValueError(f"Invalid address {address}.  Expected one of {', '.join(TRANSPORTS)}://...")
+    return TRANSPORTS[scheme], location
+
+
+#### Framing
+def _encode(messages):
+    """Return the parts of the frame of a batch of messages.  Buffers that support out-of-band pickling
+    (e.g. NumPy arrays, pickle.PickleBuffer) are sent as they are instead of being copied into the pickle."""
+    buffers = []
+    if _PROTOCOL >= 5:
+        data = pickle.dumps(messages, protocol=_PROTOCOL, buffer_callback=buffers.append)
+    else:
+        data = pickle.dumps(messages, protocol=_PROTOCOL)
+    parts = [_FRAME.pack(len(data), len(buffers)), data]
+    for buf in buffers:
+        raw = buf.raw()
+        parts.append(_BUFFER.pack(raw.nbytes))
+        parts.append(raw)
+    return parts
+
+
+def _send_parts(sock, parts):
+    small = []
+    for part in parts:
+        if len(part) < _SEND_JOIN_MAX:
+            small.append(part)
+            continue
+        if small:
+            sock.sendall(b"".join(small))
+            small = []
+        sock.sendall(part)
+    if small:
+        sock.sendall(b"".join(small))
+
+
+def _read_exact(rfile, size):
+    data = rfile.read(size)
+    if len(data) < size:
+        raise EOFError("Connection closed")
+    return data
+
+
+def _read_batch(rfile):
+    data_len, buf_cnt = _FRAME.unpack(_read_exact(rfile, _FRAME.size))
+    data = _read_exact(rfile, data_len)
+    if not buf_cnt:
+        return pickle.loads(data)
+    buffers = [_read_exact(rfile, _BUFFER.unpack(_read_exact(rfile, _BUFFER.size))[0]) for _ in range(buf_cnt)]
+    return pickle.loads(data, buffers=buffers)
+
+
+def _mac(auth_key, role, nonce):
+    if not auth_key:
+        return bytes(_MAC_SIZE)
+    return hmac.new(auth_key, role + nonce, hashlib.sha256).digest()
+
+
+#### Remote references
+class _NetReplyRef:
+    """Stands in for the return_q of a task sent to another node.  The reply is sent back to the node
+    that owns the return queue (see NetworkNode._portable)."""
+    def __init__(self, node_name, reply_id):
+        self.node_name = node_name
+        self.reply_id = reply_id
+
+    def put(self, item, block=True, timeout=None):
+        App.network._send_reply(self.node_name, self.reply_id, item, False)
+
+    def put_nowait(self, item):
+        self.put(item)
+
+    def set_exception(self, exc):
+        App.network._send_reply(self.node_name, self.reply_id, exc, True)
+
+
+class _RemoteQueue:
+    """The queue of an actor on another node (App.get_queue("node:actor")).  Items put here are sent to it."""
+    def __init__(self, network, peer, actor_name):
+        self.network = network
+        self.peer = peer
+        self.actor_name = actor_name
+
+    def put(self, item, block=True, timeout=None):
+        self.network._send(self.peer, ("put", self.actor_name, self.network._portable(item)), self.actor_name)
+
+    def put_nowait(self, item):
+        self.put(item)
+
+
+class _PeerLink:
+    """One pooled outbound connection to a peer, with its sender thread.
+    Messages are queued and sent in batches: every message queued while the previous batch was being sent goes
+    in the next one.  Under load (a send within the last linger_s), the sender also waits up to linger_s for a
+    batch to fill (Nagle style).  An idle link sends a message at once.
+    While the peer can't be reached, up to max_pending messages are kept and the connection is retried with
+    exponential backoff.  The messages of a batch whose send failed are lost (counted in lost_cnt)."""
+    def __init__(self, network, peer, idx):
+        self.network = network
+        self.peer = peer
+        self.idx = idx
+        self.sock = None
+        self.pending = collections.deque()
+        self.cond = threading.Condition()
+        self.closed = False
+        self.last_send = 0.0
+        self.sent_cnt = 0
+        self.batch_cnt = 0
+        self.dropped_cnt = 0  # Dropped because max_pending messages were waiting
+        self.lost_cnt = 0
+        self.connect_cnt = 0
+        self.thread = threading.Thread(target=self._sender, args=(), name=f"network_{peer}_{idx}", daemon=True)
+        self.thread.start()
+
+    def send(self, msg):
+        with self.cond:
+            if len(self.pending) >= self.network.max_pending:
+                self.pending.popleft()
+                self.dropped_cnt += 1
+            self.pending.append(msg)
+            if len(self.pending) == 1 or len(self.pending) == self.network.max_batch:
+                self.cond.notify()
+
+    def close(self):
+        with self.cond:
+            self.closed = True
+            self.cond.notify()
+        if self.thread is not threading.current_thread():
+            self.thread.join(timeout=5)
+
+    def _sender(self):
+        network = self.network
+        backoff = network.reconnect_min_s
+        while True:
+            with self.cond:
+                while not self.pending and not self.closed:
+                    self.cond.wait()
+                if not self.pending:
+                    break  # Closed and flushed
+                linger_s = network.linger_s
+                if (linger_s and len(self.pending) < network.max_batch
+                        and time.monotonic() - self.last_send < linger_s):
+                    self.cond.wait(linger_s)
+                pending = self.pending
+                batch = [pending.popleft() for _ in range(min(len(pending), network.max_batch))]
+            if self.sock is not None and not self._alive():
+                self._disconnect()
+            if self.sock is None and not self._connect():
+                with self.cond:
+                    self.pending.extendleft(reversed(batch))
+                    if self.closed:
+                        break
+                    self.cond.wait(backoff)
+                backoff = min(backoff * 2, network.reconnect_max_s)
+                continue
+            backoff = network.reconnect_min_s
+            try:
+                parts = network._encode_batch(batch)
+                if parts:
+                    _send_parts(self.sock, parts)
+            except OSError as e:
+                network.log(f"ERROR: Send to {self.peer} failed: {e}.  {len(batch)} messages lost", 0)
+                self.lost_cnt += len(batch)
+                self._disconnect()
+                continue
+            self.last_send = time.monotonic()
+            self.sent_cnt += len(batch)
+            self.batch_cnt += 1
+        self._disconnect()
+
+    def _connect(self):
+        network = self.network
+        address = network.peers.get(self.peer)
+        if address is None:
+            return False
+        try:
+            transport, location = _transport(address)
+            sock = transport.connect(location, network.connect_timeout_s)
+            rfile = sock.makefile("rb")
+            nonce = _read_exact(rfile, _NONCE_SIZE)
+            client_nonce = os.urandom(_NONCE_SIZE)
+            hello = json.dumps({"node": network.node_name, "address": network.address}).encode("utf-8")
+            sock.sendall(_LEN.pack(_MAC_SIZE + _NONCE_SIZE + len(hello)) + _mac(network.auth_key, _CLIENT, nonce)
+                         + client_nonce + hello)
+            if rfile.read(1) != _ACCEPTED:
+                sock.close()
+                network.log(f"ERROR: Connection refused by {self.peer} at {address}.  Check auth_key.", 0)
+                return False
+            if not hmac.compare_digest(_read_exact(rfile, _MAC_SIZE), _mac(network.auth_key, _SERVER, client_nonce)):
+                sock.close()
+                network.log(f"ERROR: {self.peer} at {address} failed to authenticate.  Check auth_key.", 0)
+                return False
+            sock.settimeout(None)
+            rfile.close()
+            if self.idx == 0:
+                resubscribe = network._resubscribe_msgs(self.peer)  # The peer may have restarted
+                if resubscribe:
+                    _send_parts(sock, _encode(resubscribe))
+        except (OSError, EOFError, ValueError) as e:
+            network.log(f"Can't connect to {self.peer} at {address}: {e}", 3)
+            return False
+        self.sock = sock
+        self.connect_cnt += 1
+        network.log(f"Connected to {self.peer} at {address} (link {self.idx})", 1)
+        return True
+
+    def _alive(self):
+        """The peer never sends on an outbound connection, so a readable socket means it was closed.
+        Checked before each batch: the first send to a closed connection would still succeed and be lost."""
+        try:
+            readable, _, _ = select.select([self.sock], [], [], 0)
+            return not readable or self.sock.recv(1, socket.MSG_PEEK) != b""
+        except (OSError, ValueError):
+            return False
+
+    def _disconnect(self):
+        if self.sock is not None:
+            try:
+                self.sock.close()
+            except OSError:
+                pass
+            self.sock = None
+
+    def stats(self):
+        with self.cond:
+            pending = len(self.pending)
+        return {"connected": self.sock is not None, "connects": self.connect_cnt, "sent": self.sent_cnt,
+                "batches": self.batch_cnt, "pending": pending, "dropped": self.dropped_cnt, "lost": self.lost_cnt}
+
+
+class NetworkNode(Actor):
+    """This class connects the app to other nodes (processes or machines), so actors can reach the actors of
+    another node by qualified name: <node>:<actor>.  It is started by AppMgr.init_network() as App.network.
+        App.get_queue("node_b:dmm1") returns a queue that sends to actor dmm1 of node_b, so enqueue, send_data,
+        query and task_query work as usual.  Queries get their reply (or exception) back over the network.
+        subscribe("node_b:rack1/+/voltage", ...) subscribes to topics published on node_b, and
+        publish("node_b:topic", data) publishes on node_b.  Remote subscriptions are made again when the
+        connection to the peer is made again, so they survive a restart of the peer.
+        Conflated subscriptions are not conflated across the network.
+    Addresses are <scheme>://<location> with a transport from TRANSPORTS: tcp://host:port or unix://path.
+    Each peer has a pool of pool_size outbound connections (messages to one actor always use the same one, so
+    they stay in order).  Messages are batched into frames of pickled lists (see _PeerLink).
+    Messages are pickled: only connect trusted nodes, and set an auth_key (shared secret) to authenticate them.
+    Both ends of a connection prove they hold the auth_key (HMAC challenge each way).  Listening without an
+    auth_key is refused, except on a unix socket only this user can open.
+    A peer can put tasks on the local actors, but not on the service actors (_SERVICE_QUEUES), and can only call
+    the services in _REMOTE_CALLS.  A received message that can't be delivered (refused, unknown actor, full
+    mailbox) is logged and counted in failed_cnt.  It never waits for a full mailbox.
+    A node that does not listen can send to its peers, but can't receive replies or remote subscriptions:
+    query and subscribe to a peer raise.
+    Before Python 3.8, messages use pickle protocol 4 without out-of-band buffers, which 3.8+ nodes can read
+    but not send to.
+    """
+    def __init__(self, node_name, listen=None, peers=None, auth_key=None, pool_size=1, max_batch=1000,
+                 linger_s=0.0005, max_pending=100000, reconnect_min_s=0.05, reconnect_max_s=5.0,
+                 connect_timeout_s=5.0, log_level=0):
+        self.name = "network"
+        self.node_name = node_name
+        self.peers = dict(peers or {})  # key = node name, value = address
+        self.auth_key = auth_key.encode("utf-8") if isinstance(auth_key, str) else auth_key
+        self.pool_size = pool_size
+        self.max_batch = max_batch
+        self.linger_s = linger_s
+        self.max_pending = max_pending
+        self.reconnect_min_s = reconnect_min_s
+        self.reconnect_max_s = reconnect_max_s
+        self.connect_timeout_s = connect_timeout_s
+        self.address = None  # Address this node listens on
+        self._server = None
+        self._server_location = None
+        self._transport = None
+        self._links = {}  # key = peer name, value = list of _PeerLink
+        self._remote_queues = {}  # key = qualified name, value = _RemoteQueue
+        self._remote_subs = {}  # key = peer name, value = {(topic, subs_id): add_subscription message}
+        self._subs_ids = itertools.count(1)
+        self._pending_replies = weakref.WeakValueDictionary()  # key = reply id, value = local return queue
+        self._reply_ids = itertools.count()
+        self._inbound = set()  # Accepted sockets
+        self.failed_cnt = 0  # Messages received from peers that could not be delivered
+        self._net_lock = threading.Lock()
+        self._closing = False
+        super().__init__(self.name, log_level=log_level)
+        if listen is not None:
+            try:
+                self._listen(listen)
+            except Exception:
+                self.stop()
+                raise
+
+    #### Server side
+    def _listen(self, address):
+        self._transport, self._server_location = _transport(address)
+        self._server = self._transport.listen(self._server_location)
+        if not self.auth_key and not getattr(self._transport, "is_private", lambda server: False)(self._server):
+            self._transport.close(self._server, self._server_location)
+            self._server = None
+            raise ValueError(f"Refusing to listen on {address} without an auth_key: messages are pickled, so any "
+                             f"process that can connect could run code here.  Set an auth_key, or listen on a "
+                             f"unix socket only this user can open.")
+        self.address = self._transport.address(self._server)
+        threading.Thread(target=self._accept_loop, args=(), name="network_accept", daemon=True).start()
+        self.log(f"Node {self.node_name} listening on {self.address}", 1)
+
+    def _accept_loop(self):
+        while not self._closing:
+            try:
+                sock, _ = self._server.accept()
+            except OSError:
+                break
+            threading.Thread(target=self._serve, args=(sock,), name="network_in", daemon=True).start()
+
+    def _serve(self, sock):
+        """Authenticate a connection from a peer, then deliver the batches it sends"""
+        with self._net_lock:
+            self._inbound.add(sock)
+        peer = None
+        try:
+            rfile = sock.makefile("rb")
+            nonce = os.urandom(_NONCE_SIZE)
+            sock.sendall(nonce)
+            hello_len = _LEN.unpack(_read_exact(rfile, _LEN.size))[0]
+            if not _MAC_SIZE + _NONCE_SIZE <= hello_len <= _MAX_HELLO:
+                raise ValueError(f"Invalid hello length {hello_len}")
+            hello = _read_exact(rfile, hello_len)
+            if not hmac.compare_digest(hello[:_MAC_SIZE], _mac(self.auth_key, _CLIENT, nonce)):
+                raise ValueError("Authentication failed")
+            client_nonce = hello[_MAC_SIZE:_MAC_SIZE + _NONCE_SIZE]
+            info = json.loads(hello[_MAC_SIZE + _NONCE_SIZE:])
+            sock.sendall(_ACCEPTED + _mac(self.auth_key, _SERVER, client_nonce))
+            peer = info["node"]
+            if info.get("address") and peer not in self.peers:
+                self.add_peer(peer, info["address"])  # To send replies back
+            self.log(f"Peer {peer} connected", 1)
+            while True:
+                for msg in _read_batch(rfile):
+                    try:
+                        self._handle(peer, msg)
+                    except Exception as e:  # Only this message is lost, not the rest of the batch or connection
+                        self.failed_cnt += 1
+                        self.log(f"ERROR: {msg[0]} message from {peer} failed: {e}", 0)
+        except (EOFError, OSError):
+            pass
+        except Exception as e:
+            self.log(f"ERROR: Connection from {peer or 'unknown peer'} closed: {e}", 0)
+        finally:
+            with self._net_lock:
+                self._inbound.discard(sock)
+            try:
+                sock.close()
+            except OSError:
+                pass
+        if peer is not None and not self._closing:
+            self.log(f"Peer {peer} disconnected", 1)
+
+    def _handle(self, peer, msg):
+        """Deliver a message from a peer.  Raises if it can't be delivered (see _serve)."""
+        kind = msg[0]
+        if kind == "put":
+            dest, item = msg[1], msg[2]
+            if dest in _SERVICE_QUEUES or type(item) is not tuple or type(item[0]) is not str:
+                raise ValueError(f"Refused put of {item[0] if type(item) is tuple else item!r} on {dest}")
+            dest_q = App.queues.get(dest)  # Local actors only
+            if dest_q is None:
+                raise ValueError(f"dest_q {dest} does not exist")
+            if dest_q.put(item, False) is False:  # Never waits on a full mailbox: this thread serves the peer
+                raise queue.Full(f"Mailbox {dest} is full.  {item[0]} dropped")
+        elif kind == "reply":
+            self._resolve_reply(*msg[1:])
+        elif kind == "call":
+            _, service_name, method_name, args, kwargs = msg
+            service = getattr(App, service_name, None)
+            if (service_name, method_name) not in _REMOTE_CALLS or service is None:
+                raise ValueError(f"Refused call {service_name}.{method_name}")
+            getattr(service, method_name)(*args, **kwargs)
+
+    #### Client side
+    def add_peer(self, node_name, address):
+        """Add or change the address of a node.  Connections are made when the first message is sent."""
+        _transport(address)  # Validate
+        with self._net_lock:
+            self.peers[node_name] = address
+
+    def split(self, name):
+        """Return (node, local name) of a qualified name, or None if it is not one (node unknown)"""
+        node, sep, local = name.partition(NODE_SEP)
+        if sep and (node in self.peers or node == self.node_name):
+            return node, local
+        return None
+
+    def is_remote(self, name):
+        split = self.split(name)
+        return split is not None and split[0] != self.node_name
+
+    def remote_queue(self, name):
+        """Return the queue of a qualified actor name (see App.get_queue), or None"""
+        split = self.split(name)
+        if split is None:
+            return None
+        node, actor_name = split
+        if node == self.node_name:
+            return App.queues.get(actor_name)
+        remote_q = self._remote_queues.get(name)
+        if remote_q is None:
+            remote_q = self._remote_queues.setdefault(name, _RemoteQueue(self, node, actor_name))
+        return remote_q
+
+    def _link(self, peer, key):
+        links = self._links.get(peer)
+        if links is None:
+            with self._net_lock:
+                links = self._links.get(peer)
+                if links is None:
+                    links = self._links[peer] = [_PeerLink(self, peer, i) for i in range(self.pool_size)]
+        return links[hash(key) % len(links)] if key is not None and len(links) > 1 else links[0]
+
+    def _send(self, peer, msg, key=None):
+        """Queue a message to a peer.  Messages with the same key use the same connection, so they stay in order.
+        Calls and replies have no key."""
+        if self._closing:
+            return
+        if peer not in self.peers:  # e.g. a node that does not listen.  A link would retry forever.
+            self.log(f"ERROR: No address for node {peer}.  {msg[0]} message dropped", 0)
+            return
+        self._link(peer, key).send(msg)
+
+    def _encode_batch(self, batch):
+        try:
+            return _encode(batch)
+        except Exception:
+            pass
+        portable = []
+        for msg in batch:  # Find the messages that can't be pickled
+            try:
+                pickle.dumps(msg, protocol=_PROTOCOL)
+            except Exception as e:
+                self.log(f"ERROR: Can't send {msg[0]} message {msg[1]}: {e}", 0)
+            else:
+                portable.append(msg)
+        return _encode(portable) if portable else None
+
+    def _portable(self, item):
+        """Replace the return_q of a task item with a _NetReplyRef, so the reply comes back to this node"""
+        if type(item) is tuple and len(item) == 3 and isinstance(item[2], dict):
+            return_q = item[2].get("return_q")
+            if return_q is not None and not isinstance(return_q, _NetReplyRef):
+                if self.address is None:
+                    raise QueryError(f"Node {self.node_name} does not listen, so replies can't reach it.  "
+                                     f"Start it with listen (App.cfg['node_listen']).")
+                reply_id = next(self._reply_ids)
+                self._pending_replies[reply_id] = return_q
+                return item[0], item[1], dict(item[2], return_q=_NetReplyRef(self.node_name, reply_id))
+        return item
+
+    def _send_reply(self, node_name, reply_id, item, failed):
+        if node_name == self.node_name:
+            self._resolve_reply(reply_id, item, failed)
+        else:
+            self._send(node_name, ("reply", reply_id, item, failed))
+
+    def _resolve_reply(self, reply_id, item, failed):
+        return_q = self._pending_replies.pop(reply_id, None)
+        if return_q is None:
+            return  # Query already gone
+        if failed:
+            set_exception = getattr(return_q, "set_exception", None)
+            if set_exception is not None:
+                set_exception(item)
+        else:
+            return_q.put(item)
+
+    #### Remote publish/subscribe
+    def subscribe_remote(self, qualified_topic, dest_q, task_method, subs_id=None, **kwargs):
+        """Subscribe the local actor dest_q to a topic of another node (<node>:<topic>)"""
+        peer, topic = self.split(qualified_topic)
+        if self.address is None:
+            raise ValueError(f"Node {self.node_name} does not listen, so {peer} can't deliver {topic} to it.  "
+                             f"Start it with listen (App.cfg['node_listen']).")
+        if subs_id is None:
+            subs_id = f"{self.node_name}{NODE_SEP}{dest_q}_{next(self._subs_ids)}"
+        msg = ("call", "subs_mgr", "add_subscription", (topic, f"{self.node_name}{NODE_SEP}{dest_q}", task_method),
+               dict(kwargs, subs_id=subs_id))
+        with self._net_lock:
+            self._remote_subs.setdefault(peer, {})[(topic, subs_id)] = msg
+        self._send(peer, msg)
+        return subs_id
+
+    def unsubscribe_remote(self, qualified_topic, subs_id):
+        peer, topic = self.split(qualified_topic)
+        with self._net_lock:
+            self._remote_subs.get(peer, {}).pop((topic, subs_id), None)
+        self._send(peer, ("call", "subs_mgr", "unsubscribe", (topic, subs_id), {}))
+
+    def publish_remote(self, qualified_topic, data):
+        """Publish on the subscription manager of another node"""
+        peer, topic = self.split(qualified_topic)
+        self._send(peer, ("call", "subs_mgr", "_publish", (topic, data), {}), topic)
+
+    def _resubscribe_msgs(self, peer):
+        with self._net_lock:
+            return list(self._remote_subs.get(peer, {}).values())
+
+    def get_stats(self):
+        """Return {peer: [stats of each pooled connection]}"""
+        with self._net_lock:
+            links = dict(self._links)
+        return {peer: [link.stats() for link in peer_links] for peer, peer_links in links.items()}
+
+    def stop(self):
+        """Send what is queued, close the connections and stop listening"""
+        self._closing = True
+        with self._net_lock:
+            links = [link for peer_links in self._links.values() for link in peer_links]
+            inbound = list(self._inbound)
+        for link in links:
+            link.close()
+        if self._server is not None:
+            self._transport.close(self._server, self._server_location)
+            self._server = None
+        for sock in inbound:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+        super().stop()
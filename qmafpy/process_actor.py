@@ -0,0 +1,390 @@
+import functools
+import itertools
+import multiprocessing
+import pickle
+import struct
+import sys
+import threading
+import weakref
+from .actor import Actor
+from .globals import App
+
+_PROTOCOL = min(5, pickle.HIGHEST_PROTOCOL)
+
+# Process wide state.  In the parent, _process_owner is None.  In a child, it is the name of the actor it runs.
+_process_owner = None
+_child_channel = None  # Child only: channel to the parent
+_handles = {}  # Parent only: key = actor name, value = ProcessActor handle
+_pending_replies = weakref.WeakValueDictionary()  # key = reply id, value = local return queue
+_reply_ids = itertools.count()
+
+
+class _Channel:
+    """One direction of a pipe.  Messages are pickled with protocol 5.  Buffers that support out-of-band
+    pickling (e.g. NumPy arrays, pickle.PickleBuffer) are sent as separate frames instead of being copied
+    into the pickle stream."""
+    def __init__(self, conn):
+        self.conn = conn
+        self.lock = threading.Lock()  # Several threads may send
+
+    def send(self, msg):
+        buffers = []
+        if _PROTOCOL >= 5:
+            data = pickle.dumps(msg, protocol=_PROTOCOL, buffer_callback=buffers.append)
+        else:
+            data = pickle.dumps(msg, protocol=_PROTOCOL)
+        with self.lock:
+            self.conn.send_bytes(struct.pack("<I", len(buffers)) + data)
+            for buf in buffers:
+                self.conn.send_bytes(buf.raw())
+
+    def recv(self):
+        data = self.conn.recv_bytes()
+        buf_cnt = struct.unpack_from("<I", data)[0]
+        if buf_cnt:
+            buffers = [self.conn.recv_bytes() for _ in range(buf_cnt)]
+            return pickle.loads(memoryview(data)[4:], buffers=buffers)
+        return pickle.loads(memoryview(data)[4:])
+
+    def close(self):
+        try:
+            self.conn.close()
+        except OSError:
+            pass
+
+
+class _ReplyRef:
+    """Stands in for a task_query return queue when the query crosses a process boundary.
+    The task calls put() as usual and the value is routed back to the process that owns the queue."""
+    def __init__(self, owner, reply_id):
+        self.owner = owner
+        self.reply_id = reply_id
+
+    def put(self, item, block=True, timeout=None):
+        _route_reply(self.owner, self.reply_id, item)
+
+    def put_nowait(self, item):
+        self.put(item)
+
+
+class _QueryReplyRef(_ReplyRef):
+    """_ReplyRef for the reply of an Actor.query.  The task's return value or exception is routed back too."""
+    def set_exception(self, exc):
+        _route_reply(self.owner, self.reply_id, exc, True)
+
+
+def _route_reply(owner, reply_id, item, failed=False):
+    if owner == _process_owner:
+        return_q = _pending_replies.get(reply_id)
+        if return_q is not None:
+            if failed:
+                return_q.set_exception(item)
+            else:
+                return_q.put(item)
+    elif _child_channel is not None:
+        _child_channel.send(("reply", owner, reply_id, item, failed))  # The parent routes it on
+    else:
+        handle = _handles.get(owner)
+        if handle is not None:
+            handle._send(("reply", owner, reply_id, item, failed))
+
+
+def _portable(item):
+    """Replace a local return queue (a queue or a query reply) in a task item with a _ReplyRef that can be pickled."""
+    if type(item) is tuple and len(item) == 3 and isinstance(item[2], dict):
+        return_q = item[2].get("return_q")
+        if return_q is not None and not isinstance(return_q, _ReplyRef):
+            reply_id = next(_reply_ids)
+            _pending_replies[reply_id] = return_q
+            ref_cls = _QueryReplyRef if hasattr(return_q, "set_exception") else _ReplyRef
+            kwargs = dict(item[2], return_q=ref_cls(_process_owner, reply_id))
+            return item[0], item[1], kwargs
+    return item
+
+
+class _ProcessQueue:
+    """Parent side: the App queue of a ProcessActor.  Items put here are sent to the child process."""
+    def __init__(self, handle):
+        self.handle = handle
+
+    def put(self, item, block=True, timeout=None):
+        self.handle._send(("put", _portable(item)))
+
+    def put_nowait(self, item):
+        self.put(item)
+
+
+class _ForwardQueue:
+    """Child side: any queue that is not local to the child.  Items are forwarded to the parent, which puts
+    them in the parent's queue of that name."""
+    def __init__(self, name):
+        self.name = name
+
+    def put(self, item, block=True, timeout=None):
+        _child_channel.send(("put", self.name, _portable(item)))
+
+    def put_nowait(self, item):
+        self.put(item)
+
+
+class _ChildQueues(dict):
+    """Child side App.queues.  Names that are not local resolve to a _ForwardQueue."""
+    def get(self, name, default=None):
+        if name in self:
+            return self[name]
+        return _ForwardQueue(name)
+
+
+class _ServiceProxy:
+    """Child side stand-in for a parent service (App.subs_mgr, App.scheduler, App.logger).
+    Method calls are forwarded to the parent.  They do not return a value."""
+    def __init__(self, service_name):
+        self.service_name = service_name
+
+    def __getattr__(self, method_name):
+        def call(*args, **kwargs):
+            _child_channel.send(("call", self.service_name, method_name, args, kwargs))
+        return call
+
+
+def _child_main(cls, name, init_args, init_kwargs, cfg, in_conn, out_conn):
+    """Child process entry point.  Builds the actor and relays messages from the parent to it."""
+    global _process_owner, _child_channel
+    _process_owner = name
+    _child_channel = _Channel(out_conn)
+    in_channel = _Channel(in_conn)
+    # Start from a clean App, as a spawned child does.  A forked child inherits copies of the parent's queues,
+    # locks and services, whose threads (event loop, network, recorder, watchdog, executor workers) did not fork.
+    App.cfg = cfg
+    App.lock = threading.RLock()
+    App.data = {}
+    App.log_levels = {}
+    App.queues = _ChildQueues()
+    App.cfg_mgr = None
+    App.subs_mgr = _ServiceProxy("subs_mgr")
+    App.scheduler = _ServiceProxy("scheduler")
+    App.logger = _ServiceProxy("logger")
+    App.executor = None
+    App.async_loop = None
+    App.metrics = None
+    App.watchdog = None
+    App.recorder = None
+    App.network = None
+    actor = cls(*init_args, **init_kwargs)
+    while True:
+        try:
+            msg = in_channel.recv()
+        except (EOFError, OSError):
+            break  # Parent is gone
+        kind = msg[0]
+        if kind == "put":
+            actor.q.put(msg[1])
+        elif kind == "reply":
+            _route_reply(*msg[1:])
+        elif kind == "stop":
+            break
+    shm_ring = sys.modules.get(f"{__package__}.shm_ring")
+    if shm_ring is not None:
+        shm_ring.close_rings()  # Children exit without running atexit handlers
+    _child_channel.close()
+
+
+def _child_side(method):
+    """Wrap an Actor method that reaches other actors or the parent's services (subscribe, publish, enqueue,
+    scheduling).  A ProcessActor's constructor runs in the parent too, to build the handle.  The calls it
+    makes there are skipped, since the child makes them when it runs the same constructor."""
+    @functools.wraps(method)
+    def call(self, *args, **kwargs):
+        if self._constructing and _process_owner != self.name:
+            return None
+        return method(self, *args, **kwargs)
+    return call
+
+
+class _ProcessActorType(type):
+    """Metaclass of ProcessActor.  Ends the construction of the handle, then starts the child process."""
+    def __call__(cls, *args, **kwargs):
+        self = super().__call__(*args, **kwargs)
+        self._constructing = False
+        if self._start_when_built:
+            self.run()
+        return self
+
+
+class ProcessActor(Actor, metaclass=_ProcessActorType):
+    """An actor whose task loop runs in a child process, so CPU heavy tasks do not hold the parent's GIL.
+        In the parent, the actor is a handle:
+            Its App queue sends items to the child, so enqueue, send_data, App.get_queue and
+            task_query reach it by name as usual.
+            A relay thread delivers what the child sends: enqueues to other actors, publish/subscribe and
+            scheduler calls, log messages and task_query replies.
+            If the child dies unexpectedly, it is restarted up to max_restarts times (restart=True).
+                Messages in flight when it died are lost.
+        In the child, the same class runs as a regular Actor.
+        Subclasses must be importable by the child (module level), and the constructor arguments must be
+        picklable.  Tasks are sent by name.  Calls made to parent services return no value.
+        The constructor runs in both processes.  In the parent, the subscribe, publish, enqueue and scheduling
+        calls it makes are skipped (the child makes them), and the process starts once it has returned.
+    """
+    def __new__(cls, *args, **kwargs):
+        self = super().__new__(cls)
+        self._init_args = (args, kwargs)  # Used to build the actor again in the child
+        self._constructing = True
+        self._start_when_built = False
+        return self
+
+    def __init__(self, name: str, log_level=0, auto_start=True, restart=True, max_restarts=3):
+        if _process_owner == name:
+            # In the child process
+            super().__init__(name, log_level=log_level, auto_start=auto_start)
+            return
+        self.restart = restart
+        self.max_restarts = max_restarts
+        self.restart_cnt = 0
+        self.process = None
+        self._channel = None
+        self._relay_thread = None
+        self._stopping = False
+        _handles[name] = self
+        super().__init__(name, log_level=log_level, auto_start=False)
+        self._start_when_built = auto_start
+
+    def _create_queue(self, mailbox_options):
+        if self.is_child():
+            return super()._create_queue(mailbox_options)
+        q = _ProcessQueue(self)  # Sends to the child
+        App.add_queue(self.name, q)
+        return q
+
+    def is_child(self):
+        """Return True when running in the child process"""
+        return _process_owner == self.name
+
+    def _send(self, msg):
+        with self.lock:
+            channel = self._channel
+        if channel is None:
+            self.log(f"ERROR: Process is not running.  Dropped {msg[0]} message", 0)
+            return
+        try:
+            channel.send(msg)
+        except (OSError, ValueError) as e:
+            self.log(f"ERROR: Send to process failed: {e}", 0)
+
+    def run(self):
+        """Start the child process (or, in the child, the dequeue loop)"""
+        if self.is_child():
+            return super().run()
+        with self.lock:
+            if self._running:
+                self.log("Can't run process.  It is already running.", 5)
+                return
+            self._stopping = False
+            self._spawn()
+
+    def _spawn(self):
+        ctx = multiprocessing.get_context(App.cfg.get("process_start_method"))
+        child_in, parent_out = ctx.Pipe(duplex=False)
+        parent_in, child_out = ctx.Pipe(duplex=False)
+        args, kwargs = self._init_args
+        self.process = ctx.Process(target=_child_main, name=f"qmafpy-{self.name}", daemon=True,
+                                   args=(type(self), self.name, args, kwargs, dict(App.cfg), child_in, child_out))
+        self.process.start()
+        # Close the child's ends here so a dead child shows up as EOF on the relay
+        child_in.close()
+        child_out.close()
+        self._channel = _Channel(parent_out)
+        self._running = True
+        self._relay_thread = threading.Thread(target=self._relay, args=(_Channel(parent_in), self.process),
+                                              daemon=True)
+        self._relay_thread.start()
+        self.log(f"Process started pid={self.process.pid}", 1)
+
+    def _relay(self, in_channel, process):
+        """Parent side.  Deliver messages from the child until it exits, then restart it if it crashed."""
+        exited = False
+        while True:
+            try:
+                msg = in_channel.recv()
+            except (EOFError, OSError):
+                break
+            kind = msg[0]
+            try:
+                if kind == "put":
+                    dest_q = App.get_queue(msg[1])
+                    if dest_q is not None:
+                        dest_q.put(msg[2])
+                    else:
+                        self.log(f"ERROR: dest_q does not exist.  Enqueue dest={msg[1]}", 0)
+                elif kind == "reply":
+                    _route_reply(*msg[1:])
+                elif kind == "call":
+                    self._call_service(*msg[1:])
+                elif kind == "exited":
+                    exited = True
+                    self._send(("stop",))
+                    break
+            except Exception as e:
+                self.log(f"ERROR: Exception relaying {kind} message from process: {e}", 0)
+        in_channel.close()
+        process.join(timeout=5)
+        with self.lock:
+            if self.process is not process:
+                return  # Already replaced
+            self._channel.close()
+            self._channel = None
+            self._running = False
+            if exited or self._stopping:
+                self.log("Process exited", 1)
+                return
+            self.log(f"ERROR: Process exited unexpectedly.  exitcode={process.exitcode}", 0)
+            if self.restart and self.restart_cnt < self.max_restarts:
+                self.restart_cnt += 1
+                self.log(f"Restarting process ({self.restart_cnt} of {self.max_restarts})", 0)
+                self._spawn()
+
+    def _call_service(self, service_name, method_name, args, kwargs):
+        service = getattr(App, service_name, None)
+        if service is None:
+            if service_name == "logger" and method_name == "log_record":
+                print(f"{args[0]} {args[2]}")
+            return
+        getattr(service, method_name)(*args, **kwargs)
+
+    @_child_side
+    def subscribe(self, topic: str, callback_method, **kwargs):
+        """Subscribe by task name, since the child's bound methods cannot be sent to the parent"""
+        if callable(callback_method):
+            callback_method = callback_method.__name__
+        super().subscribe(topic, callback_method, **kwargs)
+
+    publish = _child_side(Actor.publish)
+    publish_shared = _child_side(Actor.publish_shared)
+    publish_many = _child_side(Actor.publish_many)
+    send_data = _child_side(Actor.send_data)
+    enqueue = _child_side(Actor.enqueue)
+    enqueue_priority = _child_side(Actor.enqueue_priority)
+    enqueue_conflated = _child_side(Actor.enqueue_conflated)
+    sched_local = _child_side(Actor.sched_local)
+    sched = _child_side(Actor.sched)
+    sched_del_item = _child_side(Actor.sched_del_item)
+
+    def is_alive(self):
+        return self.process is not None and self.process.is_alive()
+
+    def stop(self):
+        if self.is_child():
+            super().stop()
+            _child_channel.send(("exited",))
+            return
+        with self.lock:
+            self._stopping = True
+            process = self.process
+        if process is not None and process.is_alive():
+            self._send(("put", ("exit", (), {})))
+            process.join(timeout=5)
+            if process.is_alive():
+                self.log("ERROR: Process did not exit.  Terminating it.", 0)
+                process.terminate()
+        if self._relay_thread is not None and self._relay_thread is not threading.current_thread():
+            self._relay_thread.join(timeout=5)
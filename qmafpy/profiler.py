@@ -0,0 +1,176 @@
+import collections
+import cProfile
+import json
+import os
+import pstats
+import random
+import re
+import sys
+import threading
+import time
+from .globals import App
+
+_MAX_STACK_DEPTH = 64
+_SLOW_TASKS_KEPT = 100
+
+
+class _Running:
+    """A task being performed by a profiled actor"""
+    __slots__ = ("task", "start", "threshold_s", "stacks", "profile", "outer", "sampler")
+
+    def __init__(self, task, start, threshold_s, profile):
+        self.task = task
+        self.outer = None  # _Running of the task this one is nested in (e.g. receive_publications)
+        self.sampler = None
+        self.start = start
+        self.threshold_s = threshold_s
+        self.stacks = None  # Counter of sampled stacks once the task is past its threshold
+        self.profile = profile  # cProfile.Profile when the task is sampled
+
+
+class _StackSampler:
+    """One thread for the process.  While a profiled task runs past its slow threshold, the stack of its thread is
+    sampled every interval_s.  Costs nothing to tasks that finish in time."""
+    def __init__(self, interval_s):
+        self.interval_s = interval_s
+        self.running = {}  # key = thread id, value = _Running
+        self.lock = threading.Lock()
+        self.thread = threading.Thread(target=self._sample_loop, args=(), name="task_stack_sampler", daemon=True)
+        self.thread.start()
+
+    def _sample_loop(self):
+        while True:
+            time.sleep(self.interval_s)
+            now = time.perf_counter()
+            with self.lock:
+                slow = [(tid, running) for tid, running in self.running.items()
+                        if now - running.start > running.threshold_s]
+            if not slow:
+                continue
+            frames = sys._current_frames()
+            for tid, running in slow:
+                frame = frames.get(tid)
+                if frame is None:
+                    continue
+                stack = []
+                while frame is not None and len(stack) < _MAX_STACK_DEPTH:
+                    code = frame.f_code
+                    stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})")
+                    frame = frame.f_back
+                stack.reverse()
+                if running.stacks is None:
+                    running.stacks = collections.Counter()
+                running.stacks[tuple(stack)] += 1
+
+
+_sampler = None
+_sampler_lock = threading.Lock()
+
+
+def _get_sampler():
+    global _sampler
+    with _sampler_lock:
+        if _sampler is None:
+            _sampler = _StackSampler(App.cfg.get("profile_sample_interval_s", 0.005))
+        return _sampler
+
+
+class ActorProfiler:
+    """Opt-in profiling of an actor's tasks (see Actor.set_profiling).
+        sample_rate: fraction of tasks run under cProfile.  Their stats are aggregated per task name.
+        slow_threshold_s: a task running longer than this is captured.  Its stack is sampled while it runs,
+            and its duration and arguments are kept.
+        write() saves the results in App.cfg["results_dir"]/profiles/<actor name>/:
+            <task>.prof: aggregated cProfile stats (load with pstats)
+            <task>.slow.folded: sampled stacks of slow runs, one "frame;frame;... count" line per stack
+                (flame graph input)
+            summary.json: task counts and the most recent slow runs
+    """
+    def __init__(self, name, sample_rate=0.0, slow_threshold_s=None):
+        self.name = name
+        self.task_cnt = collections.Counter()  # key = task name
+        self.profiled_cnt = collections.Counter()
+        self.stats = {}  # key = task name, value = pstats.Stats
+        self.slow_stacks = {}  # key = task name, value = Counter of stacks
+        self.slow_tasks = collections.deque(maxlen=_SLOW_TASKS_KEPT)
+        self._lock = threading.Lock()  # Pooled actors end tasks on several threads
+        self.configure(sample_rate, slow_threshold_s)
+
+    def configure(self, sample_rate=0.0, slow_threshold_s=None):
+        """Change the settings.  Results collected so far are kept."""
+        self.sample_rate = sample_rate
+        self.slow_threshold_s = slow_threshold_s
+        self._sampler = _get_sampler() if slow_threshold_s is not None else None
+
+    def begin(self, task):
+        """Called before a task is performed.  Returns the state to pass to end()."""
+        profile = None
+        if self.sample_rate and random.random() < self.sample_rate:
+            profile = cProfile.Profile()
+        threshold_s = self.slow_threshold_s if self.slow_threshold_s is not None else float("inf")
+        running = _Running(task, time.perf_counter(), threshold_s, profile)
+        sampler = running.sampler = self._sampler
+        if sampler is not None:
+            with sampler.lock:
+                running.outer = sampler.running.get(threading.get_ident())
+                sampler.running[threading.get_ident()] = running
+        if profile is not None:
+            try:
+                profile.enable()
+            except ValueError:
+                running.profile = None  # Another profiler is active on this thread
+        return running
+
+    def end(self, running, task_data):
+        """Called after the task, with the state returned by begin()"""
+        duration_s = time.perf_counter() - running.start
+        if running.profile is not None:
+            running.profile.disable()
+        sampler = running.sampler
+        if sampler is not None:
+            with sampler.lock:
+                if running.outer is not None:
+                    sampler.running[threading.get_ident()] = running.outer
+                else:
+                    sampler.running.pop(threading.get_ident(), None)
+        task = running.task if type(running.task) == str else getattr(running.task, "__name__", str(running.task))
+        with self._lock:
+            self.task_cnt[task] += 1
+            if running.profile is not None:
+                self.profiled_cnt[task] += 1
+                if task in self.stats:
+                    self.stats[task].add(running.profile)
+                else:
+                    self.stats[task] = pstats.Stats(running.profile)
+            if duration_s >= running.threshold_s:
+                self.slow_tasks.append({"task": task, "time": time.time(), "duration_s": duration_s,
+                                        "args": repr(task_data[1])[:200], "kwargs": repr(task_data[2])[:200],
+                                        "profiled": running.profile is not None})
+                if running.stacks:
+                    self.slow_stacks.setdefault(task, collections.Counter()).update(running.stacks)
+
+    def write(self, results_dir=None):
+        """Save the results (see class doc) and return the directory, or None if there is nothing to save"""
+        if results_dir is None:
+            results_dir = App.cfg.get("results_dir", "results")
+        with self._lock:
+            if not self.task_cnt:
+                return None
+            profile_dir = os.path.join(results_dir, "profiles", self.name)
+            os.makedirs(profile_dir, exist_ok=True)
+            for task, stats in self.stats.items():
+                stats.dump_stats(os.path.join(profile_dir, f"{_file_name(task)}.prof"))
+            for task, stacks in self.slow_stacks.items():
+                with open(os.path.join(profile_dir, f"{_file_name(task)}.slow.folded"), "w") as f:
+                    for stack, cnt in stacks.most_common():
+                        f.write(f"{';'.join(stack)} {cnt}\n")
+            summary = {"actor": self.name, "sample_rate": self.sample_rate, "slow_threshold_s": self.slow_threshold_s,
+                       "tasks": dict(self.task_cnt), "profiled": dict(self.profiled_cnt),
+                       "slow_tasks": list(self.slow_tasks)}
+            with open(os.path.join(profile_dir, "summary.json"), "w") as f:
+                json.dump(summary, f, indent=2)
+        return profile_dir
+
+
+def _file_name(task):
+    return re.sub(r"[^\w.-]", "_", task)
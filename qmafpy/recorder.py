@@ -0,0 +1,360 @@
+import argparse
+import atexit
+import collections
+import os
+import pickle
+import struct
+import threading
+import time
+from .actor import current_actor
+from .globals import App
+from .histogram import Histogram
+
+_MAGIC = b"QMAFREC1"
+_BLOCK = struct.Struct("<I")  # Length of the block that follows: a pickled list of records
+REPLY = "<reply>"  # Stands in for the return_q of a recorded query
+
+
+class MessageRecorder:
+    """Records the messages put on the queues of App.queues into rolling binary files, for replay (Replayer).
+    Each record holds the time, source, destination, task, args and kwargs of a message.  The source is the actor
+    whose task sent it (see actor.current_actor), whatever thread or event loop runs the task, or else the name of
+    the sending thread.
+    Recording only appends a reference to the message and its time to an in-memory buffer.  A Mailbox calls the
+    recorder when it accepts an item (see Mailbox.set_put_listener).  Other queues have their put wrapped.
+    A writer thread serializes the buffer into one pickled block
+    every flush_interval_s, and appends it to rec_<time>_<seq>.qrec files of about file_mb, keeping the last
+    max_files.
+    A full buffer drops messages (counted in dropped_cnt) rather than slowing the actors.
+    Only the messages a queue accepted are recorded.  One a full mailbox drops or rejects on put is not, while
+    one evicted later by the drop_oldest policy stays recorded.
+    Args are serialized when written, so data mutated after it was sent is recorded as it is then.
+    Args that can't be pickled are recorded as their repr and are not replayed.
+    Queues added after start() are recorded too (see App.add_queue).
+    """
+    def __init__(self, record_dir, file_mb=64, max_files=10, flush_interval_s=0.5, buffer_size=100000):
+        self.record_dir = record_dir
+        self.max_bytes = int(file_mb * 1024 * 1024)
+        self.max_files = max_files
+        self.flush_interval_s = flush_interval_s
+        self.buffer_size = buffer_size
+        self.recorded_cnt = 0
+        self.dropped_cnt = 0
+        self.files = []  # Recording files, oldest first
+        self._buffer = collections.deque()
+        self._hooked = {}  # key = queue name, value = queue whose put is recorded
+        self._file = None
+        self._file_seq = 0
+        self._recording = False
+        self._stop_event = threading.Event()
+        self._writer_thread = None
+        self._thread_names = threading.local()  # .name: name of the sending thread.  Dies with the thread.
+        self._lock = threading.Lock()
+
+    def start(self):
+        """Start recording the queues of App.queues"""
+        os.makedirs(self.record_dir, exist_ok=True)
+        self._recording = True
+        with App.lock:
+            queues = list(App.queues.items())
+        for name, q in queues:
+            self.attach(name, q)
+        self._stop_event.clear()
+        self._writer_thread = threading.Thread(target=self._writer, args=(), name="recorder", daemon=True)
+        self._writer_thread.start()
+        atexit.register(self.stop)
+
+    def attach(self, name, q):
+        """Record the messages put on a queue"""
+        if not self._recording:
+            return
+        with self._lock:
+            old = self._hooked.get(name)
+            if old is q:
+                return
+            if old is not None:
+                _unhook(old)
+            self._hooked[name] = q
+        buffer = self._buffer
+        buffer_size = self.buffer_size
+        thread_names = self._thread_names
+        get_actor = current_actor.get
+        now = time.time
+
+        def record(dest, item, t=None):
+            if type(item) is not tuple:
+                return  # The stop sentinel
+            if len(buffer) < buffer_size:
+                source = get_actor()
+                if source is None:
+                    try:
+                        source = thread_names.name
+                    except AttributeError:
+                        source = thread_names.name = threading.current_thread().name
+                buffer.append((now() if t is None else t, source, dest, item))
+            else:
+                self.dropped_cnt += 1
+
+        if hasattr(q, "set_put_listener"):
+            # Called under the mailbox lock, so a message is recorded before the ones its task sends
+            q.set_put_listener(record)
+            return
+        put = q.put
+
+        def recorded_put(item, *args, **kwargs):
+            if type(item) is not tuple or not self._recording:
+                return put(item, *args, **kwargs)
+            t = now()  # Before the put, so the message is not recorded after the ones its task sends
+            accepted = put(item, *args, **kwargs)
+            if accepted is not False:  # False: dropped by a full mailbox.  A rejected item raised.
+                record(name, item, t)
+            return accepted
+
+        q.put = recorded_put  # Instance attribute, removed by _unhook.  put_nowait goes through it too.
+        if hasattr(q, "put_conflated"):
+            put_conflated = q.put_conflated
+
+            def recorded_put_conflated(key, item, *args, **kwargs):
+                if type(item) is not tuple or not self._recording:
+                    return put_conflated(key, item, *args, **kwargs)
+                t = now()
+                accepted = put_conflated(key, item, *args, **kwargs)
+                if accepted is not False:
+                    record(name, item, t)
+                return accepted
+
+            q.put_conflated = recorded_put_conflated
+
+    def stop(self):
+        """Stop recording, write the buffered messages and close the file"""
+        if not self._recording:
+            return
+        self._recording = False
+        with self._lock:
+            for q in self._hooked.values():
+                _unhook(q)
+            self._hooked = {}
+        self._stop_event.set()
+        if self._writer_thread is not None and self._writer_thread is not threading.current_thread():
+            self._writer_thread.join()
+        self._writer_thread = None
+        self._write_pending()
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        atexit.unregister(self.stop)
+
+    def _writer(self):
+        while not self._stop_event.wait(self.flush_interval_s):
+            self._write_pending()
+
+    def _write_pending(self):
+        buffer = self._buffer
+        if not buffer:
+            return
+        pending = []
+        while buffer:
+            pending.append(buffer.popleft())
+        try:
+            records = []
+            for t, source, dest, (task, args, kwargs) in pending:
+                if "return_q" in kwargs:
+                    kwargs = dict(kwargs, return_q=REPLY)
+                records.append((t, source, dest, task, args, kwargs, True))
+            try:
+                block = pickle.dumps(records, pickle.HIGHEST_PROTOCOL)
+            except Exception:
+                block = pickle.dumps([_portable(record) for record in records], pickle.HIGHEST_PROTOCOL)
+            with self._lock:
+                if self._file is None or self._file.tell() >= self.max_bytes:
+                    self._open_new_file()
+                self._file.write(_BLOCK.pack(len(block)) + block)
+                self._file.flush()
+        except Exception as e:
+            # Runs on the writer thread, which must keep going.  The messages are lost.
+            self.dropped_cnt += len(pending)
+            App.log(f"ERROR: Recorder failed to write {len(pending)} messages: {e}")
+            return
+        self.recorded_cnt += len(pending)
+
+    def _open_new_file(self):
+        if self._file is not None:
+            self._file.close()
+        self._file_seq += 1
+        file_path = os.path.join(self.record_dir, f"rec_{time.strftime('%Y%m%d_%H%M%S')}_{self._file_seq:04d}.qrec")
+        self._file = open(file_path, "wb")
+        self._file.write(_MAGIC)
+        self.files.append(file_path)
+        while len(self.files) > self.max_files:
+            try:
+                os.remove(self.files.pop(0))
+            except OSError:
+                pass
+
+
+def _unhook(q):
+    if hasattr(q, "set_put_listener"):
+        q.set_put_listener(None)
+    q.__dict__.pop("put", None)
+    q.__dict__.pop("put_conflated", None)
+
+
+def _portable(record):
+    """Return a record that can be pickled.  A callable task or args that can't be pickled are kept as repr,
+    and the record is marked as not replayable."""
+    t, source, dest, task, args, kwargs, _ = record
+    if type(task) != str:
+        return t, source, dest, getattr(task, "__name__", repr(task)), repr(args)[:1000], repr(kwargs)[:1000], False
+    try:
+        pickle.dumps((args, kwargs), pickle.HIGHEST_PROTOCOL)
+    except Exception:
+        return t, source, dest, task, repr(args)[:1000], repr(kwargs)[:1000], False
+    return record
+
+
+def recording_files(path):
+    """Return the recording files of a directory in order, or [path] for a file"""
+    if os.path.isdir(path):
+        return sorted(os.path.join(path, name) for name in os.listdir(path) if name.endswith(".qrec"))
+    return [path]
+
+
+def read_recording(path):
+    """Yield the records (time, source, dest, task, args, kwargs, replayable) of a recording file or directory"""
+    for file_path in recording_files(path):
+        with open(file_path, "rb") as f:
+            if f.read(len(_MAGIC)) != _MAGIC:
+                raise ValueError(f"{file_path} is not a qmafpy recording")
+            while True:
+                header = f.read(_BLOCK.size)
+                if len(header) < _BLOCK.size:
+                    break  # End of file
+                length, = _BLOCK.unpack(header)
+                block = f.read(length)
+                if len(block) < length:
+                    break  # Block still being written
+                yield from pickle.loads(block)
+
+
+class _NullReply:
+    """return_q of a replayed query.  The reply is discarded."""
+    def put(self, item, block=True, timeout=None):
+        pass
+
+    def put_nowait(self, item):
+        pass
+
+    def set_exception(self, exc):
+        pass
+
+
+class Replayer:
+    """Feeds a recording back into the running actors (the queues of App.queues) and reports the results.
+        actors: names of the destination actors to replay to (default: all that exist)
+        replay(speed): 1.0 keeps the recorded timing, N is N times faster, None sends as fast as possible.
+    The report has the send rate, the processing throughput (until the destination mailboxes are drained) and
+    the latency of the destination mailboxes.  Mailbox latency tracking is started on them (one item in
+    latency_sample_every) and their latency histograms are reset.
+    """
+    def __init__(self, path, actors=None):
+        self.path = path
+        self.actors = set(actors) if actors is not None else None
+
+    def replay(self, speed=1.0, latency_sample_every=1, drain_timeout_s=60.0):
+        targets = {}  # key = destination name, value = queue
+        skipped = collections.Counter()
+        lateness = Histogram()  # ns behind the recorded timing, when paced
+        reply = _NullReply()
+        sent = 0
+        first_t = start = None
+        for t, source, dest, task, args, kwargs, replayable in read_recording(self.path):
+            if self.actors is not None and dest not in self.actors:
+                skipped["filtered"] += 1
+                continue
+            if not replayable:
+                skipped["not_replayable"] += 1
+                continue
+            q = targets.get(dest)
+            if q is None:
+                q = App.get_queue(dest)
+                if q is None:
+                    skipped["no_queue"] += 1
+                    continue
+                targets[dest] = q
+                if hasattr(q, "track_latency"):
+                    if q.queue_latency is None:
+                        q.track_latency(latency_sample_every)
+                    q.queue_latency = Histogram()
+            if kwargs.get("return_q") == REPLY:
+                kwargs = dict(kwargs, return_q=reply)
+            if first_t is None:
+                first_t, start = t, time.perf_counter()
+            if speed:
+                delay = (t - first_t) / speed - (time.perf_counter() - start)
+                if delay > 0:
+                    time.sleep(delay)
+                else:
+                    lateness.record(int(-delay * 1e9))
+            q.put((task, args, kwargs))
+            sent += 1
+        if start is None:
+            start = time.perf_counter()
+        send_s = time.perf_counter() - start
+        deadline = time.monotonic() + drain_timeout_s
+        for q in targets.values():
+            while getattr(q, "unfinished_tasks", 0) and time.monotonic() < deadline:
+                time.sleep(0.001)
+        elapsed_s = time.perf_counter() - start
+        report = {"speed": speed, "sent": sent, "skipped": dict(skipped), "send_s": send_s, "elapsed_s": elapsed_s,
+                  "send_rate_msgs_s": sent / send_s if send_s else 0.0,
+                  "throughput_msgs_s": sent / elapsed_s if elapsed_s else 0.0,
+                  "drained": all(not getattr(q, "unfinished_tasks", 0) for q in targets.values()),
+                  "queue_latency_ns": {dest: q.queue_latency.summary() for dest, q in targets.items()
+                                       if getattr(q, "queue_latency", None) is not None}}
+        if speed:
+            report["lateness_ns"] = lateness.summary()
+        return report
+
+
+def format_report(report):
+    speed = f"{report['speed']}x" if report["speed"] else "as fast as possible"
+    lines = [f"Replay at {speed}: {report['sent']} messages sent, skipped {report['skipped']}",
+             f"send {report['send_s']:.3f} s ({report['send_rate_msgs_s']:.0f} msgs/s), "
+             f"processed {report['elapsed_s']:.3f} s ({report['throughput_msgs_s']:.0f} msgs/s)"
+             + ("" if report["drained"] else ", NOT DRAINED")]
+    if "lateness_ns" in report:
+        late = report["lateness_ns"]
+        lines.append(f"behind schedule: {late['count']} msgs, p99 {late['p99'] / 1e3:.0f} us, "
+                     f"max {late['max'] / 1e3:.0f} us")
+    for dest, summary in report["queue_latency_ns"].items():
+        lines.append(f"{dest} queue latency: p50 {summary['p50'] / 1e3:.1f} us, p99 {summary['p99'] / 1e3:.1f} us, "
+                     f"max {summary['max'] / 1e3:.1f} us")
+    return "\n".join(lines)
+
+
+def summarize(path):
+    """Return {"records", "first", "last", "messages": {(source, dest, task): count}} of a recording"""
+    messages = collections.Counter()
+    first = last = None
+    for t, source, dest, task, _, _, _ in read_recording(path):
+        if first is None:
+            first = t
+        last = t
+        messages[(source, dest, task)] += 1
+    return {"records": sum(messages.values()), "first": first, "last": last, "messages": messages}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Summarize a qmafpy message recording.")
+    parser.add_argument("path", help="rec_*.qrec file or recording directory")
+    args = parser.parse_args(argv)
+    summary = summarize(args.path)
+    duration = summary["last"] - summary["first"] if summary["records"] else 0.0
+    print(f"{summary['records']} messages over {duration:.3f} s")
+    print(f"{'count':>8}  source -> dest task")
+    for (source, dest, task), cnt in summary["messages"].most_common():
+        print(f"{cnt:>8}  {source} -> {dest} {task}")
+
+
+if __name__ == "__main__":
+    main()
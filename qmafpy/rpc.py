@@ -0,0 +1,179 @@
+import concurrent.futures
+import heapq
+import itertools
+import threading
+import time
+
+
+class QueryError(Exception):
+    """Set on a query future when the query could not be sent"""
+
+
+class QueryFuture(concurrent.futures.Future):
+    """Handle of a pending query (see Actor.query).  A concurrent.futures.Future whose result is the task's reply.
+    result() and exception() default to the query's own timeout.  When it expires, the query is cancelled and a
+    late reply is discarded."""
+    def __init__(self, corr_id, deadline, dest=None):
+        super().__init__()
+        self.corr_id = corr_id
+        self.deadline = deadline  # time.monotonic() value, or None
+        self.dest = dest  # Name of the queried actor
+        self.waiting_since = None  # time.monotonic() when a thread started blocking in result(), for the watchdog
+
+    def _remaining(self, timeout):
+        if timeout is None and self.deadline is not None:
+            timeout = max(0.0, self.deadline - time.monotonic())
+        return timeout
+
+    def result(self, timeout=None):
+        if not self.done():
+            self.waiting_since = time.monotonic()
+        try:
+            return super().result(self._remaining(timeout))
+        except concurrent.futures.TimeoutError:
+            self._expire(timeout)
+            raise
+        finally:
+            self.waiting_since = None
+
+    def exception(self, timeout=None):
+        try:
+            return super().exception(self._remaining(timeout))
+        except concurrent.futures.TimeoutError:
+            self._expire(timeout)
+            raise
+
+    def _expire(self, timeout):
+        if timeout is None or (self.deadline is not None and time.monotonic() >= self.deadline):
+            self.cancel()
+
+
+class _Reply:
+    """Stands in for the return_q of a query.  The first value put on it (or returned by the task) resolves the
+    query's future.  Later values are ignored."""
+    def __init__(self, channel, corr_id):
+        self.channel = channel
+        self.corr_id = corr_id
+
+    def put(self, item, block=True, timeout=None):
+        self.channel._resolve(self.corr_id, item)
+
+    def put_nowait(self, item):
+        self.put(item)
+
+    def set_exception(self, exc):
+        self.channel._resolve(self.corr_id, exc, failed=True)
+
+
+class ReplyChannel:
+    """Pending queries of one actor, keyed on correlation ID.
+    Replies resolve their future on the replying actor's thread.  Queries past their deadline are cancelled
+    lazily, when the next query is made."""
+    def __init__(self, name):
+        self.name = name
+        self._ids = itertools.count(1)
+        self._pending = {}  # key = correlation ID, value = (QueryFuture, _Reply)
+        self._deadlines = []  # Heap of (deadline, correlation ID)
+        self._lock = threading.Lock()
+        self.late_cnt = 0  # Replies that arrived after their query was cancelled or expired
+
+    def open(self, timeout=None, dest=None):
+        """Return (future, reply) for a new query to the dest actor"""
+        now = time.monotonic()
+        self._expire(now)
+        corr_id = next(self._ids)
+        deadline = now + timeout if timeout is not None else None
+        future = QueryFuture(corr_id, deadline, dest)
+        reply = _Reply(self, corr_id)
+        with self._lock:
+            self._pending[corr_id] = (future, reply)
+            if deadline is not None:
+                heapq.heappush(self._deadlines, (deadline, corr_id))
+        future.add_done_callback(self._discard)
+        return future, reply
+
+    def _discard(self, future):
+        with self._lock:
+            self._pending.pop(future.corr_id, None)
+
+    def _resolve(self, corr_id, item, failed=False):
+        with self._lock:
+            entry = self._pending.pop(corr_id, None)
+        if entry is None or not entry[0].set_running_or_notify_cancel():
+            self.late_cnt += 1
+            return
+        if failed:
+            entry[0].set_exception(item)
+        else:
+            entry[0].set_result(item)
+
+    def _expire(self, now):
+        expired = []
+        with self._lock:
+            while self._deadlines and self._deadlines[0][0] <= now:
+                entry = self._pending.get(heapq.heappop(self._deadlines)[1])
+                if entry is not None:
+                    expired.append(entry[0])
+        for future in expired:
+            future.cancel()
+
+    def cancel(self, corr_id):
+        with self._lock:
+            entry = self._pending.get(corr_id)
+        if entry is not None:
+            entry[0].cancel()
+
+    def pending_cnt(self):
+        with self._lock:
+            return len(self._pending)
+
+    def blocked_on(self):
+        """Return [(dest, waiting_since)] of the pending queries a thread is blocked on in result()"""
+        with self._lock:
+            futures = [entry[0] for entry in self._pending.values()]
+        blocked = []
+        for future in futures:
+            since = future.waiting_since
+            if since is not None:
+                blocked.append((future.dest, since))
+        return blocked
+
+
+def _wait_timeout(futures, timeout):
+    """Without an explicit timeout, wait until the last query deadline (None if a query has no deadline)"""
+    if timeout is None:
+        deadlines = [future.deadline for future in futures if not future.done()]
+        if deadlines and None not in deadlines:
+            timeout = max(0.0, max(deadlines) - time.monotonic())
+    return timeout
+
+
+def gather(futures, timeout=None, return_exceptions=False):
+    """Wait for all the query futures and return their results in order.
+    On timeout, the queries still pending are cancelled and TimeoutError is raised.
+    With return_exceptions=True, a failed or timed out query gives its exception in place of a result."""
+    futures = list(futures)
+    done, not_done = concurrent.futures.wait(futures, _wait_timeout(futures, timeout))
+    for future in not_done:
+        future.cancel()
+    results = []
+    for future in futures:
+        if future.cancelled():
+            exc = concurrent.futures.TimeoutError(f"Query {future.corr_id} timed out")
+        else:
+            exc = future.exception(timeout=0)
+        if exc is not None:
+            if not return_exceptions:
+                raise exc
+            results.append(exc)
+        else:
+            results.append(future.result(timeout=0))
+    return results
+
+
+def wait_any(futures, timeout=None):
+    """Wait until one of the query futures is done and return it, or None on timeout.  Others are not cancelled."""
+    futures = list(futures)
+    done, _ = concurrent.futures.wait(futures, _wait_timeout(futures, timeout),
+                                      return_when=concurrent.futures.FIRST_COMPLETED)
+    return next((future for future in futures if future in done), None)
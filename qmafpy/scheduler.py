@@ -1,103 +1,279 @@
+import bisect
+import heapq
 import queue
 import time
 import threading
 from .actor import Actor
+from .globals import App
+
+_clock = time.perf_counter  # Monotonic and high resolution.  Unaffected by wall-clock changes.
+
+# Missed tick policies for periodic items that fall behind
+SCHED_BURST = "burst"  # Send every missed tick, back to back, until caught up
+SCHED_COALESCE = "coalesce"  # Send once for all missed ticks, then continue on the original grid
+SCHED_SKIP = "skip"  # Drop ticks that are a full interval late, then continue on the original grid
+SCHED_POLICIES = (SCHED_BURST, SCHED_COALESCE, SCHED_SKIP)
+
+
+class SchedStats:
+    """Lateness and jitter measured for one scheduled item.
+    lateness = time the item was sent - its scheduled launch time
+    jitter = |time between two sends - interval|
+    Times are recorded in ms into fixed histogram buckets (upper bounds below).
+    """
+    BUCKETS_MS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 50, 100, 250, 500, 1000)
+
+    def __init__(self):
+        self.sent = 0  # Ticks sent
+        self.missed = 0  # Ticks coalesced or skipped
+        self.backlog_skipped = 0  # Ticks skipped because the destination mailbox was backlogged
+        self.rejected = 0  # Ticks a full destination mailbox refused
+        self.last_send_time = None
+        self.lateness = self._new_series()
+        self.jitter = self._new_series()
+
+    def _new_series(self):
+        return {"count": 0, "total": 0.0, "max": 0.0, "hist": [0] * (len(self.BUCKETS_MS) + 1)}
+
+    @classmethod
+    def _add(cls, series, value_ms):
+        series["count"] += 1
+        series["total"] += value_ms
+        if value_ms > series["max"]:
+            series["max"] = value_ms
+        series["hist"][bisect.bisect_left(cls.BUCKETS_MS, value_ms)] += 1
+
+    def record(self, launch_time, now, interval_s):
+        self.sent += 1
+        self._add(self.lateness, (now - launch_time) * 1000)
+        if self.last_send_time is not None:
+            self._add(self.jitter, abs((now - self.last_send_time) - interval_s) * 1000)
+        self.last_send_time = now
+
+    def _series_snapshot(self, series):
+        count = series["count"]
+        buckets = [str(b) for b in self.BUCKETS_MS] + ["inf"]
+        return {"count": count, "mean_ms": series["total"] / count if count else 0.0, "max_ms": series["max"],
+                "hist_ms": dict(zip(buckets, series["hist"]))}
+
+    def snapshot(self):
+        return {"sent": self.sent, "missed": self.missed, "backlog_skipped": self.backlog_skipped,
+                "rejected": self.rejected,
+                "lateness": self._series_snapshot(self.lateness), "jitter": self._series_snapshot(self.jitter)}
 
 
 class SchedMgr(Actor):
     """This class provides scheduling service.
+    Scheduled items are held in a min-heap keyed on launch time, so a wake only touches the items that are due.
+    Deleted or replaced items are cancelled lazily: their heap entries are discarded when they reach the top.
+    Launch times use a monotonic clock.  Periodic items stay on their original time grid, and each item has a
+    missed tick policy (SCHED_POLICIES) for when it falls behind.  The default policy is App.cfg["sched_policy"],
+    or burst if not configured.
+    Ticks are skipped while the destination mailbox is backlogged (above its high watermark).  A full mailbox
+    rejects a tick rather than make the scheduler wait (counted in SchedStats.rejected).
     """
     def __init__(self, log_level=0):
         self.name = "sched"
         super().__init__(self.name, log_level=log_level)
         self.sched_items = {}  # Is a dict of scheduled Items.
+        self._heap = []  # Heap entries are (launch_time, seq, item_id)
+        self._seq = 0  # Identifies the live heap entry of each item
+        self._stale_cnt = 0  # Number of cancelled entries still in the heap
+        self._source_items = {}  # key = source name, value = set of item IDs
+        self.sched_stats = {}  # key = source name, value = {sched_id: SchedStats}.  Kept after a counted item completes.
         self._wake_monitor_thread = None
         self._wake_stop_flag = None
         self._wake_running = False
         self.q_wake = queue.Queue()
         self._run_wake_monitor()
 
-    def _sched_send(self, item_id):
-        """ send scheduled item. Check if count completed, remove item.  Otherwise, schedule next launch time."""
-        with self.lock:
-            sched_item = self.sched_items[item_id]
-            task_method = sched_item["task_method"]
-            dest_q_name = sched_item["dest_q_name"]
-            args = sched_item["args"]
-            kwargs = sched_item["kwargs"]
-            self.enqueue(dest_q_name, task_method, *args, **kwargs)
+    def _push(self, item_id, sched_item):
+        """Add the heap entry for the item's current launch time."""
+        self._seq += 1
+        sched_item["seq"] = self._seq
+        heapq.heappush(self._heap, (sched_item["launch_time"], self._seq, item_id))
+
+    def _remove(self, item_id, in_heap=True):
+        """Remove an item.  Its heap entry becomes stale and is dropped later."""
+        sched_item = self.sched_items.pop(item_id, None)
+        if sched_item is None:
+            return
+        source_items = self._source_items.get(sched_item["source"])
+        if source_items is not None:
+            source_items.discard(item_id)
+            if not source_items:
+                del self._source_items[sched_item["source"]]
+        if in_heap:
+            self._stale_cnt += 1
+            self._compact()
+
+    def _compact(self):
+        """Rebuild the heap when most of it is made of cancelled entries."""
+        if self._stale_cnt > 64 and self._stale_cnt > len(self._heap) // 2:
+            self._heap = [entry for entry in self._heap if not self._is_stale(entry)]
+            heapq.heapify(self._heap)
+            self._stale_cnt = 0
+
+    def _is_stale(self, entry):
+        sched_item = self.sched_items.get(entry[2])
+        return sched_item is None or sched_item["seq"] != entry[1]
+
+    def _sched_send(self, item_id, now=None):
+        """Take a tick of a due item.  Check if count completed, remove item.  Otherwise, schedule next launch time.
+        Returns (dest_q_name, task item, stats, launch_time, interval_s, missed) to send, or None.  Call locked.
+        The item is sent by _send_ticks once the lock is released."""
+        if now is None:
+            now = _clock()
+        sched_item = self.sched_items[item_id]
+        launch_time = sched_item["launch_time"]
+        interval_s = sched_item["interval_s"]
+        stats = self.sched_stats.get(sched_item["source"], {}).get(sched_item["name"])
+        # Whole ticks missed since the launch time
+        missed = int((now - launch_time) // interval_s) if interval_s > 0 else 0
+        send = None
+        if missed > 0 and sched_item["policy"] == SCHED_SKIP:
+            # The due tick and the missed ones after it are all dropped: the next launch is the first slot after now
+            if stats is not None:
+                stats.missed += 1 + missed
+        elif getattr(App.get_queue(sched_item["dest_q_name"]), "backlogged", False):
+            # Destination mailbox is above its high watermark.  Skip this tick rather than add to the backlog.
+            if stats is not None:
+                stats.missed += 1 + missed
+                stats.backlog_skipped += 1
+        else:
+            item = (sched_item["task_method"], sched_item["args"], sched_item["kwargs"])
+            send = (sched_item["dest_q_name"], item, stats, launch_time, interval_s,
+                    missed if sched_item["policy"] == SCHED_COALESCE else 0)
             # Update count adn schedule next event
-            item_expired = False
             count = sched_item["count"]
             if count > 0:
                 next_cnt = count - 1
                 if next_cnt <= 0:
-                    del self.sched_items[item_id]
-                    item_expired = True
+                    self._remove(item_id, in_heap=False)  # Its heap entry was already popped
+                    return send
+                sched_item["count"] = next_cnt
+        if sched_item["policy"] != SCHED_BURST:
+            launch_time += interval_s * missed  # Jump to the grid slot before now
+        sched_item["launch_time"] = launch_time + interval_s
+        self._push(item_id, sched_item)
+        return send
+
+    def _send_ticks(self, sends, now):
+        """Enqueue the ticks taken by _sched_send.  Called unlocked, and never waits for room in a full mailbox:
+        the tick is counted as rejected instead, so a slow actor can't stall the scheduler."""
+        results = []
+        for dest_q_name, item, stats, launch_time, interval_s, missed in sends:
+            dest_q = App.get_queue(dest_q_name)
+            if dest_q is None:
+                self.log(f"ERROR: dest_q does not exist.  Scheduled dest={dest_q_name} task={item[0]}", 0)
+                queued = False
+            else:
+                queued = self._put(dest_q, dest_q_name, item, block=False)
+            results.append((queued, stats, launch_time, interval_s, missed))
+        with self.lock:
+            for queued, stats, launch_time, interval_s, missed in results:
+                if stats is None:
+                    continue
+                if queued:
+                    stats.record(launch_time, now, interval_s)
+                    stats.missed += missed
                 else:
-                    self.sched_items[item_id]["count"] = next_cnt
-            if not item_expired:
-                self.sched_items[item_id]["launch_time"] = sched_item["launch_time"] + sched_item["interval_s"]
+                    stats.rejected += 1
 
     def _check(self):
-        items_to_send = []
-        # Check items due now
-        for item_id, sched_item in self.sched_items.items():
-            if sched_item["launch_time"] <= time.time():
-                items_to_send.append(item_id)
-        # Send due items
-        for item_id in items_to_send:
-            self._sched_send(item_id)
-        # Calculate next wake time
-        next_wake = 3
-        for sched_item in self.sched_items.values():
-            next_wake = min(next_wake, sched_item["launch_time"] - time.time())
-        if next_wake < 0:
-            next_wake = 0
+        with self.lock:
+            now = _clock()
+            # Pop items due now.  Items re-armed by _sched_send are picked up on the next check.
+            items_to_send = []
+            while self._heap and self._heap[0][0] <= now:
+                entry = heapq.heappop(self._heap)
+                if self._is_stale(entry):
+                    self._stale_cnt -= 1
+                else:
+                    items_to_send.append(entry[2])
+            # Take the due ticks
+            sends = []
+            for item_id in items_to_send:
+                send = self._sched_send(item_id, now)
+                if send is not None:
+                    sends.append(send)
+            # Calculate next wake time
+            while self._heap and self._is_stale(self._heap[0]):
+                heapq.heappop(self._heap)
+                self._stale_cnt -= 1
+            next_wake = now + 3
+            if self._heap:
+                next_wake = min(next_wake, self._heap[0][0])
+        # Send due items outside the lock, so schedule() and del_item() never wait behind a destination
+        if sends:
+            self._send_ticks(sends, now)
+        if App.metrics is not None:
+            App.metrics.sched_check_time.record(int((_clock() - now) * 1e9))
         # Sched to check at next wake time
-        self.q_wake.put(next_wake)  # This will cause the wait monitor to wait the specified time
+        self.q_wake.put(next_wake)  # This will cause the wait monitor to wait until the specified clock time
 
     ### Methods available for Queue Tasks
     def reset(self, *args, **kwargs):
         # Clear all scheduled items
-        self.sched_items = {}
+        with self.lock:
+            self.sched_items = {}
+            self.sched_stats = {}
+            self._heap = []
+            self._stale_cnt = 0
+            self._source_items = {}
         self._check()
 
     def del_item(self, source_name: str, sched_id: str):
         # Build the item ID
         item_id = f"{source_name}_{sched_id}"
         # Clear the specified scheduled item
-        if item_id in self.sched_items:
-            del self.sched_items[item_id]
+        with self.lock:
+            self._remove(item_id)
+            self.sched_stats.get(source_name, {}).pop(sched_id, None)
 
     def flush_my_items(self, source_name: str):
         # Clear the scheduled items for this caller
-        items_to_del = []
-        for item_id in self.sched_items.keys():
-            # If the itemID begins with the caller name then remove it
-            if item_id.startswith(source_name + "_"):
-                items_to_del.append(item_id)
-        for item_to_del in items_to_del:
-            del self.sched_items[item_to_del]
-
-    def schedule(self, source_name, sched_id, interval_s, count, dest_q_name, task_method, *args, **kwargs):
+        with self.lock:
+            for item_id in list(self._source_items.get(source_name, ())):
+                self._remove(item_id)
+            self.sched_stats.pop(source_name, None)
+
+    def get_stats(self, source_name: str, sched_id: str):
+        """Return the measured lateness and jitter of a scheduled item, or None if it is unknown."""
+        with self.lock:
+            stats = self.sched_stats.get(source_name, {}).get(sched_id)
+            return None if stats is None else stats.snapshot()
+
+    def schedule(self, source_name, sched_id, interval_s, count, dest_q_name, task_method, *args,
+                 sched_policy=None, **kwargs):
         """
         The scheduler is used to schedule tasks. The tasks will be enqueued at the specified interval.
+        sched_policy selects how missed ticks are handled (burst, coalesce or skip).  It is a reserved keyword:
+        it is never passed to the task, so a scheduled task can't take a sched_policy argument.
         """
+        if sched_policy is None:
+            sched_policy = App.cfg.get("sched_policy", SCHED_BURST)
+        if sched_policy not in SCHED_POLICIES:
+            self.log(f"ERROR: Invalid sched_policy={sched_policy} for sched_id={sched_id}", 0)
+            return
         item_id = f"{source_name}_{sched_id}"
-        launch_time = time.time() + interval_s
+        launch_time = _clock() + interval_s
         sched_item = {"source": source_name, "name": sched_id, "dest_q_name": dest_q_name, "interval_s": interval_s,
-                     "count": count, "launch_time": launch_time,
+                     "count": count, "launch_time": launch_time, "policy": sched_policy,
                      "task_method": task_method, "args": args, "kwargs": kwargs}
         with self.lock:
-            self.sched_items.update({item_id: sched_item})
+            self._remove(item_id)  # Replacing an item cancels its pending launch
+            self.sched_items[item_id] = sched_item
+            self.sched_stats.setdefault(source_name, {})[sched_id] = SchedStats()
+            self._source_items.setdefault(source_name, set()).add(item_id)
+            self._push(item_id, sched_item)
         # Force a check
         self.q_wake.put(0)
 
     def _run_wake_monitor(self):
         self.log("Task Wake Run Initiated", 5)
         if not self._wake_running:
-            self._wake_monitor_thread = threading.Thread(target=self._wake_monitor, args=(), daemon=True)
+            self._wake_monitor_thread = threading.Thread(target=self._wake_monitor, args=(), name=self.name, daemon=True)
             self._wake_monitor_thread.start()
         else:
             self.log("Can't run Wake Monitor thread.  It is already running.", 5)
@@ -106,19 +282,20 @@ class SchedMgr(Actor):
         """This method waits until next scheduled item is due"""
         self._wake_running = True
         self._wake_stop_flag = False
-        next_wake = 3
+        next_wake_time = _clock() + 3
         while not self._wake_stop_flag:
             try:
-                next_wake_time = self.q_wake.get(timeout=next_wake)
+                # Wake times are absolute clock values, so time spent between checks does not shift the next wake
+                new_wake_time = self.q_wake.get(timeout=max(0, next_wake_time - _clock()))
             except queue.Empty:
-                next_wake = 3  # Set default next wake.  Will be changed by Check
+                next_wake_time = _clock() + 3  # Set default next wake.  Will be changed by Check
                 self._check()  # Check will enqueue next wait time
             else:
-                if next_wake_time is None:
+                if new_wake_time is None:
                     # Exiting.  End thread.
                     self._wake_stop_flag = True
                 else:
-                    next_wake = next_wake_time
+                    next_wake_time = new_wake_time
         self._wake_running = False
 
     def stop(self):
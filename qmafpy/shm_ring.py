@@ -0,0 +1,209 @@
+import atexit
+import itertools
+import os
+import struct
+import sys
+import threading
+from .globals import App
+
+try:
+    from multiprocessing import resource_tracker, shared_memory
+except ImportError:  # Python < 3.8
+    resource_tracker = shared_memory = None
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+_HEADER = struct.Struct("<QQ")  # Slot header: generation, payload size
+_SLOT_ALIGN = 64
+
+# Process wide state
+_rings = {}  # Rings written by this process.  key = topic, value = ShmRing
+_retired_rings = []  # Rings replaced by a larger one.  Kept until exit, since a writer or reader may still use them.
+_segments = {}  # Segments mapped by this process.  key = segment name, value = SharedMemory
+_lock = threading.Lock()  # Guards _segments
+_rings_lock = threading.Lock()  # Guards _rings
+_ring_ids = itertools.count()
+
+
+class StaleHandle(Exception):
+    """Raised when the slot of a ShmHandle has been reused for a newer payload"""
+
+
+def _open_segment(name):
+    """Map a segment created by another process.
+    Before Python 3.13, SharedMemory(name=...) registers the segment with this process's resource tracker, which
+    then unlinks it when this process exits.  The registration is undone here, the writer owns the segment."""
+    if sys.version_info >= (3, 13):
+        return shared_memory.SharedMemory(name=name, track=False)
+    shm = shared_memory.SharedMemory(name=name)
+    if os.name == "posix":
+        resource_tracker.unregister("/" + name, "shared_memory")
+    return shm
+
+
+def _attach(segment):
+    with _lock:
+        shm = _segments.get(segment)
+        if shm is None:
+            try:
+                shm = _open_segment(segment)
+            except FileNotFoundError:
+                raise StaleHandle(f"Shared memory segment {segment} no longer exists")
+            _segments[segment] = shm
+        return shm
+
+
+class ShmHandle:
+    """Small picklable reference to a payload in a ShmRing slot.  It is what subscribers receive.
+        view(): zero-copy memoryview of the payload.  array(): NumPy array view (needs numpy).
+        valid(): True while the slot still holds this payload.
+    The slot is reused after the ring's other slots have been written.  A reader that needs the data for longer
+    must copy it, and should check valid() after reading to detect a payload overwritten while it was read.
+    """
+    __slots__ = ("segment", "offset", "generation", "nbytes", "dtype", "shape")
+
+    def __init__(self, segment, offset, generation, nbytes, dtype=None, shape=None):
+        self.segment = segment  # Shared memory segment name
+        self.offset = offset  # Offset of the slot header
+        self.generation = generation
+        self.nbytes = nbytes
+        self.dtype = dtype  # Set when an array was published
+        self.shape = shape
+
+    def __getstate__(self):
+        return self.segment, self.offset, self.generation, self.nbytes, self.dtype, self.shape
+
+    def __setstate__(self, state):
+        self.segment, self.offset, self.generation, self.nbytes, self.dtype, self.shape = state
+
+    def __repr__(self):
+        return f"ShmHandle({self.segment}, offset={self.offset}, generation={self.generation}, nbytes={self.nbytes})"
+
+    def valid(self):
+        try:
+            shm = _attach(self.segment)
+        except StaleHandle:
+            return False
+        return _HEADER.unpack_from(shm.buf, self.offset)[0] == self.generation
+
+    def view(self):
+        """Return a read only memoryview of the payload.  Raises StaleHandle if the slot was reused."""
+        shm = _attach(self.segment)
+        if _HEADER.unpack_from(shm.buf, self.offset)[0] != self.generation:
+            raise StaleHandle(f"{self} was overwritten")
+        start = self.offset + _HEADER.size
+        return shm.buf[start:start + self.nbytes].toreadonly()
+
+    def array(self):
+        """Return a read only NumPy array view of the payload"""
+        if numpy is None:
+            raise ImportError("numpy is required for ShmHandle.array()")
+        arr = numpy.frombuffer(self.view(), dtype=self.dtype or "u1")
+        return arr.reshape(self.shape) if self.shape is not None else arr
+
+    def copy(self):
+        """Return the payload as bytes.  Raises StaleHandle if the slot was reused while it was copied."""
+        data = bytes(self.view())
+        if not self.valid():
+            raise StaleHandle(f"{self} was overwritten")
+        return data
+
+
+class ShmRing:
+    """Ring of fixed size slots in one shared memory segment.  Written by one process, read by any.
+    Each slot header holds a generation number.  It is odd while the slot is being written and even when the
+    payload is complete.  A handle records the generation it was written with, so a reader can tell when its
+    slot has been reused.
+    """
+    def __init__(self, slot_size, slot_cnt):
+        self.slot_size = slot_size  # Payload capacity of a slot
+        self.slot_cnt = slot_cnt
+        self.stride = -(-(_HEADER.size + slot_size) // _SLOT_ALIGN) * _SLOT_ALIGN
+        self.name = f"qmafpy_{os.getpid()}_{next(_ring_ids)}"
+        self.shm = shared_memory.SharedMemory(name=self.name, create=True, size=self.stride * slot_cnt)
+        self._next = 0
+        self._lock = threading.Lock()
+        with _lock:
+            _segments[self.name] = self.shm
+
+    def write(self, data):
+        """Copy a bytes-like object (e.g. bytes, bytearray, a contiguous NumPy array) into the next slot and
+        return its ShmHandle"""
+        src = memoryview(data)
+        nbytes = src.nbytes
+        if nbytes > self.slot_size:
+            raise ValueError(f"Payload of {nbytes} bytes exceeds the slot size of {self.slot_size}")
+        dtype = shape = None
+        if numpy is not None and isinstance(data, numpy.ndarray):
+            dtype, shape = data.dtype.str, data.shape
+        buf = self.shm.buf
+        with self._lock:
+            offset = self._next * self.stride
+            self._next = (self._next + 1) % self.slot_cnt
+            generation = _HEADER.unpack_from(buf, offset)[0] + 1
+            _HEADER.pack_into(buf, offset, generation, 0)  # Odd: being written
+            start = offset + _HEADER.size
+            buf[start:start + nbytes] = src.cast("B")
+            generation += 1
+            _HEADER.pack_into(buf, offset, generation, nbytes)
+        return ShmHandle(self.name, offset, generation, nbytes, dtype, shape)
+
+    def close(self, unlink=True):
+        with _lock:
+            _segments.pop(self.name, None)
+        try:
+            self.shm.close()
+        except BufferError:
+            pass  # A view is still in use.  The mapping goes away with the process.
+        if unlink:
+            try:
+                self.shm.unlink()
+            except FileNotFoundError:
+                pass
+
+
+def share(topic, data, slot_cnt=None):
+    """Write data into the shared memory ring of a topic and return its ShmHandle.
+    The ring is created on first use with App.cfg["shm_slot_cnt"] slots (default 8).  A payload larger than the
+    ring's slots replaces the ring with a larger one."""
+    if shared_memory is None:
+        raise NotImplementedError("Shared memory publishing needs Python 3.8+ (multiprocessing.shared_memory)")
+    nbytes = memoryview(data).nbytes
+    with _rings_lock:
+        ring = _rings.get(topic)
+        if ring is None or nbytes > ring.slot_size:
+            if slot_cnt is None:
+                slot_cnt = App.cfg.get("shm_slot_cnt", 8)
+            old_ring = ring
+            ring = ShmRing(max(nbytes, old_ring.slot_size * 2 if old_ring is not None else 0), slot_cnt)
+            _rings[topic] = ring
+            if old_ring is not None:
+                _retired_rings.append(old_ring)
+    return ring.write(data)
+
+
+def close_rings():
+    """Unlink the rings written by this process"""
+    with _rings_lock:
+        rings = list(_rings.values()) + _retired_rings
+        _rings.clear()
+        _retired_rings.clear()
+    for ring in rings:
+        ring.close()
+
+
+def _forget_rings():
+    # A forked child must not write into, or unlink, its parent's rings
+    global _lock, _rings_lock
+    _lock = threading.Lock()
+    _rings_lock = threading.Lock()
+    _rings.clear()
+    _retired_rings.clear()
+
+
+atexit.register(close_rings)
+if hasattr(os, "register_at_fork"):  # Not on Windows
+    os.register_at_fork(after_in_child=_forget_rings)
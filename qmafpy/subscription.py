@@ -1,10 +1,235 @@
+import threading
+import time
 from .actor import Actor
+from .globals import App
+
+
+# Aggregation of the samples a throttled subscription suppresses
+AGGREGATE_LAST = "last"  # Deliver the latest sample
+AGGREGATE_MINMAX = "minmax"  # Deliver (min, max) of the samples since the last delivery
+AGGREGATE_MEAN = "mean"  # Deliver the mean of the samples since the last delivery
+AGGREGATES = (AGGREGATE_LAST, AGGREGATE_MINMAX, AGGREGATE_MEAN)
+
+
+class Subscription:
+	"""One subscriber of a topic
+	A subscription can be throttled.  Publishes are then decimated before anything is enqueued:
+		every_nth: deliver one of every n publishes
+		max_rate_hz: deliver at most this many publishes per second.  The last sample held back is delivered
+			when the interval ends (trailing edge, see flush), so a burst always ends with its last value.
+	The suppressed samples can be aggregated into the next delivery (AGGREGATES, numeric data only).
+	Data that can't be aggregated (e.g. strings, dicts) is delivered as the raw sample, and counted in
+	aggregate_errors.  It never affects the other subscribers of the topic.
+	"""
+	__slots__ = ("dest_q", "task_method", "attributes", "conflate", "every_nth", "min_interval_s", "aggregate",
+				 "throttled", "delivered_cnt", "suppressed_cnt", "aggregate_errors", "last_error", "_skip_cnt",
+				 "_next_time", "_agg", "_held", "_flush_armed", "_lock")
+
+	def __init__(self, dest_q, task_method, attributes=None, conflate=False, max_rate_hz=None, every_nth=None,
+				 aggregate=AGGREGATE_LAST):
+		if aggregate not in AGGREGATES:
+			raise ValueError(f"Invalid aggregate: {aggregate}")
+		self.dest_q = dest_q  # Destination queue name
+		self.task_method = task_method
+		self.attributes = attributes
+		self.conflate = conflate  # Keep at most one pending delivery in the destination mailbox
+		self.every_nth = every_nth if every_nth is not None and every_nth > 1 else None
+		self.min_interval_s = 1.0 / max_rate_hz if max_rate_hz else None
+		self.aggregate = aggregate
+		self.throttled = self.every_nth is not None or self.min_interval_s is not None
+		self.delivered_cnt = 0  # Not locked for unthrottled subscriptions: concurrent publishers may rarely lose a count
+		self.suppressed_cnt = 0
+		self.aggregate_errors = 0  # Samples that could not be aggregated
+		self.last_error = None
+		self._skip_cnt = 0  # Publishes since the last delivery
+		self._next_time = 0.0  # Earliest time of the next delivery
+		self._agg = None  # Aggregate of the samples since the last delivery
+		self._held = None  # (topic, data) of the last sample max_rate_hz held back, for the trailing edge
+		self._flush_armed = False  # A trailing edge flush is scheduled
+		self._lock = threading.Lock()  # Publishers of the topic may run concurrently
+
+	def sample(self, topic, data, now):
+		"""Throttled subscriptions: return (deliver, data to deliver, flush time) for a publish.
+		A flush time is returned when a trailing edge flush must be scheduled (see flush)."""
+		with self._lock:
+			return self._sample(topic, data, now)
+
+	def _sample(self, topic, data, now):
+		if self.aggregate != AGGREGATE_LAST:
+			self._accumulate(data)
+		self._skip_cnt += 1
+		if self.every_nth is not None and self._skip_cnt < self.every_nth:
+			self.suppressed_cnt += 1
+			return False, None, None
+		if self.min_interval_s is not None:
+			if now < self._next_time:
+				self.suppressed_cnt += 1
+				self._held = (topic, data)
+				if self._flush_armed:
+					return False, None, None
+				self._flush_armed = True
+				return False, None, self._next_time
+			self._advance(now)
+		self.delivered_cnt += 1
+		return True, self._take(data), None
+
+	def _advance(self, now):
+		"""Set the earliest time of the next delivery, for a delivery at now.
+		Keep the delivery grid unless the topic went quiet for longer than an interval."""
+		if now - self._next_time < self.min_interval_s:
+			self._next_time += self.min_interval_s
+		else:
+			self._next_time = now + self.min_interval_s
+
+	def _take(self, data):
+		"""Start a new delivery interval and return the data to deliver for the latest sample"""
+		self._skip_cnt = 0
+		self._held = None
+		if self._agg is not None:
+			try:
+				data = self._result()
+			except Exception as e:
+				self._aggregate_failed(e)
+			self._agg = None
+		return data
+
+	def flush(self, now):
+		"""Trailing edge of max_rate_hz.  Return (topic, data) of the sample held back since the last delivery
+		if it is now due, (None, time) if it is due later, or None if there is nothing to deliver."""
+		with self._lock:
+			if self._held is None:
+				self._flush_armed = False
+				return None
+			if now < self._next_time:
+				return None, self._next_time
+			self._flush_armed = False
+			topic, data = self._held
+			self._advance(now)
+			self.delivered_cnt += 1
+			return topic, self._take(data)
+
+	def _accumulate(self, data):
+		agg = self._agg
+		try:
+			if agg is None:
+				self._agg = [data, data, data, 1]  # min, max, sum, count
+			else:
+				if data < agg[0]:
+					agg[0] = data
+				if data > agg[1]:
+					agg[1] = data
+				agg[2] += data
+				agg[3] += 1
+		except Exception as e:
+			self._aggregate_failed(e)
+
+	def _aggregate_failed(self, e):
+		"""Drop the aggregate.  The next delivery carries the raw sample."""
+		self._agg = None
+		self.aggregate_errors += 1
+		self.last_error = f"{type(e).__name__}: {e}"
+
+	def _result(self):
+		agg = self._agg
+		if self.aggregate == AGGREGATE_MINMAX:
+			return agg[0], agg[1]
+		return agg[2] / agg[3]
+
+	def stats(self):
+		return {"dest_q": self.dest_q, "delivered": self.delivered_cnt, "suppressed": self.suppressed_cnt,
+				"aggregate_errors": self.aggregate_errors}
+
+
+# Hierarchical topics: levels are separated by TOPIC_SEP.  In a subscription topic, a level can be a wildcard:
+TOPIC_SEP = "/"
+WILDCARD_ONE = "+"  # Matches exactly one level
+WILDCARD_ALL = "#"  # Matches all remaining levels (zero or more).  Only allowed as the last level.
+_MATCH_CACHE_MAX = 100000  # The match cache is cleared when it grows past this number of published topics
+
+
+def is_wildcard(topic:str):
+	return WILDCARD_ONE in topic or WILDCARD_ALL in topic
+
+
+def check_pattern(topic:str):
+	"""Raise ValueError if the wildcards of a subscription topic are misplaced"""
+	levels = topic.split(TOPIC_SEP)
+	for i, level in enumerate(levels):
+		if level in (WILDCARD_ONE, WILDCARD_ALL):
+			if level == WILDCARD_ALL and i != len(levels) - 1:
+				raise ValueError(f"Invalid topic {topic}: {WILDCARD_ALL} must be the last level")
+		elif WILDCARD_ONE in level or WILDCARD_ALL in level:
+			raise ValueError(f"Invalid topic {topic}: a wildcard must be a whole level")
+
+
+class _TopicTrie:
+	"""Index of the wildcard subscription topics.  Each node is one level.
+	Matching a published topic walks at most the topic's levels (twice per level when + is used), so the cost
+	does not depend on the number of wildcard subscriptions."""
+	__slots__ = ("children", "patterns")
+
+	def __init__(self):
+		self.children = {}  # key = level, value = _TopicTrie
+		self.patterns = frozenset()  # Subscription topics that end at this node.  Replaced, never changed in place.
+
+	def add(self, pattern:str):
+		node = self
+		for level in pattern.split(TOPIC_SEP):
+			child = node.children.get(level)
+			if child is None:
+				child = node.children[level] = _TopicTrie()
+			node = child
+		node.patterns = node.patterns | {pattern}
+
+	def remove(self, pattern:str):
+		path = [self]
+		for level in pattern.split(TOPIC_SEP):
+			node = path[-1].children.get(level)
+			if node is None:
+				return
+			path.append(node)
+		path[-1].patterns = path[-1].patterns - {pattern}
+		# Prune the nodes left empty
+		levels = pattern.split(TOPIC_SEP)
+		for i in range(len(levels), 0, -1):
+			node = path[i]
+			if node.patterns or node.children:
+				break
+			del path[i - 1].children[levels[i - 1]]
+
+	def match(self, levels, i=0, matches=None):
+		"""Return the set of subscription topics that match a published topic split into levels"""
+		if matches is None:
+			matches = set()
+		children = self.children
+		node = children.get(WILDCARD_ALL)
+		if node is not None:
+			matches.update(node.patterns)
+		if i == len(levels):
+			matches.update(self.patterns)
+			return matches
+		node = children.get(levels[i])
+		if node is not None:
+			node.match(levels, i + 1, matches)
+		node = children.get(WILDCARD_ONE)
+		if node is not None:
+			node.match(levels, i + 1, matches)
+		return matches
 
 
 class SubsriptionMgr(Actor):
 	"""This module handles subscriptions
 	Data can be published under a topic (a key name for the data)
 	Published data can be subscribed to.  The subscriber needs to provide a queue and task name where the data will be sent.
+	Topics are hierarchical (rack1/dmm3/voltage).  A subscription topic may use + (one level) and # (all remaining
+	levels) wildcards, e.g. rack1/+/voltage or rack1/#.  Deliveries carry the published topic.
+	The subscriptions matching each published topic are kept in a match cache, which is cleared when a
+	subscription is added or removed.  On a cache miss, wildcard topics are matched with a trie.
+	Publishing does not take the lock.  Changes to the subscriptions are copy-on-write: a topic's subscriber dict,
+	the trie's pattern sets and the match cache are replaced rather than changed in place, so a publisher always
+	reads a consistent snapshot.
+	publish_many publishes several topics at once and sends one receive_publications message per destination.
+	Deliveries never wait for room in a full mailbox.  A refused delivery is counted in failed_deliveries.
 	"""
 
 	def __init__(self, log_level=0):
@@ -20,36 +245,161 @@ class SubsriptionMgr(Actor):
 			key	= topic
 			value = dictionary of subscribers.  
 				key = subscription ID
-					value = (destination queue name, task_method)
+					value = Subscription (destination queue name, task_method, attributes, conflate)
 					When this topic is published, the enqueued item will contain (task_method, data_object)
 		"""	
 		self.name = "subscription"
 		super().__init__(self.name, log_level=log_level)
 		self.subs_ids_cnt = {}  # Contains a count of each time a dup id used.  A new ID is generated using this int.
+		self._wildcards = _TopicTrie()  # Index of the wildcard subscription topics
+		self._match_cache = {}  # Replaced when the subscriptions change.  key = published topic, value = tuple of (subscription topic, subscription ID, Subscription)
+		self.failed_deliveries = {}  # key = (subscription topic, subscription ID), value = count of publishes a full mailbox refused
 
 	def _publish(self, topic:str, data):
 		"""Data is published under a topic (an identifier)
 		Any subscribers to the data will be sent the data.
 		"""
-		self.log(f"Publish Event topic={topic} data={data}", 5)
-		with self.lock:
-			#Store
+		self.log("Publish Event topic=%s data=%s", 5, topic, data)
+		#Store
+		self.published_data[topic] = data
+		#Service Subscriptions
+		deliveries = self._check_subs(topic, data)
+		if App.metrics is not None:
+			App.metrics.record_publish(topic, deliveries)
+
+	def _publish_many(self, data_by_topic:dict):
+		"""Publish several topics.  The deliveries to each destination are sent as one receive_publications
+		message, in the order of data_by_topic.  Conflated subscriptions are still delivered one by one: the
+		deliveries grouped so far for that destination are sent first, so each destination keeps the order."""
+		self.log("Publish Many Event topics=%s", 5, list(data_by_topic))
+		groups = {}  # key = destination queue name, value = list of (pattern, subs_id, delivery)
+		metrics = App.metrics
+		for topic, data in data_by_topic.items():
 			self.published_data[topic] = data
-			#Service Subscriptions
-			self._check_subs(topic)
-
-	def _check_subs(self, topic:str):
-		if topic in self.subscriptions:
-			for subscription in self.subscriptions[topic].values():
-				# value = (dest_q, task, data_only)
-				dest_q, task_method, attributes = subscription
-				data = self.published_data[topic]
-				self.enqueue(dest_q, task_method, topic, attributes, data)
-
-	def add_subscription(self, topic:str, dest_q:str, task_method, attributes=None, subs_id=None):
+			deliveries = self._admit(topic, data)
+			if metrics is not None:
+				metrics.record_publish(topic, len(deliveries))
+			for pattern, subs_id, subscription, data in deliveries:
+				if subscription.conflate:
+					group = groups.pop(subscription.dest_q, None)
+					if group is not None:
+						self._send_group(subscription.dest_q, group)
+					self._deliver(topic, pattern, subs_id, subscription, data)
+				else:
+					groups.setdefault(subscription.dest_q, []).append(
+						(pattern, subs_id, (subscription.task_method, topic, subscription.attributes, data)))
+		for dest_q, group in groups.items():
+			self._send_group(dest_q, group)
+
+	def _send_group(self, dest_q, group):
+		"""Send the deliveries of a publish_many to one destination"""
+		if len(group) == 1:
+			pattern, subs_id, (task_method, topic, attributes, data) = group[0]
+			queued = self._send(dest_q, (task_method, (topic, attributes, data), {}))
+		else:
+			queued = self._send(dest_q, ("receive_publications", ([delivery for _, _, delivery in group],), {}))
+		if not queued:
+			for pattern, subs_id, _ in group:
+				self._count_failed(pattern, subs_id)
+
+	def _match(self, topic:str):
+		"""Return the subscriptions that match a published topic"""
+		cache = self._match_cache  # A newer cache replaces this one if the subscriptions change meanwhile
+		matches = cache.get(topic)
+		if matches is None:
+			matches = [(topic, subs_id, subscription) for subs_id, subscription in self.subscriptions.get(topic, {}).items()]
+			if self._wildcards.children:
+				for pattern in self._wildcards.match(topic.split(TOPIC_SEP)):
+					matches.extend((pattern, subs_id, subscription)
+								   for subs_id, subscription in self.subscriptions.get(pattern, {}).items())
+			matches = tuple(matches)
+			if len(cache) >= _MATCH_CACHE_MAX:
+				cache.clear()
+			cache[topic] = matches
+		return matches
+
+	def _admit(self, topic:str, published):
+		"""Return a list of (subscription topic, subscription ID, Subscription, data) to deliver for a publish"""
+		deliveries = []
+		now = None
+		for pattern, subs_id, subscription in self._match(topic):
+			data = published
+			if subscription.throttled:
+				if now is None:
+					now = time.monotonic()
+				errors = subscription.aggregate_errors
+				deliver, data, flush_time = subscription.sample(topic, published, now)
+				if subscription.aggregate_errors and not errors:
+					self.log(f"ERROR: Can't aggregate ({subscription.aggregate}) the data of {topic} for "
+							 f"{subscription.dest_q}: {subscription.last_error}.  Delivering raw samples.", 0)
+				if flush_time is not None:
+					self._arm_flush(pattern, subs_id, flush_time - now)
+				if not deliver:
+					continue
+			else:
+				subscription.delivered_cnt += 1  # Unlocked, like Histogram (throttled ones count in sample)
+			deliveries.append((pattern, subs_id, subscription, data))
+		return deliveries
+
+	def _arm_flush(self, pattern, subs_id, delay_s):
+		"""Schedule the trailing edge flush of a max_rate_hz subscription.  Needs App.scheduler."""
+		if App.scheduler is not None:
+			App.scheduler.schedule(self.name, f"flush:{pattern}:{subs_id}", max(delay_s, 0.0), 1, self.name,
+								   "flush_trailing", pattern, subs_id)
+
+	def flush_trailing(self, pattern, subs_id):
+		"""Deliver the last sample a max_rate_hz subscription held back, once its interval has ended"""
+		subscription = self.subscriptions.get(pattern, {}).get(subs_id)
+		if subscription is None:
+			return
+		now = time.monotonic()
+		flushed = subscription.flush(now)
+		if flushed is None:
+			return
+		topic, data = flushed
+		if topic is None:  # A delivery moved the interval meanwhile.  data is when the new one ends.
+			self._arm_flush(pattern, subs_id, data - now)
+			return
+		self._deliver(topic, pattern, subs_id, subscription, data)
+
+	def _deliver(self, topic, pattern, subs_id, subscription, data):
+		item = (subscription.task_method, (topic, subscription.attributes, data), {})
+		key = ("subs", topic, pattern, subs_id) if subscription.conflate else None
+		if not self._send(subscription.dest_q, item, key):
+			self._count_failed(pattern, subs_id)
+
+	def _send(self, q_name, item, key=None):
+		"""Enqueue a delivery.  It never waits for room: a full mailbox refuses it, so a slow subscriber can't
+		stall the publishers.  Returns False if it was not queued."""
+		dest_q = App.get_queue(q_name)
+		if dest_q is None:
+			self.log(f"ERROR: dest_q does not exist.  Publish dest={q_name} task={item[0]}", 0)
+			return False
+		return self._put(dest_q, q_name, item, key=key, block=False)
+
+	def _count_failed(self, pattern, subs_id):
+		key = (pattern, subs_id)
+		with self.lock:
+			self.failed_deliveries[key] = self.failed_deliveries.get(key, 0) + 1
+
+	def _check_subs(self, topic:str, data):
+		"""Deliver a publish.  Returns the number of deliveries."""
+		deliveries = self._admit(topic, data)
+		for pattern, subs_id, subscription, data in deliveries:
+			self._deliver(topic, pattern, subs_id, subscription, data)
+		return len(deliveries)
+
+	def add_subscription(self, topic:str, dest_q:str, task_method, attributes=None, subs_id=None, conflate=False,
+						 max_rate_hz=None, every_nth=None, aggregate=AGGREGATE_LAST):
 		"""Data is subscribed by providing the topic, a queue and task name for where to send the data.
+		With conflate=True, a publish replaces the data of this subscription's delivery still waiting in the
+		destination mailbox instead of queueing another one.
+		max_rate_hz / every_nth throttle the deliveries.  aggregate selects what a delivery carries (see Subscription).
+		The topic may contain wildcards.  Throttling then applies to the matching topics together.
 		"""
-		self.log(f"Subscribe Event topic={topic} dest_q={dest_q} task_method={task_method}", 5)
+		if is_wildcard(topic):
+			check_pattern(topic)
+		self.log("Subscribe Event topic=%s dest_q=%s task_method=%s", 5, topic, dest_q, task_method)
 		if subs_id is None:
 			subs_id = str(dest_q)
 			if subs_id in self.subs_ids_cnt:
@@ -59,24 +409,45 @@ class SubsriptionMgr(Actor):
 			else:
 				self.subs_ids_cnt[subs_id] = 1
 		with self.lock:
-			self.log(f"Subscription for {topic} sourceID={subs_id} task={task_method}", 3)
-			if not topic in self.subscriptions:
-				self.subscriptions[topic] = {}
-			self.subscriptions[topic][subs_id] = (dest_q,task_method, attributes)
+			self.log("Subscription for %s sourceID=%s task=%s", 3, topic, subs_id, task_method)
+			topic_subs = dict(self.subscriptions.get(topic, {}))
+			topic_subs[subs_id] = Subscription(dest_q, task_method, attributes, conflate, max_rate_hz, every_nth, aggregate)
+			self.subscriptions[topic] = topic_subs
+			if len(topic_subs) == 1 and is_wildcard(topic):
+				self._wildcards.add(topic)
+			self._match_cache = {}
 
 	def get_data(self, topic:str, default_value=None):
 		"""The last published data under the specified topic will be returned.
 		If no data for the topic exists, then the defaultValue will be returned."""
 		return self.published_data.get(topic, default_value)
 
+	def get_subscription_stats(self, topic=None):
+		"""Return {topic: {subscription ID: {dest_q, delivered, suppressed}}} for one topic or all topics"""
+		with self.lock:
+			topics = [topic] if topic is not None else list(self.subscriptions)
+			return {t: {subs_id: subscription.stats() for subs_id, subscription in self.subscriptions.get(t, {}).items()}
+					for t in topics}
+
 	def unsubscribe(self, topic, subs_id):
 		with self.lock:
 			if topic in self.subscriptions and subs_id in self.subscriptions[topic]:
-				del self.subscriptions[topic][subs_id]
+				topic_subs = dict(self.subscriptions[topic])
+				del topic_subs[subs_id]
+				if topic_subs:
+					self.subscriptions[topic] = topic_subs
+				else:
+					del self.subscriptions[topic]
+					if is_wildcard(topic):
+						self._wildcards.remove(topic)
+				self._match_cache = {}
 
 	def reset(self):
 		"""This method clears any stored published data and subscriptions.
 		"""
-		self.published_data = {}
-		self.subscriptions = {}
+		with self.lock:
+			self.published_data = {}
+			self.subscriptions = {}
+			self._wildcards = _TopicTrie()
+			self._match_cache = {}
 	
\ No newline at end of file
@@ -0,0 +1,153 @@
+import sys
+import threading
+import time
+import traceback
+import weakref
+from .actor import Actor
+from .globals import App
+
+
+class _ActorState:
+    """What the watchdog last saw of one actor"""
+    def __init__(self, now):
+        self.done_cnt = 0
+        self.progress_time = now  # Last time the actor completed a task or was idle
+        self.flagged = None  # Reason the actor is flagged, or None
+
+
+class Watchdog(Actor):
+    """This class detects stalled actors and query deadlocks.  It is started by AppMgr.init_services() as
+    App.watchdog, unless App.cfg["watchdog_enabled"] is False.
+        Actors created after it register themselves (see Actor.__init__).  Each one then keeps its current
+        tasks and their start times, and counts completed tasks as a heartbeat.
+        Every App.cfg["watchdog_interval_s"] (default 1), its own thread checks each actor.  An actor is flagged:
+            stalled: its mailbox is not empty and no task completed for watchdog_stall_s (default 10)
+            long task: a task has been running for watchdog_task_s (default watchdog_stall_s)
+        Query wait-for cycles are also flagged: actors blocked in QueryFuture.result() (e.g. task_query) on
+        each other for watchdog_query_s (default 1).
+        Flags are logged once, with the stacks of the actor's threads, and cleared when the actor progresses.
+        get_report() returns the current flags.
+    """
+    def __init__(self, log_level=0):
+        self.name = "watchdog"
+        self.interval_s = App.cfg.get("watchdog_interval_s", 1.0)
+        self.stall_s = App.cfg.get("watchdog_stall_s", 10.0)
+        self.task_s = App.cfg.get("watchdog_task_s", self.stall_s)
+        self.query_s = App.cfg.get("watchdog_query_s", 1.0)
+        self.actors = weakref.WeakValueDictionary()  # key = actor name, value = actor
+        self.states = {}  # key = actor name, value = _ActorState
+        self.cycles = set()  # Wait-for cycles flagged, as tuples of actor names
+        self._registry_lock = threading.Lock()
+        self._stop_event = threading.Event()
+        super().__init__(self.name, log_level=log_level)
+        self.check_thread = threading.Thread(target=self._check_loop, args=(), name="watchdog", daemon=True)
+        self.check_thread.start()
+
+    def register(self, actor):
+        """Start watching an actor.  Returns the dict in which it keeps its running tasks
+        (key = thread ident, value = (task, start time))."""
+        with self._registry_lock:
+            self.actors[actor.name] = actor
+            self.states[actor.name] = _ActorState(time.monotonic())
+        return {}
+
+    def _check_loop(self):
+        while not self._stop_event.wait(self.interval_s):
+            try:
+                self.check()
+            except Exception as e:
+                self.log(f"ERROR: Watchdog check failed: {e}")
+
+    def check(self):
+        """Check every actor, and the query wait-for graph"""
+        now = time.monotonic()
+        with self._registry_lock:
+            actors = [(actor, self.states[name]) for name, actor in list(self.actors.items())]
+            for name in set(self.states).difference(self.actors):  # Actors garbage collected
+                del self.states[name]
+        for actor, state in actors:
+            self._check_actor(actor, state, now)
+        self._check_cycles([actor for actor, _ in actors], now)
+
+    def _check_actor(self, actor, state, now):
+        busy = actor._busy
+        if busy is None:
+            return
+        running = list(busy.values())
+        depth = actor.q.qsize() if hasattr(actor.q, "qsize") else 0
+        if actor._done_cnt != state.done_cnt or (depth == 0 and not running):
+            state.done_cnt = actor._done_cnt
+            state.progress_time = now
+        reason = None
+        if running:
+            task, start = min(running, key=lambda r: r[1])
+            if now - start >= self.task_s:
+                reason = f"task {_task_name(task)} running for {now - start:.1f} s, mailbox depth {depth}"
+        if reason is None and depth > 0 and now - state.progress_time >= self.stall_s:
+            reason = f"stalled: no task completed for {now - state.progress_time:.1f} s, mailbox depth {depth}"
+        if reason is not None and state.flagged is None:
+            self.log(f"WARNING: Actor {actor.name} {reason}\n{self._format_stacks(actor)}")
+        elif reason is None and state.flagged is not None:
+            self.log(f"Actor {actor.name} recovered", 1)
+        state.flagged = reason
+
+    def _check_cycles(self, actors, now):
+        """Find cycles of actors blocked on queries to each other"""
+        waits_for = {}  # key = actor name, value = set of the actor names it is blocked on
+        for actor in actors:
+            for dest, since in actor.replies.blocked_on():
+                if dest is not None and now - since >= self.query_s:
+                    waits_for.setdefault(actor.name, set()).add(dest)
+        cycles = set()
+        for name in waits_for:
+            cycles.update(_find_cycles(name, waits_for))
+        by_name = {actor.name: actor for actor in actors}
+        for cycle in cycles - self.cycles:
+            stacks = "\n".join(self._format_stacks(by_name[name]) for name in cycle if name in by_name)
+            self.log(f"WARNING: Query deadlock: {' -> '.join(cycle + (cycle[0],))}\n{stacks}")
+        self.cycles = cycles
+
+    def _format_stacks(self, actor):
+        """Return the current stacks of the threads running the actor's tasks"""
+        idents = set(actor._busy or ())
+        idents.update(thread.ident for thread in actor.task_monitor_threads if thread.ident is not None)
+        frames = sys._current_frames()
+        lines = []
+        for ident in idents:
+            frame = frames.get(ident)
+            if frame is not None:
+                lines.append(f"Thread {ident} of {actor.name}:\n{''.join(traceback.format_stack(frame))}")
+        return "".join(lines)
+
+    def get_report(self):
+        """Return the flagged actors ({name: reason}) and query deadlocks (list of cycles)"""
+        with self._registry_lock:
+            flagged = {name: state.flagged for name, state in self.states.items() if state.flagged is not None}
+        return {"flagged": flagged, "deadlocks": [list(cycle) for cycle in self.cycles]}
+
+    def stop(self):
+        self._stop_event.set()
+        super().stop()
+
+
+def _find_cycles(start, waits_for):
+    """Return the wait-for cycles through start, each rotated to begin with its smallest name"""
+    cycles = []
+    path = [start]
+    pending = [iter(waits_for.get(start, ()))]
+    while pending:
+        dest = next(pending[-1], None)
+        if dest is None:
+            pending.pop()
+            path.pop()
+        elif dest == start:
+            i = path.index(min(path))
+            cycles.append(tuple(path[i:] + path[:i]))
+        elif dest not in path:
+            path.append(dest)
+            pending.append(iter(waits_for.get(dest, ())))
+    return cycles
+
+
+def _task_name(task):
+    return task if type(task) == str else getattr(task, "__name__", str(task))